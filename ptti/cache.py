@@ -0,0 +1,180 @@
+__all__ = ["ResultCache"]
+
+from ptti.model import runModel
+from ptti.version import software
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=None)
+def source_hash():
+    """
+    Hash of the source of this package, its python modules and Kappa
+    rules, so that results are not reused after any change to it,
+    committed or not, whether or not it is in a git repository.
+    """
+    top = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(top):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith((".py", ".ka")):
+                continue
+            path = os.path.join(root, name)
+            h.update(os.path.relpath(path, top).encode("utf-8"))
+            with open(path, "rb") as fp:
+                h.update(fp.read())
+    return h.hexdigest()
+
+def canonical(obj):
+    """
+    Convert a configuration value into plain JSON-serialisable data
+    that does not depend on the order of dictionary keys, or on whether
+    numbers are numpy or python ones.
+    """
+    if isinstance(obj, dict):
+        return [[str(k), canonical(v)] for k, v in sorted(obj.items(), key=lambda kv: str(kv[0]))]
+    if isinstance(obj, (list, tuple)):
+        return [canonical(v) for v in obj]
+    if isinstance(obj, np.ndarray):
+        return canonical(obj.tolist())
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, type):
+        return "{}:{}".format(obj.__module__, obj.__qualname__)
+    return obj
+
+class ResultCache(object):
+    """
+    Cache of simulation results in a directory on disk. Results are
+    keyed on a hash of everything that determines them: the model
+    class, time grid, parameters, initial conditions, interventions,
+    random seed, and the software version and source. They are kept
+    as compressed numpy files, and when the total size goes over
+    maxsize bytes, the least recently used are removed.
+
+    >>> cache = ResultCache("cache")
+    >>> t, traj = cache.runModel(SEIRCTODEMem, 0, 300, 300, params, initial)
+    """
+    def __init__(self, directory, maxsize=2**30):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        ## estimate of the total size, kept up to date by put, so that
+        ## the directory is only scanned when it may be too big
+        self.size = self.evict()
+
+    def key(self, model, t0, tmax, steps, parameters={}, initial={}, interventions=[],
+            rseries=True, seed=0, runner="runModel", **unused):
+        """
+        Return the key for the result of running the model with the
+        given configuration, as for `runModel`. Any other configuration,
+        such as the output file name, is ignored. The runner says how
+        the result was produced, since batches of ODE samples are not
+        identical to single runs.
+        """
+        data = canonical({
+            "model": model, "t0": t0, "tmax": tmax, "steps": steps,
+            "parameters": parameters, "initial": initial,
+            "interventions": interventions, "rseries": rseries, "seed": seed,
+            "runner": runner, "software": software, "source": source_hash(),
+        })
+        text = json.dumps(data, separators=(",", ":"))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, "{}.npz".format(key))
+
+    def get(self, key):
+        """
+        Return the `(t, traj)` stored under key, or None.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                t, traj = data["t"], data["traj"]
+        except (IOError, KeyError, ValueError):
+            self.misses += 1
+            log.debug("Cache miss: {}".format(key))
+            return None
+
+        ## mark it as recently used
+        os.utime(path)
+        self.hits += 1
+        log.debug("Cache hit: {}".format(key))
+        return t, traj
+
+    def put(self, key, t, traj):
+        """
+        Store `(t, traj)` under key, and evict old results if the cache
+        has become too big.
+        """
+        ## write under a temporary name so that other processes never
+        ## see a partial file
+        path = self._path(key)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "wb") as fp:
+            np.savez_compressed(fp, t=t, traj=traj)
+        self.size += os.path.getsize(tmp)
+        os.replace(tmp, path)
+
+        ## other processes may be adding to the cache too, so the
+        ## estimate can be low, and is corrected whenever it is checked
+        if self.size > self.maxsize:
+            self.size = self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used results, other than the one under
+        the key keep, until the total size is at most maxsize. Returns
+        the total size that remains.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.maxsize:
+                break
+            if name == "{}.npz".format(keep):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+                log.debug("Cache evicted: {}".format(name))
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    def runModel(self, model, *args, **kwargs):
+        """
+        Run the model, as with `runModel`, unless the result is already
+        in the cache.
+        """
+        names = ("t0", "tmax", "steps", "parameters", "initial", "interventions", "rseries", "seed")
+        kwargs.update(zip(names, args))
+        key = self.key(model, **kwargs)
+
+        result = self.get(key)
+        if result is None:
+            result = runModel(model, **kwargs)
+            self.put(key, *result)
+        return result
+
+    def __str__(self):
+        return "{} hits, {} misses".format(self.hits, self.misses)
@@ -1,7 +1,8 @@
 import argparse
 import pkg_resources
+from ptti.cache import ResultCache
 from ptti.config import config_load, config_save
-from ptti.model import runModel
+from ptti.model import runModel, runModelBatch, runScenarios
 from ptti.plotting import plot
 from multiprocessing import Pool
 import logging as log
@@ -23,16 +24,20 @@ def mpirank():
 log.basicConfig(stream=sys.stdout, level=log.INFO,
                 format='%(asctime)s - %(name)s:%(levelname)s - %(message)s')
 
+def load_models():
+    ## locate models by name from pkg_resources
+    models = {}
+    for ep in pkg_resources.iter_entry_points(group='models'):
+        models.update({ep.name: ep.load()})
+    return models
+
 def command():
     ## if we are running in MPI, and we are a worker process, skip all this
     if inmpi() and mpirank() > 0:
         mpiwork()
         sys.exit(0)
 
-    ## locate models by name from pkg_resources
-    models = {}
-    for ep in pkg_resources.iter_entry_points(group='models'):
-        models.update({ep.name: ep.load()})
+    models = load_models()
 
     parser = argparse.ArgumentParser("ptti",
                                      description="Population-wide Testing, Tracing and Isolation Models")
@@ -64,6 +69,10 @@ def command():
                         default=False, help="Dump model state and exit")
     parser.add_argument("--parallel", action="store_true",
                         default=False, help="Execute samples in parallel")
+    parser.add_argument("--cache", default=None, metavar="DIR",
+                        help="Reuse results of identical runs kept in DIR")
+    parser.add_argument("--cache-size", type=float, default=1024,
+                        help="Largest size of the cache in MB")
     parser.add_argument("-v", "--var", nargs="*", default=[],
                         help="Set variables / parameters")
 
@@ -117,11 +126,51 @@ def command():
 
     cfg = mkcfg(0)
     samples = [(i, mkcfg(i)) for i in range(cfg["meta"]["samples"])]
-    trajectories = pmap(runSample, samples)
+    batch = args.parallel and not inmpi() and batchable(samples)
+
+    ## look up samples that have been run before, and only run the rest
+    if args.cache is not None:
+        cache = ResultCache(args.cache, int(args.cache_size * 2**20))
+        runner = "runModelBatch" if batch else "runModel"
+        keys = []
+        for i, c in samples:
+            c["meta"]["seed"] = i
+            keys.append(cache.key(runner=runner, **dict(c, **c["meta"])))
+        cached = [cache.get(k) for k in keys]
+        log.info("Cache: {}".format(cache))
+        todo = [s for s, r in zip(samples, cached) if r is None]
+    else:
+        todo = samples
+
+    if len(todo) == 0:
+        computed = []
+    elif batch:
+        computed = runBatch(todo)
+    else:
+        computed = pmap(runSample, todo)
+
+    if args.cache is not None:
+        computed = iter(computed)
+        trajectories = []
+        for k, r in zip(keys, cached):
+            if r is None:
+                tseries = next(computed)
+                cache.put(k, tseries[:, 0], tseries[:, 1:])
+            else:
+                t, traj = r
+                tseries = np.vstack([t, traj.T]).T
+            trajectories.append(tseries)
+    else:
+        trajectories = computed
 
     for s, traj in zip(samples, trajectories):
 
         i, cfg = s
+        ## record when the epidemic died out, if it did
+        m = cfg["meta"]["model"]()
+        cfg["meta"]["extinction"] = m.extinction(traj[:, 0], traj[:, 1:])
+        if cfg["meta"]["extinction"] is not None:
+            log.info("Sample {} extinct at t = {}".format(i, cfg["meta"]["extinction"]))
         outfile = "{}-{}.tsv".format(cfg["meta"]["output"], i)
         np.savetxt(outfile, traj, delimiter="\t")
 
@@ -146,6 +195,65 @@ def command():
     if args.plot:
         plot(**cfg["meta"], **cfg)
 
+def scenarios():
+    # Run several scenarios together, simulating the beginning that they
+    # have in common only once
+
+    models = load_models()
+
+    parser = argparse.ArgumentParser("ptti-scenarios",
+                                     description="Run scenarios that share their early interventions")
+    parser.add_argument("yaml", nargs="+",
+                        help="YAML files describing the scenarios")
+    parser.add_argument("-m", "--model", default=None,
+                        help="Select model: {}".format(", ".join(
+                            models.keys())))
+    parser.add_argument("--samples", type=int, default=None,
+                        help="Number of samples")
+    parser.add_argument("--loglevel", default="INFO",
+                        help="Set logging level")
+    parser.add_argument("--parallel", action="store_true",
+                        default=False, help="Execute samples in parallel")
+
+    args = parser.parse_args()
+
+    log.getLogger().setLevel(getattr(log, args.loglevel))
+
+    def mkcfg(filename, sample):
+        cfg = config_load(filename, sample)
+        if args.model is not None:
+            cfg["meta"]["model"] = args.model
+        model = models.get(cfg["meta"]["model"])
+        if model is None:
+            log.error("Unknown model: {}".format(cfg["meta"]["model"]))
+            sys.exit(255)
+        cfg["meta"]["model"] = model
+        cfg["meta"]["seed"] = sample
+        return cfg
+
+    ## every sample is a tree of all of the scenarios
+    nsamples = args.samples
+    if nsamples is None:
+        nsamples = max(mkcfg(y, 0)["meta"]["samples"] for y in args.yaml)
+    samples = [[mkcfg(y, i) for y in args.yaml] for i in range(nsamples)]
+
+    if args.parallel:
+        pmap = Pool().map
+    else:
+        def pmap(f, v): return list(map(f, v))
+
+    for i, (cfgs, trajectories) in enumerate(zip(samples, pmap(runScenarioSample, samples))):
+        for cfg, traj in zip(cfgs, trajectories):
+            cfg["meta"]["samples"] = nsamples
+            m = cfg["meta"]["model"]()
+            cfg["meta"]["extinction"] = m.extinction(traj[:, 0], traj[:, 1:])
+
+            outfile = "{}-{}.tsv".format(cfg["meta"]["output"], i)
+            np.savetxt(outfile, traj, delimiter="\t")
+
+            cfgout = "{}-{}.yaml".format(cfg["meta"]["output"], i)
+            config_save(cfg, cfgout)
+
 def compare():
     # Compare two different runs of the same model, gauge one vs. the other
     # and produce various metrics
@@ -253,6 +361,33 @@ def runSample(arg):
 
     return tseries
 
+def runScenarioSample(cfgs):
+    results = runScenarios([dict(cfg["meta"], **cfg) for cfg in cfgs])
+    return [np.vstack([t, traj.T]).T for t, traj in results]
+
+def batchable(samples):
+    """
+    Samples can be run as a batch in one process if the model supports
+    it and they differ only in their random seed.
+    """
+    _, cfg = samples[0]
+    if getattr(cfg["meta"]["model"], "run_batch", None) is None:
+        return False
+    return all(c[k] == cfg[k] for _, c in samples
+               for k in ("parameters", "initial", "interventions"))
+
+def runBatch(samples):
+    _, cfg = samples[0]
+    seeds = [i for i, _ in samples]
+    for i, c in samples:
+        c["meta"]["seed"] = i
+
+    meta = dict(cfg["meta"])
+    meta.pop("seed", None)
+    t, trajs = runModelBatch(seeds=seeds, **meta, **cfg)
+
+    return [np.vstack([t, traj.T]).T for traj in trajs]
+
 def mpimap(f, v):
     if MPI is None:
         log.error("Using MPI requires installation of mpi4py")
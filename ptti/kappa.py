@@ -0,0 +1,267 @@
+__all__ = ['KappaSystem']
+
+import itertools
+import re
+import numpy as np
+from numba import jit
+
+_agent_re = re.compile(r"(\w+)\(([^)]*)\)|\.")
+_site_re  = re.compile(r"(\w+)\{([^}]*)\}")
+
+def _pattern(text):
+    """
+    Parse a Kappa pattern, a list of agents separated by commas, into
+    a list of (agent, sites) where sites is a dictionary of site names
+    to the state as written, or (None, None) for the empty agent ".".
+    """
+    agents = []
+    for m in _agent_re.finditer(text):
+        if m.group(0) == ".":
+            agents.append((None, None))
+        else:
+            agents.append((m.group(1), dict(_site_re.findall(m.group(2)))))
+    return agents
+
+@jit(nopython=True, cache=True)
+def reaction_propensity(x, k, reactants, r):
+    """
+    The propensity of reaction r, with rate constant k[r], in the state
+    x: the rate times the number of ways of choosing its reactants, in
+    order, from the species counts.
+    """
+    n = len(x)
+    v = k[r]
+    for m in range(reactants.shape[1]):
+        s = reactants[r, m]
+        if s >= n:
+            break
+        c = x[s]
+        for l in range(m):
+            if reactants[r, l] == s:
+                c -= 1
+        v *= max(c, 0)
+    return v
+
+@jit(nopython=True, cache=True)
+def reaction_ssa(t, tgrid, tmax, seed, x, k, reactants, delta, deps, out):
+    """
+    Simulate a system of reactions between species exactly, with
+    Gillespie's direct method, from time t to tmax. The reactants of
+    reaction r are given by reactants[r], padded with the number of
+    species, and it changes the species counts x by delta[r]. Only the
+    propensities given by deps, as for coupling_deps, are recomputed
+    after each reaction. The counts are updated in place and their
+    values at the times in tgrid are written into out. The random
+    number generator is seeded with seed. Returns the time reached and
+    the seed to continue with.
+    """
+    np.random.seed(seed)
+    ptr, dep = deps
+    a = np.empty(len(k))
+    for r in range(len(k)):
+        a[r] = reaction_propensity(x, k, reactants, r)
+
+    j = 0
+    while True:
+        total = np.sum(a)
+        tnext = t + np.random.exponential(1.0/total) if total > 0 else np.inf
+
+        # the state holds until the next event
+        while j < len(tgrid) and tgrid[j] < min(tnext, tmax):
+            out[j] = x
+            j += 1
+        if tnext > tmax:
+            break
+        t = tnext
+
+        # choose which reaction happens
+        u = np.random.random()*total
+        r = 0
+        while r < len(a) - 1 and u >= a[r]:
+            u -= a[r]
+            r += 1
+
+        x += delta[r]
+        for d in range(ptr[r], ptr[r+1]):
+            a[dep[d]] = reaction_propensity(x, k, reactants, dep[d])
+
+    while j < len(tgrid):
+        out[j] = x
+        j += 1
+    return tmax, np.random.randint(0, 2**31 - 1)
+
+
+class KappaSystem(object):
+    """
+    A Kappa model whose agents have internal states but no bonds,
+    compiled into reactions between species, one species for each
+    combination of the internal states of an agent. This is enough for
+    `seir-ct.ka`, and simulating the reactions gives the same
+    statistics as KaSim, in process. A rule whose left hand side
+    matches several species, such as `C() -> .`, becomes one reaction
+    for each, with the rate of the rule, which like KaSim counts every
+    way of matching the left hand side.
+
+    The supported statements are `%agent`, `%var`, `%init`, `%obs` and
+    rules, either with `->` or with the states edited in place as
+    `P(s{e/i})`. Rates and variables may be arithmetic expressions of
+    variables.
+
+    >>> ks = KappaSystem(kappa_text)
+    >>> t, obs, x = ks.simulate(0, 100, 101, seed=1)
+    """
+    def __init__(self, text):
+        self.agents = {}
+        self.vars = {}
+        self.init = []
+        self.obs = []
+        self.rules = []
+
+        for line in text.splitlines():
+            line = line.split("//")[0].strip()
+            if not line:
+                continue
+            if line.startswith("%agent:"):
+                name, sites = _pattern(line[7:])[0]
+                self.agents[name] = [(s, v.split()) for s, v in sites.items()]
+            elif line.startswith("%var:"):
+                name, expr = line[5:].split(None, 1)
+                self.vars[name.strip("'")] = self._eval(expr, self.vars)
+            elif line.startswith("%init:"):
+                n, pattern = line[6:].split(None, 1)
+                self.init.append((self._eval(n, self.vars), _pattern(pattern)[0]))
+            elif line.startswith("%obs:"):
+                name, pattern = line[5:].split(None, 1)
+                self.obs.append((name.strip("'"), _pattern(pattern.strip("| "))[0]))
+            elif line.startswith("%"):
+                raise ValueError("Unsupported Kappa statement: {}".format(line))
+            else:
+                self.rules.append(self._rule(line))
+
+        self.species = [(a, states) for a, sites in self.agents.items()
+                        for states in itertools.product(*(v for _, v in sites))]
+        self._compile()
+
+    def _eval(self, expr, variables):
+        try:
+            return float(eval(expr, {"__builtins__": {}}, dict(variables)))
+        except Exception:
+            raise ValueError("Unsupported Kappa expression: {}".format(expr))
+
+    def _rule(self, line):
+        """
+        Parse a rule into its name, left and right hand sides and rate
+        expression.
+        """
+        m = re.match(r"(?:'([^']*)')?\s*(.*)@(.*)", line)
+        if m is None:
+            raise ValueError("Unsupported Kappa rule: {}".format(line))
+        name, body, rate = m.groups()
+        if "->" in body:
+            lhs, rhs = (_pattern(s) for s in body.split("->"))
+        else:
+            pattern = _pattern(body)
+            lhs = [(a, dict((s, v.split("/")[0]) for s, v in sites.items())) for a, sites in pattern]
+            rhs = [(a, dict((s, v.split("/")[-1]) for s, v in sites.items())) for a, sites in pattern]
+        if len(lhs) != len(rhs):
+            raise ValueError("Unbalanced Kappa rule: {}".format(line))
+        return (name, lhs, rhs, rate.strip())
+
+    def _matches(self, agent, sites):
+        """
+        The indexes of the species that match an agent of a pattern.
+        """
+        names = [s for s, _ in self.agents[agent]]
+        return [i for i, (a, states) in enumerate(self.species)
+                if a == agent and all(states[names.index(s)] == v for s, v in sites.items())]
+
+    def _species(self, agent, sites, states=None):
+        """
+        The index of the species that results from setting the given
+        sites of an agent, starting from states, or the default states.
+        """
+        if states is None:
+            states = tuple(v[0] for _, v in self.agents[agent])
+        names = [s for s, _ in self.agents[agent]]
+        states = tuple(sites.get(s, v) for s, v in zip(names, states))
+        return self.species.index((agent, states))
+
+    def _compile(self):
+        """
+        Turn the rules into reactions between species, and the initial
+        conditions and observables into vectors over them.
+        """
+        n = len(self.species)
+        reactions = []
+        for r, (_, lhs, rhs, _) in enumerate(self.rules):
+            choices = [self._matches(a, sites) if a is not None else [None] for a, sites in lhs]
+            for match in itertools.product(*choices):
+                delta = np.zeros(n, dtype=np.int64)
+                reactants = [s for s in match if s is not None]
+                for s, (a, sites) in zip(match, rhs):
+                    if s is not None:
+                        delta[s] -= 1
+                    if a is not None:
+                        states = self.species[s][1] if s is not None else None
+                        delta[self._species(a, sites, states)] += 1
+                reactions.append((r, reactants, delta))
+
+        width = max([len(reactants) for _, reactants, _ in reactions] + [1])
+        self.reaction_rule = np.array([r for r, _, _ in reactions], dtype=np.int64)
+        self.reactants = np.full((len(reactions), width), n, dtype=np.int64)
+        for i, (_, reactants, _) in enumerate(reactions):
+            self.reactants[i, :len(reactants)] = reactants
+        self.delta = np.array([delta for _, _, delta in reactions], dtype=np.int64).reshape(-1, n)
+
+        ## the reactions whose propensities change with each reaction
+        ptr, deps = [0], []
+        for i in range(len(reactions)):
+            changed = set(np.nonzero(self.delta[i])[0])
+            deps.extend(l for l in range(len(reactions)) if changed.intersection(self.reactants[l]))
+            ptr.append(len(deps))
+        self.deps = (np.array(ptr, dtype=np.int64), np.array(deps, dtype=np.int64))
+
+        self.x0 = np.zeros(n, dtype=np.int64)
+        for count, (a, sites) in self.init:
+            self.x0[self._species(a, sites)] += int(round(count))
+
+        self.obsmatrix = np.zeros((len(self.obs), n))
+        for i, (_, (a, sites)) in enumerate(self.obs):
+            self.obsmatrix[i, self._matches(a, sites)] = 1
+
+    def rates(self, **variables):
+        """
+        The rate constant of each reaction, with the variables of the
+        model, overridden by any that are given.
+        """
+        env = dict(self.vars, **variables)
+        k = np.array([self._eval(rate, env) for _, _, _, rate in self.rules])
+        return k[self.reaction_rule]
+
+    def simulate(self, t0, tmax, steps, seed, **variables):
+        """
+        Simulate the model from its initial conditions, from time t0 to
+        tmax, reporting the observables at steps evenly spaced times.
+        The random number stream is seeded with seed. Returns the times,
+        the observables in the order of the `%obs` statements, and the
+        final species counts.
+        """
+        return self.simulate_schedule([(t0, tmax, steps, None)], [variables], seed)[:3]
+
+    def simulate_schedule(self, segments, parameters, seed):
+        """
+        Simulate the model from its initial conditions through the
+        segments, as returned by `segments`, with the variables given
+        by parameters overridden during each, in one go. Returns the
+        same as `simulate`, and the seed to continue with.
+        """
+        t = np.hstack([np.linspace(ts, te, tsteps) for ts, te, tsteps, _ in segments])
+        x = self.x0.copy()
+        counts = np.empty((len(t), len(x)), dtype=np.int64)
+        lo = 0
+        for (ts, te, tsteps, _), p in zip(segments, parameters):
+            hi = lo + tsteps
+            _, seed = reaction_ssa(ts, t[lo:hi], te, seed, x, self.rates(**p), self.reactants,
+                                   self.delta, self.deps, counts[lo:hi])
+            lo = hi
+        return t, counts @ self.obsmatrix.T, x, seed
@@ -1,5 +1,6 @@
 __all__ = ['Model', 'Unimplemented']
 
+import copy
 import yaml
 import logging
 from math import floor
@@ -51,6 +52,28 @@ class Model(object):
     >>> m.set_parameters(alpha=1, beta=2, ...)
     >>> state = m.initial_conditions(N=1000, I=10, ...)
     >>> t, obs, state = m.run(t0, tmax, tsteps, state)
+
+    Models may also provide a `run_batch` method for running many
+    samples at once, which is used by `runModelBatch`:
+
+    >>> t, trajs = m.run_batch(segments, parameters, seeds, N=1000, I=10, ..., out=None)
+
+    where `segments` is as returned by `segments`, `parameters` is
+    a list of the parameters in force during each segment, whose
+    values may be sequences with one value for each seed, and
+    `trajs` has one trajectory for each seed. As with `run`, the
+    trajectories are written into `out` if it is given.
+
+    Models may also provide a `run_schedule` method that `runModel`
+    uses to run all of the segments in one go:
+
+    >>> t, obs, state = m.run_schedule(segments, parameters, state, out=None)
+
+    and a `run_sensitivity` method, used by `runModelSensitivity`, that
+    also gives the derivatives of the observables with respect to the
+    named parameters:
+
+    >>> t, obs, sens, state = m.run_sensitivity(segments, parameters, state, ["beta", "c"])
     """
     ## name of this model
     name = "ChangeMe: set model.name"
@@ -115,7 +138,7 @@ class Model(object):
                 return i
         raise ValueError("no such column: {}".format(c))
 
-    def run(self, t0, tmax, tsteps, state):
+    def run(self, t0, tmax, tsteps, state, out=None):
         """
         Run the model from time t0 to time tmax reporting in
         tsteps number of steps, provided initial model state. This
@@ -126,6 +149,10 @@ class Model(object):
             the model trajectory at each `t`
           - `state` is an opaque state object representing
             the final state of the model
+
+        If `out` is given, it is an array of shape `(tsteps, columns)`,
+        usually a view into a larger array, and the observables are
+        written into it and it is returned as `obs`.
         """
         raise Unimplemented("[{}] run".format(self.name))
 
@@ -157,6 +184,38 @@ class Model(object):
         for all infectious individuals
         """
         return (self.colindex("IU"), self.colindex("ID"))
+    @property
+    def ecols(self):
+        """
+        Return column indexes for all exposed individuals
+        """
+        return (self.colindex("EU"), self.colindex("ED"))
+
+    def absorbed(self, obs):
+        """
+        Whether the model, with the given observables, is in an absorbing
+        state from which it cannot change whatever the parameters: the
+        epidemic is over and everyone is either susceptible or removed,
+        and not isolated or waiting to be traced.
+        """
+        free = (self.colindex("SU"), self.colindex("RU"))
+        return all(obs[i] == 0 for i in range(len(self.observables)) if i not in free)
+
+    def extinction(self, t, traj):
+        """
+        Return the time at which the epidemic died out in the given
+        trajectory, after which there is no one exposed or infectious,
+        or None if it did not, or the model has no columns to tell.
+        """
+        try:
+            cols = self.ecols + self.icols
+        except ValueError:
+            return None
+        EI = np.sum(traj[:, cols], axis=1)
+        if len(EI) == 0 or EI[-1] != 0:
+            return None
+        alive = np.nonzero(EI)[0]
+        return float(t[alive[-1] + 1] if len(alive) > 0 else t[0])
 
     def R(self, t, traj, beta=None, c=None):
         """
@@ -168,6 +227,10 @@ class Model(object):
         calculating R(t) under interventions. If they are not given,
         the corresponding model parameter is used.
 
+        Several trajectories can be given at once, as an array of shape
+        `(samples, len(t), columns)`, in which case beta, c and gamma may
+        also have a leading axis for the samples.
+
         This is done in a slightly model-specific way because we need
         to know the susceptible population and the fraction of the
         infectious population that may infect them.
@@ -177,26 +240,169 @@ class Model(object):
         if c is None:
             c = self.c
 
+        t = np.asarray(t, dtype=float)
         n = len(t)
 
         ## could alternatively require that subclasses just populate self.N
-        N  = np.sum(traj[0,i] for i in self.pcols)
+        N  = traj[..., 0, list(self.pcols)].sum(axis=-1)
         ## but these are model-specific anyways
-        SU = np.sum(traj[:,i] for i in self.sucols)
-        IU = np.sum(traj[:,i] for i in self.iucols)
-        I  = np.sum(traj[:,i] for i in self.icols)
+        SU = traj[..., list(self.sucols)].sum(axis=-1)
+        IU = traj[..., list(self.iucols)].sum(axis=-1)
+        I  = traj[..., list(self.icols)].sum(axis=-1)
 
-        X = np.zeros(len(I))
+        X = np.zeros(I.shape)
         np.true_divide(SU*IU, I, out=X, where=I != 0)
 
-        ker = np.exp(-self.gamma*t)
         bcs = beta*c*X
 
-        Rs = []
-        for i, tau in enumerate(t):
-            s = np.pad(bcs, (n-i-1, 0), mode="edge")
-            Rs.append(np.trapz(s[:n]*ker[::-1]/N, t))
-        return np.array(Rs)
+        ## R(t_i) is the trapezoidal integral over the whole grid of
+        ## exp(-gamma t) against bcs shifted right by i places, with
+        ## bcs[0] filling in before the start. Writing h_m for the
+        ## kernel times the trapezoid weight at t_{n-1-m} makes this
+        ## a causal convolution of h with bcs plus a tail of bcs[0]
+        ## times the rest of h, which holds for any grid.
+        w = np.zeros(n)
+        dt = np.diff(t)/2
+        w[:-1] += dt
+        w[1:]  += dt
+        gamma = np.asarray(self.gamma, dtype=float)
+        h = w[::-1]*np.exp(-gamma[..., None]*t)
+
+        tail = np.zeros(h.shape)
+        tail[..., :-1] = np.cumsum(h[..., ::-1], axis=-1)[..., ::-1][..., 1:]
+
+        return (convolve(h, bcs) + bcs[..., :1]*tail)/np.asarray(N)[..., None]
+
+def convolve(a, b):
+    """
+    The first n terms of the linear convolution of a and b along their
+    last axis, of length n, using the FFT. Other axes are broadcast.
+    """
+    n = a.shape[-1]
+    size = 1 << max(2*n - 1, 1).bit_length()
+    fa = np.fft.rfft(a, size, axis=-1)
+    fb = np.fft.rfft(b, size, axis=-1)
+    return np.fft.irfft(fa*fb, size, axis=-1)[..., :n]
+
+def segments(t0, tmax, steps, interventions=[]):
+    """
+    Split the simulation from `t0` to `tmax`, reporting in `steps` evenly
+    spaced time-steps, into segments separated by the interventions.
+    Returns a list of `(ts, te, tsteps, parameters)` giving the start and
+    end time of each segment, the number of time-steps to report in it,
+    and the parameters of the intervention that follows it, or `None` for
+    the last segment.
+    """
+    segs = []
+
+    ts = t0
+    for iv in interventions:
+        ti, pi = iv["time"], iv["parameters"]
+
+        ## end time for this segment
+        te = min(tmax, ti)
+
+        ## how many time-tsteps in this segment?
+        tsteps = floor((te - ts) * steps / (tmax - t0))
+
+        ## end time in integral number of tsteps
+        te = ts + (tsteps * (tmax - t0) / steps)
+
+        segs.append((ts, te, tsteps, pi))
+
+        ts = ti
+
+        ## stop running if we are past the 
+        if te >= tmax:
+            break
+
+    ## if we have more time to run, run for the required
+    ## number of tsteps
+    if ts < tmax:
+        tsteps = int((tmax - ts) * steps / (tmax - t0))
+        segs.append((ts, tmax, tsteps, None))
+
+    return segs
+
+def segment_grid(segs):
+    """
+    The reporting times of all of the segments `segs`, as returned by
+    `segments`, together, the index of the first time of each segment,
+    and the start and end time of each, as arrays for the batch kernels.
+    Returns `(t, segstart, segtime)`.
+    """
+    t = np.hstack([np.linspace(ts, te, tsteps) for ts, te, tsteps, _ in segs])
+    segstart = np.cumsum([0] + [tsteps for _, _, tsteps, _ in segs[:-1]]).astype(np.int64)
+    segtime = np.array([(ts, te) for ts, te, _, _ in segs], dtype=np.float64).reshape(-1, 2)
+    return t, segstart, segtime
+
+def schedule(m, segs):
+    """
+    Return the parameters of the model `m` that are in force during
+    each of the segments `segs`, as returned by `segments`, starting
+    from its current parameters. The interventions are applied to `m`
+    on the way, so it is left with the parameters of the last segment.
+    """
+    params = []
+    for ts, te, tsteps, pi in segs:
+        params.append(dict((k, getattr(m, k)) for k in m.parameters))
+        if pi is not None:
+            log.info("Intervention: {}".format(pi))
+            m.set_parameters(**pi)
+    return params
+
+def advance(m, segs, params, state, t, out, last=None):
+    """
+    Run the model `m` from `state` through the segments `segs`, with
+    the parameters `params` in force during each, writing the times
+    into `t` and the observables into `out`. `last` is the row of
+    observables that the state was left with, if known. Returns the
+    new state and last row, from which the simulation can be carried on.
+
+    The simulation is skipped for segments that start in an absorbing
+    state. A model with `run_schedule` is given the rest of the schedule
+    from the first segment that does not, and so has to stop by itself
+    if it is absorbed part way through, as the stochastic simulations do
+    when no more events can happen.
+    """
+    lo = 0
+    for k, ((ts, te, tsteps, pi), p) in enumerate(zip(segs, params)):
+        m.set_parameters(**p)
+        hi  = lo + tsteps
+        seg = out[lo:hi]
+        if last is not None and m.absorbed(last):
+            ## nothing more can happen, so skip the simulation
+            log.info("Absorbed, filling from {} to {} in {} tsteps".format(ts, te, tsteps))
+            t[lo:hi] = np.linspace(ts, te, tsteps)
+            seg[:] = last
+        elif getattr(m, "run_schedule", None) is not None:
+            ## the model can run the rest of the schedule by itself
+            log.info("Running from {} to {} in {} segments".format(ts, segs[-1][1], len(segs) - k))
+            t[lo:], _, state = m.run_schedule(segs[k:], params[k:], state, out=out[lo:])
+            break
+        else:
+            ## run the simulation
+            log.info("Running from {} to {} in {} tsteps".format(ts, te, tsteps))
+            t[lo:hi], obs, state = m.run(ts, te, tsteps, state, out=seg)
+            if obs is not seg:
+                seg[:] = obs
+        if tsteps > 0:
+            last = seg[-1]
+        lo = hi
+
+    if len(out) > 0:
+        last = out[-1]
+    return state, last
+
+def piecewise_R(m, t, traj, segs, params):
+    """
+    Piece-wise computation of R(t) with the beta and c in force
+    during each of the segments.
+    """
+    lengths = [tsteps for ts, te, tsteps, pi in segs]
+    betas   = np.repeat([p["beta"] for p in params], lengths)
+    cs      = np.repeat([p["c"] for p in params], lengths)
+    return m.R(t, traj, betas, cs)
 
 def runModel(model, t0, tmax, steps, parameters={}, initial={}, interventions=[], rseries=True, seed=0, **unused):
     """
@@ -250,75 +456,230 @@ def runModel(model, t0, tmax, steps, parameters={}, initial={}, interventions=[]
     log.info("Initial conditions: {}".format(initial))
     log.info("Interventions: {}".format(len(interventions)))
 
-    ## piece-wise simulation segments
-    times = []
-    trajs = []
-
-    ## also record a time-series of betas and cs for
-    ## piece-wise computation of R(t)
-    if rseries:
-        betas = []
-        cs    = []
+    ## the whole output grid is known in advance, so every segment
+    ## writes into its own rows of one array, with a column to spare
+    ## for R(t)
+    segs = segments(t0, tmax, steps, interventions)
+    nsteps = sum(tsteps for ts, te, tsteps, pi in segs)
+    ncols = len(m.observables)
+    t = np.empty(nsteps)
+    traj = np.empty((nsteps, ncols + 1 if rseries else ncols))
 
-    ts = t0
-    for iv in interventions:
-        ti, pi = iv["time"], iv["parameters"]
+    ## the parameters in force during each segment
+    params = schedule(m, segs)
+    advance(m, segs, params, state, t, traj[:, :ncols])
 
-        ## end time for this segment
-        te = min(tmax, ti)
+    if rseries:
+        traj[:, ncols] = piecewise_R(m, t, traj[:, :ncols], segs, params)
 
-        ## how many time-tsteps in this segment?
-        tsteps = floor((te - ts) * steps / (tmax - t0))
+    return t, traj
 
-        ## end time in integral number of tsteps
-        te = ts + (tsteps * (tmax - t0) / steps)
+def runModelBatch(model, t0, tmax, steps, parameters={}, initial={}, interventions=[], rseries=True, seeds=[0], **unused):
+    """
+    Run several samples of a model in one go. This is only possible
+    for models that provide a `run_batch` method, see `Model`. The
+    arguments are as for `runModel`, except that instead of a single
+    `seed` a sequence of `seeds` is given, one for each sample. Each
+    sample gets its own random number stream, so that the result for a
+    given seed is the same as what `runModel` would give.
+
+    Parameters may also be given as sequences of values, all of the
+    same length, instead of single values, to sweep over them with one
+    sample for each. A single seed is then used for all of the samples.
+    For example, for a grid of testing and contact rates,
+
+        theta, c = np.meshgrid(np.linspace(0, 0.5, 25), np.linspace(0, 20, 25))
+        t, trajs = runModelBatch(SEIRCTODEMem, 0, 100, 100,
+                                 { "theta": theta.ravel(), "c": c.ravel() },
+                                 { "N": 10000 })
+
+    Returns a tuple `(t, trajs)` where `t` is the sequence of times, and
+    `trajs` is an array of trajectories with shape `(samples, len(t), columns)`.
+    """
+    m = model()
+    m.set_parameters(**parameters)
 
-        ## run the simulation
-        log.info("Running from {} to {} in {} tsteps".format(ts, te, tsteps))
-        t, traj, state = m.run(ts, te, tsteps, state)
+    sweep = set(len(v) for v in parameters.values() if np.ndim(v) > 0)
+    if len(sweep) > 1:
+        raise ValueError("Swept parameters must all have the same length")
+    if len(sweep) > 0:
+        samples = sweep.pop()
+        if len(seeds) == 1:
+            seeds = list(seeds) * samples
+        elif len(seeds) != samples:
+            raise ValueError("Need one seed for each of {} samples".format(samples))
 
-        ## save the trajectory
-        times.append(t)
-        trajs.append(traj)
+    log.info("Running model: {}".format(m.name))
+    log.info("Random seeds: {}".format(seeds))
+    log.info("Parameters: {}".format(parameters))
+    log.info("Initial conditions: {}".format(initial))
+    log.info("Interventions: {}".format(len(interventions)))
 
-        ## save the beta and c being used
-        if rseries:
-            betas.append(m.beta * np.ones(len(t)))
-            cs.append(m.c * np.ones(len(t)))
+    segs = segments(t0, tmax, steps, interventions)
+    params = schedule(m, segs)
 
-        ## update the parameters
-        log.info("Intervention: {}".format(pi))
-        m.set_parameters(**pi)
+    log.info("Running batch of {} samples in {} segments".format(len(seeds), len(segs)))
+    nsteps = [tsteps for ts, te, tsteps, pi in segs]
+    ncols  = len(m.observables)
+    trajs  = np.empty((len(seeds), sum(nsteps), ncols + 1 if rseries else ncols))
+    t, _ = m.run_batch(segs, params, seeds, out=trajs[:, :, :ncols], **initial)
 
-        ts = ti
+    if rseries:
+        K = len(seeds)
+        betas = np.repeat([np.broadcast_to(p["beta"], K) for p in params], nsteps, axis=0).T
+        cs    = np.repeat([np.broadcast_to(p["c"], K) for p in params], nsteps, axis=0).T
+        trajs[:, :, ncols] = m.R(t, trajs[:, :, :ncols], betas, cs)
 
-        ## stop running if we are past the 
-        if te >= tmax:
-            break
+    return t, trajs
 
-    ## if we have more time to run, run for the required
-    ## number of tsteps
-    if ts < tmax:
-        tsteps = int((tmax - ts) * steps / (tmax - t0))
-        log.info("Running from {} to {} in {} tsteps".format(ts, tmax, tsteps))
-        t, traj, state = m.run(ts, tmax, tsteps, state)
+def runModelSensitivity(model, t0, tmax, steps, parameters={}, initial={}, interventions=[],
+                        rseries=True, wrt=("beta", "c", "theta", "eta", "chi"), **unused):
+    """
+    Run the model as `runModel` does, and also compute the sensitivity
+    of the trajectory to the parameters named in `wrt`, that is, its
+    derivatives with respect to them. This is only possible for models
+    that provide a `run_sensitivity` method, see `Model`, which are the
+    ODE models, and it costs much less than finite differences. A
+    parameter is changed in all of the segments of the simulation
+    alike, including those where an intervention has set it.
+
+    For example, the derivative of the final number removed with
+    respect to the testing rate is,
+
+        t, traj, sens = runModelSensitivity(SEIRCTODEMem, 0, 300, 300,
+                                            params, initial, wrt=["theta"])
+        dR = sens[-1, SEIRCTODEMem.colindex("RU"), 0] + sens[-1, SEIRCTODEMem.colindex("RD"), 0]
+
+    Returns a tuple `(t, traj, sens)` where `t` and `traj` are as from
+    `runModel`, and `sens` has the shape `(len(t), columns, len(wrt))`,
+    with one column for each observable, so that `sens[i, j, k]` is the
+    derivative of `traj[i, j]` with respect to `wrt[k]`.
+    """
+    m = model()
+    m.set_parameters(**parameters)
+    state = m.initial_conditions(**initial)
 
-        ## save the trajectory
-        times.append(t)
-        trajs.append(traj)
+    log.info("Running model: {}".format(m.name))
+    log.info("Parameters: {}".format(parameters))
+    log.info("Initial conditions: {}".format(initial))
+    log.info("Interventions: {}".format(len(interventions)))
+    log.info("Sensitivity to: {}".format(", ".join(wrt)))
 
-        ## save the beta and c being used
-        if rseries:
-            betas.append(m.beta * np.ones(len(t)))
-            cs.append(m.c * np.ones(len(t)))
+    segs = segments(t0, tmax, steps, interventions)
+    nsteps = sum(tsteps for ts, te, tsteps, pi in segs)
+    ncols = len(m.observables)
+    traj = np.empty((nsteps, ncols + 1 if rseries else ncols))
+    sens = np.empty((nsteps, ncols, len(wrt)))
 
-    t    = np.hstack(times)
-    traj = np.vstack(trajs)
+    params = schedule(m, segs)
+    log.info("Running from {} to {} in {} segments".format(t0, tmax, len(segs)))
+    t, _, _, state = m.run_sensitivity(segs, params, state, list(wrt), out=traj[:, :ncols], sens=sens)
 
     if rseries:
-        betas = np.hstack(betas)
-        cs    = np.hstack(cs)
-        rs    = m.R(t, traj, betas, cs)
-        traj  = np.vstack((traj.T, rs)).T
+        traj[:, ncols] = piecewise_R(m, t, traj[:, :ncols], segs, params)
 
-    return t, traj
+    return t, traj, sens
+
+def runScenarios(scenarios):
+    """
+    Run several scenarios, each given as a dictionary of arguments for
+    `runModel`, doing the work that they have in common only once.
+    Scenarios often differ only in their later interventions. Those with
+    the same model, seed, initial conditions and parameters are run
+    together for as long as they have the same segments, see `segments`,
+    with the same parameters in force. Where they diverge, the model
+    state is copied and each branch carries on from its own copy, so
+    for stochastic models every branch continues the same sample.
+
+    For example, two scenarios that relax a lockdown at different times
+    are simulated together up to the earlier of the two,
+
+        base = { "model": SEIRCTODEMem, "tmax": 300, "steps": 300,
+                 "initial": { "N": 10000 } }
+        early, late = runScenarios([
+            dict(base, interventions=[{ "time": 100, "parameters": { "c": 4 }},
+                                      { "time": 150, "parameters": { "c": 13 }}]),
+            dict(base, interventions=[{ "time": 100, "parameters": { "c": 4 }},
+                                      { "time": 200, "parameters": { "c": 13 }}]),
+        ])
+
+    Returns a list with a tuple `(t, traj)` for each scenario, the same
+    as `runModel` gives, except that deterministic models restart their
+    step size control at a branch and so agree with it to within the
+    solver tolerance.
+    """
+    runs = []
+    for sc in scenarios:
+        m = sc["model"]()
+        m.set_parameters(**sc.get("parameters", {}))
+        segs = segments(sc.get("t0", 0), sc["tmax"], sc["steps"], sc.get("interventions", []))
+        params = schedule(m, segs)
+        nsteps = sum(tsteps for ts, te, tsteps, pi in segs)
+        ncols = len(m.observables)
+        runs.append({
+            "model": m, "segs": segs, "params": params,
+            "root": (sc["model"], sc.get("seed", 0), sc.get("initial", {}), params[0]),
+            "keys": [(ts, te, tsteps, p) for (ts, te, tsteps, pi), p in zip(segs, params)],
+            "t": np.empty(nsteps), "ncols": ncols, "rseries": sc.get("rseries", True),
+            "traj": np.empty((nsteps, ncols + 1 if sc.get("rseries", True) else ncols)),
+        })
+
+    def partition(group, key):
+        ## split the group by equal keys, keeping the order
+        parts = []
+        for i in group:
+            for part in parts:
+                if key(part[0]) == key(i):
+                    part.append(i)
+                    break
+            else:
+                parts.append([i])
+        return parts
+
+    def branch(group, k, state, last):
+        ## all of the scenarios in the group have run their first k
+        ## segments, which left the model in state. Run the segments
+        ## that they still have in common, for the first of them
+        r = runs[group[0]]
+        j = k
+        while all(j < len(runs[i]["keys"]) and runs[i]["keys"][j] == r["keys"][j] for i in group):
+            j += 1
+
+        lo = sum(tsteps for ts, te, tsteps, pi in r["segs"][:k])
+        hi = lo + sum(tsteps for ts, te, tsteps, pi in r["segs"][k:j])
+        if j > k:
+            if len(group) > 1:
+                log.info("Running {} segments shared by {} scenarios".format(j - k, len(group)))
+            state, last = advance(r["model"], r["segs"][k:j], r["params"][k:j], state,
+                                  r["t"][lo:hi], r["traj"][lo:hi, :r["ncols"]], last)
+            ## and give the others a copy
+            for i in group[1:]:
+                runs[i]["t"][lo:hi] = r["t"][lo:hi]
+                runs[i]["traj"][lo:hi, :r["ncols"]] = r["traj"][lo:hi, :r["ncols"]]
+
+        ## the scenarios that go on from here part ways
+        rest = [i for i in group if len(runs[i]["keys"]) > j]
+        parts = partition(rest, lambda i: runs[i]["keys"][j])
+        if len(parts) > 1:
+            log.info("Branching {} ways at t = {}".format(len(parts), r["segs"][j - 1][1] if j > 0 else r["segs"][0][0]))
+        for n, part in enumerate(parts):
+            branch(part, j, state if n == len(parts) - 1 else copy.deepcopy(state), last)
+
+    for group in partition(range(len(runs)), lambda i: runs[i]["root"]):
+        sc = scenarios[group[0]]
+        np.random.seed(sc.get("seed", 0))
+        state = runs[group[0]]["model"].initial_conditions(**sc.get("initial", {}))
+
+        log.info("Running model: {}".format(runs[group[0]]["model"].name))
+        log.info("Random seed: {}".format(sc.get("seed", 0)))
+        log.info("Scenarios: {}".format(len(group)))
+        branch(group, 0, state, None)
+
+    results = []
+    for r in runs:
+        if r["rseries"]:
+            ncols = r["ncols"]
+            r["model"].set_parameters(**r["params"][-1])
+            r["traj"][:, ncols] = piecewise_R(r["model"], r["t"], r["traj"][:, :ncols], r["segs"], r["params"])
+        results.append((r["t"], r["traj"]))
+    return results
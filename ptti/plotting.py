@@ -68,7 +68,7 @@ def plot(model, output, plots, interventions, title, envelope=True, start=None,
         for i, ts in enumerate(plot["timeseries"]):
             colour = colours[i % len(colours)]
             cols = [model.colindex(c) for c in ts["columns"]]
-            series = [np.sum(traj[:,c] for c in cols) for traj in trajectories]
+            series = [traj[:,cols].sum(axis=1) for traj in trajectories]
             meanseries = np.average(series, axis=0)
             if len(series) > 1 and envelope:
                 stdseries = np.std(series, axis=0)
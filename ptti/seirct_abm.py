@@ -1,12 +1,11 @@
-__all__ = ['SEIRCTABM']
+__all__ = ['ABMState', 'SEIRCTABM', 'SEIRCTABMTau']
 
 import numpy as np
-from numba import jit
+from numba import jit, prange
 from math import sqrt
-from scipy.interpolate import interp1d
 import yaml
 import logging as log
-from ptti.model import Model
+from ptti.model import Model, segment_grid
 
 yaml_obs = """
 - name:  SU
@@ -47,207 +46,975 @@ INDEX_RD = 7
 
 INDEX_CT = 8
 
+# Agent bitfield. Each agent is a single uint8 holding the diagnosed flag
+# in bit 0, the infection state in bits 1-2 and the traceable flag in
+# bit 3, so that the low three bits, 2*state + diagnosed, are the INDEX_*
+# column of the agent's compartment.
+AGENT_DIAG  = 1
+AGENT_STATE = 6
+AGENT_COMP  = 7
+AGENT_TRACE = 8
+
+@jit(nopython=True, cache=True)
+def agent_state(agents, i):
+    return (agents[i] & AGENT_STATE) >> 1
+
+
+@jit(nopython=True, cache=True)
+def agent_diagnosed(agents, i):
+    return (agents[i] & AGENT_DIAG) != 0
+
+
+@jit(nopython=True, cache=True)
+def agent_traceable(agents, i):
+    return (agents[i] & AGENT_TRACE) != 0
+
+
+@jit(nopython=True, cache=True)
+def agent_comp(agents, i):
+    return agents[i] & AGENT_COMP
+
+
+@jit(nopython=True, cache=True)
+def agent_set_state(agents, i, state):
+    agents[i] = (agents[i] & ~AGENT_STATE) | (state << 1)
+
+
+@jit(nopython=True, cache=True)
+def agent_set_diagnosed(agents, i, diagnosed):
+    if diagnosed:
+        agents[i] |= AGENT_DIAG
+    else:
+        agents[i] &= ~AGENT_DIAG
+
+
+@jit(nopython=True, cache=True)
+def agent_set_traceable(agents, i, traceable):
+    if traceable:
+        agents[i] |= AGENT_TRACE
+    else:
+        agents[i] &= ~AGENT_TRACE
+
+
+@jit(nopython=True, cache=True)
+def count_states(agents):
+    counts = np.zeros(9, dtype=np.int64)
+    for i in range(agents.shape[0]):
+        counts[agent_comp(agents, i)] += 1
+        counts[INDEX_CT] += agent_traceable(agents, i)
+    return (counts[0], counts[1], counts[2], counts[3], counts[4],
+            counts[5], counts[6], counts[7], counts[8])
+
+
+# Contact store layout. Contacts are kept in per-infector linked lists
+# threaded through growable edge arrays, so memory scales with the number
+# of contacts that are live rather than with N^2. The store is a tuple
+# (head, link, peer, meta) where head[i] is the first edge of infector i,
+# link[e] the next edge in the same list and peer[e] the contactee.
+CONTACT_FREE = 0      # head of the list of freed edges
+CONTACT_USED = 1      # number of edge slots ever handed out
+CONTACT_ACTIVE = 2    # number of infectors with at least one contact
+
+CONTACT_BLOCK = 1024
+
+@jit(nopython=True, cache=True)
+def contacts_new(N):
+    head = -np.ones(N, dtype=np.int64)
+    link = np.zeros(CONTACT_BLOCK, dtype=np.int64)
+    peer = np.zeros(CONTACT_BLOCK, dtype=np.int64)
+    meta = np.zeros(3, dtype=np.int64)
+    meta[CONTACT_FREE] = -1
+    return (head, link, peer, meta)
+
+
+@jit(nopython=True, cache=True)
+def contact_add(contacts, infector, contactee):
+    """
+    Record a contact between an infector and a contactee. Returns the
+    contact store, which is reallocated if it needed to grow.
+    """
+    head, link, peer, meta = contacts
+    e = meta[CONTACT_FREE]
+    if e >= 0:
+        meta[CONTACT_FREE] = link[e]
+    else:
+        e = meta[CONTACT_USED]
+        if e == len(link):
+            grown = np.zeros(2*len(link), dtype=np.int64)
+            grown[:e] = link
+            link = grown
+            grown = np.zeros(2*len(peer), dtype=np.int64)
+            grown[:e] = peer
+            peer = grown
+        meta[CONTACT_USED] = e + 1
+    if head[infector] < 0:
+        meta[CONTACT_ACTIVE] += 1
+    peer[e] = contactee
+    link[e] = head[infector]
+    head[infector] = e
+    return (head, link, peer, meta)
+
+
+@jit(nopython=True, cache=True)
+def contact_clear(contacts, infector):
+    """
+    Forget all contacts made by an infector, returning their edges to
+    the free list.
+    """
+    head, link, peer, meta = contacts
+    e = head[infector]
+    if e < 0:
+        return
+    while link[e] >= 0:
+        e = link[e]
+    link[e] = meta[CONTACT_FREE]
+    meta[CONTACT_FREE] = head[infector]
+    meta[CONTACT_ACTIVE] -= 1
+    head[infector] = -1
+
+
 @jit(nopython=True, cache=True)
-def count_states(states, diagnosed, traceable):
-    SU = np.sum((states == STATE_S)*(diagnosed == 0))
-    SD = np.sum((states == STATE_S)*diagnosed)
-    EU = np.sum((states == STATE_E)*(diagnosed == 0))
-    ED = np.sum((states == STATE_E)*diagnosed)
-    IU = np.sum((states == STATE_I)*(diagnosed == 0))
-    ID = np.sum((states == STATE_I)*diagnosed)
-    RU = np.sum((states == STATE_R)*(diagnosed == 0))
-    RD = np.sum((states == STATE_R)*diagnosed)
-    CT = np.sum(traceable)
-    return SU, SD, EU, ED, IU, ID, RU, RD, CT
+def contact_list(contacts, infector):
+    """
+    Return the distinct contactees of an infector.
+    """
+    head, link, peer, meta = contacts
+    n = 0
+    e = head[infector]
+    while e >= 0:
+        n += 1
+        e = link[e]
+    ctis = np.empty(n, dtype=np.int64)
+    n = 0
+    e = head[infector]
+    while e >= 0:
+        ctis[n] = peer[e]
+        n += 1
+        e = link[e]
+    return np.unique(ctis)
 
 
 @jit(nopython=True, cache=True)
-def count_pcis(states, diagnosed, contactM):
-    SUi = np.where((states == STATE_S)*(1-diagnosed))[0]
-    SDi = np.where((states == STATE_S)*diagnosed)[0]
-    EUi = np.where((states == STATE_E)*(1-diagnosed))[0]
-    EDi = np.where((states == STATE_E)*diagnosed)[0]
-    IUi = np.where((states == STATE_I)*(1-diagnosed))[0]
-    IDi = np.where((states == STATE_I)*diagnosed)[0]
-    RUi = np.where((states == STATE_R)*(1-diagnosed))[0]
-    RDi = np.where((states == STATE_R)*diagnosed)[0]
+def count_pcis(agents, contacts):
+    N = agents.shape[0]
+    ninfectors = np.zeros(N, dtype=np.int64)
+    for ii in range(N):
+        for cti in contact_list(contacts, ii):
+            ninfectors[cti] += 1
+
+    # total infectors and agents in each compartment
+    ncomp = np.zeros(8, dtype=np.int64)
+    ninf = np.zeros(8, dtype=np.int64)
+    for i in range(N):
+        k = agent_comp(agents, i)
+        ncomp[k] += 1
+        ninf[k] += ninfectors[i]
+    pci = ninf/(ncomp*N)
+
+    return pci[0], pci[1], pci[2], pci[3], pci[4], pci[5], pci[6], pci[7]
+
+
+# Compartment pools. The agents are kept in a single permutation, order,
+# partitioned by compartment so that the members of compartment k are
+# order[bounds[k]:bounds[k+1]]. The compartment of an agent is
+# 2*state + diagnosed, its low three bits. pos is the inverse of order.
+# Agents move between compartments by swapping across the boundaries in
+# between, which is constant time.
+@jit(nopython=True, cache=True)
+def pools_new(agents):
+    N = agents.shape[0]
+    comps = (agents & AGENT_COMP).astype(np.int64)
+    order = np.argsort(comps, kind="mergesort")
+    pos = np.empty(N, dtype=np.int64)
+    pos[order] = np.arange(N)
+    bounds = np.zeros(9, dtype=np.int64)
+    for k in range(8):
+        bounds[k+1] = bounds[k] + np.sum(comps == k)
+    return (order, pos, bounds)
 
-    N = states.shape[0]
-    SUpci = np.sum(contactM[SUi])/(len(SUi)*N)
-    SDpci = np.sum(contactM[SDi])/(len(SDi)*N)
-    EUpci = np.sum(contactM[EUi])/(len(EUi)*N)
-    EDpci = np.sum(contactM[EDi])/(len(EDi)*N)
-    IUpci = np.sum(contactM[IUi])/(len(IUi)*N)
-    IDpci = np.sum(contactM[IDi])/(len(IDi)*N)
-    RUpci = np.sum(contactM[RUi])/(len(RUi)*N)
-    RDpci = np.sum(contactM[RDi])/(len(RDi)*N)
 
-    return SUpci, SDpci, EUpci, EDpci, IUpci, IDpci, RUpci, RDpci
+@jit(nopython=True, cache=True)
+def pool_move(pools, i, src, dst):
+    """
+    Move agent i from compartment src to compartment dst.
+    """
+    order, pos, bounds = pools
+    while src < dst:
+        # swap into the last slot of src, which then becomes part of src+1
+        slot = bounds[src+1] - 1
+        j = order[slot]
+        order[pos[i]] = j
+        pos[j] = pos[i]
+        order[slot] = i
+        pos[i] = slot
+        bounds[src+1] -= 1
+        src += 1
+    while src > dst:
+        # swap into the first slot of src, which then becomes part of src-1
+        slot = bounds[src]
+        j = order[slot]
+        order[pos[i]] = j
+        pos[j] = pos[i]
+        order[slot] = i
+        pos[i] = slot
+        bounds[src] += 1
+        src -= 1
 
 
 @jit(nopython=True, cache=True)
-def random_agent_i(states, diagnosed, tstate, tdiag=None):
+def random_agent_i(pools, tstate, tdiag=None):
+    order, pos, bounds = pools
     if tdiag is None:
-        return np.random.choice(np.where(states == tstate)[0])
+        lo, hi = bounds[2*tstate], bounds[2*tstate+2]
     else:
-        return np.random.choice(np.where((states == tstate) *
-                                         (diagnosed == tdiag))[0])
+        lo, hi = bounds[2*tstate+tdiag], bounds[2*tstate+tdiag+1]
+    return order[lo + np.random.randint(0, hi - lo)]
 
 
 @jit(nopython=True, cache=True)
-def seirxud_abm_gill(tmax=10,
-                     N=1000,
-                     I0=10,
-                     c=5,
-                     beta=0.05,
-                     alpha=0.2,
-                     gamma=0.1,
-                     theta=0.0,
-                     kappa=0.05,
-                     eta=0,
-                     chi=0,
-                     return_pcis=False):
+def pool_counts(pools, ntrace):
+    """
+    Constant-time equivalent of count_states, read from the pool
+    boundaries and the size of the traceable pool.
+    """
+    order, pos, bounds = pools
+    return (bounds[1] - bounds[0], bounds[2] - bounds[1],
+            bounds[3] - bounds[2], bounds[4] - bounds[3],
+            bounds[5] - bounds[4], bounds[6] - bounds[5],
+            bounds[7] - bounds[6], bounds[8] - bounds[7],
+            ntrace)
 
 
-    # Generate states
-    states = np.zeros(N, dtype=np.int8)
-    # Generate diagnosed state
-    diagnosed = np.zeros(N, dtype=np.bool8)
-    # Generate traceable status
-    traceable = np.zeros(N, dtype=np.bool8)
-    # Contact matrix
-    contactM = np.zeros((N, N), dtype=np.bool8)
+@jit(nopython=True, cache=True)
+def pool_record(pools, ntrace, row):
+    """
+    Write the current counters into a row of the output trajectory.
+    """
+    order, pos, bounds = pools
+    for k in range(8):
+        row[k] = bounds[k+1] - bounds[k]
+    row[INDEX_CT] = ntrace
+
+
+# The traceable agents are kept in a swap-remove pool, tpool[:ntrace],
+# with tpos giving the position of each agent in it, or -1.
+@jit(nopython=True, cache=True)
+def trace_add(tpool, tpos, ntrace, i):
+    if tpos[i] < 0:
+        tpool[ntrace] = i
+        tpos[i] = ntrace
+        ntrace += 1
+    return ntrace
+
+
+@jit(nopython=True, cache=True)
+def trace_remove(tpool, tpos, ntrace, i):
+    if tpos[i] >= 0:
+        ntrace -= 1
+        j = tpool[ntrace]
+        tpool[tpos[i]] = j
+        tpos[j] = tpos[i]
+        tpos[i] = -1
+    return ntrace
+
+
+# Contact weights. With heterogeneous contact rates agent i makes contacts
+# at rate c*w[i] while IU, where the w are gamma distributed with mean one
+# and shape dispersion, so that a small dispersion gives a few agents with
+# many contacts. The weights are held in fixed point, as integer multiples
+# of 1/WEIGHT_SCALE, in a tuple (w, tree), where tree is a Fenwick tree of
+# the weights of the IU agents, with the total in tree[0], so that adding
+# and removing agents, and picking one with probability proportional to
+# its weight, all take O(log N) time and the total does not drift. With
+# homogeneous contacts both arrays are empty.
+WEIGHT_SCALE = 2**20
+
+@jit(nopython=True, cache=True)
+def weight_add(tree, i, dw):
+    tree[0] += dw
+    k = i + 1
+    while k < len(tree):
+        tree[k] += dw
+        k += k & -k
+
+
+@jit(nopython=True, cache=True)
+def weight_pick(tree):
+    """
+    Choose an IU agent with probability proportional to its weight.
+    """
+    u = np.random.randint(0, tree[0])
+    k = 0
+    step = 1
+    while 2*step < len(tree):
+        step *= 2
+    while step > 0:
+        if k + step < len(tree) and tree[k + step] <= u:
+            k += step
+            u -= tree[k]
+        step //= 2
+    return k
+
+
+@jit(nopython=True, cache=True)
+def weight_update(weights, agents, i, k):
+    """
+    Add or remove agent i from the tree of IU weights after it changed
+    from compartment k.
+    """
+    w, tree = weights
+    if k == INDEX_IU and agent_comp(agents, i) != INDEX_IU:
+        weight_add(tree, i, -w[i])
+    elif k != INDEX_IU and agent_comp(agents, i) == INDEX_IU:
+        weight_add(tree, i, w[i])
+
+
+@jit(nopython=True, cache=True)
+def weights_new(agents, dispersion):
+    N = agents.shape[0]
+    if dispersion <= 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64))
+    w = np.empty(N, dtype=np.int64)
+    tree = np.zeros(N + 1, dtype=np.int64)
+    for i in range(N):
+        w[i] = int(np.random.gamma(dispersion, 1/dispersion)*WEIGHT_SCALE)
+        if agent_comp(agents, i) == INDEX_IU:
+            weight_add(tree, i, w[i])
+    return (w, tree)
+
+
+# Event channels of the stochastic simulation, in the order of their
+# propensities as returned by abm_propensities
+EVENT_CONTACT   = 0   # a random individual is contacted by an IU
+EVENT_ONSET     = 1   # E becomes I
+EVENT_RECOVERY  = 2   # I becomes R
+EVENT_DIAGNOSIS = 3   # IU is diagnosed
+EVENT_RELEASE_S = 4   # diagnosed S is released
+EVENT_RELEASE_R = 5   # diagnosed R is released
+EVENT_TRACING   = 6   # someone who's traceable gets quarantined
+
+@jit(nopython=True, cache=True)
+def abm_new(N, I0, seed, dispersion=0.0):
+    """
+    Create a population of N susceptible agents of whom I0, chosen at
+    random, are infectious, with contact weights of the given dispersion,
+    or homogeneous contacts if it is zero. Returns the agent bitfields,
+    the contact store, the compartment and traceable pools, the contact
+    weights and the seed to continue the random number stream with.
+    """
+    np.random.seed(seed)
+
+    # Generate agents: susceptible, undiagnosed and not traceable
+    agents = np.zeros(N, dtype=np.uint8)
+    # Contacts made by each infector
+    contacts = contacts_new(N)
 
     # Infect I0 patients
     istart = np.random.choice(np.arange(N), size=I0, replace=False)
     for i in istart:
-        states[i] = STATE_I
+        agent_set_state(agents, i, STATE_I)
 
-    times = []
-    traj = []
-    pcis = []
+    pools = pools_new(agents)
+    tpool = np.zeros(N, dtype=np.int64)
+    tpos = -np.ones(N, dtype=np.int64)
+    ntrace = 0
+    weights = weights_new(agents, dispersion)
 
-    t = 0
-    while t < tmax:
+    return (agents, contacts, pools, tpool, tpos, ntrace, weights,
+            np.random.randint(0, 2**31 - 1))
+
+
+@jit(nopython=True, cache=True)
+def abm_propensities(counts, c, alpha, gamma, theta, kappa, chi):
+    E = counts[INDEX_EU] + counts[INDEX_ED]
+    I = counts[INDEX_IU] + counts[INDEX_ID]
+
+    w = np.zeros(7)
+    # Possible contacts
+    w[EVENT_CONTACT] = c*counts[INDEX_IU]
+    # E becomes I
+    w[EVENT_ONSET] = alpha*E
+    # I becomes R
+    w[EVENT_RECOVERY] = gamma*I
+    # I is diagnosed
+    w[EVENT_DIAGNOSIS] = theta*counts[INDEX_IU]
+    # Diagnosed S is released
+    w[EVENT_RELEASE_S] = kappa*counts[INDEX_SD]
+    # Diagnosed R is released
+    w[EVENT_RELEASE_R] = kappa*counts[INDEX_RD]
+    # Someone who's traceable gets quarantined
+    w[EVENT_TRACING] = chi*counts[INDEX_CT]
+    return w
 
-        counts = count_states(states, diagnosed, traceable)
-        traj.append(counts)
-        times.append(t)
-        if return_pcis:
-            pcis.append(np.sum(np.sum(contactM, axis=0) > 0)/N)
-        else:
-            pcis.append(0)
 
-        E = counts[INDEX_EU] + counts[INDEX_ED]
-        I = counts[INDEX_IU] + counts[INDEX_ID]
+@jit(nopython=True, cache=True)
+def abm_possible(event, pools, ntrace):
+    """
+    Whether there is an agent that the given event can happen to.
+    """
+    order, pos, bounds = pools
+    if event == EVENT_CONTACT or event == EVENT_DIAGNOSIS:
+        return bounds[INDEX_IU+1] > bounds[INDEX_IU]
+    elif event == EVENT_ONSET:
+        return bounds[INDEX_IU] > bounds[INDEX_EU]
+    elif event == EVENT_RECOVERY:
+        return bounds[INDEX_RU] > bounds[INDEX_IU]
+    elif event == EVENT_RELEASE_S:
+        return bounds[INDEX_SD+1] > bounds[INDEX_SD]
+    elif event == EVENT_RELEASE_R:
+        return bounds[INDEX_RD+1] > bounds[INDEX_RD]
+    else:
+        return ntrace > 0
+
+
+@jit(nopython=True, cache=True)
+def abm_pick(event, pools, tpool, ntrace):
+    """
+    Choose the agent that the given event happens to. For contacts this
+    is the infector.
+    """
+    if event == EVENT_CONTACT or event == EVENT_DIAGNOSIS:
+        return random_agent_i(pools, STATE_I, False)
+    elif event == EVENT_ONSET:
+        return random_agent_i(pools, STATE_E)
+    elif event == EVENT_RECOVERY:
+        return random_agent_i(pools, STATE_I)
+    elif event == EVENT_RELEASE_S:
+        return random_agent_i(pools, STATE_S, True)
+    elif event == EVENT_RELEASE_R:
+        return random_agent_i(pools, STATE_R, True)
+    else:
+        # Random traceable?
+        return tpool[np.random.randint(0, ntrace)]
 
-        # Possible contacts
-        wIc = c*counts[INDEX_IU]
+
+@jit(nopython=True, cache=True)
+def abm_event(event, i, agents, contacts, pools,
+              tpool, tpos, ntrace, beta, eta):
+    """
+    Apply one event of the given kind to agent i, as chosen by abm_pick.
+    Returns the new size of the traceable pool and the contact store.
+    """
+    if event == EVENT_CONTACT:
+        # Contact between a random individual and the IU
+        rndi = np.random.randint(0, agents.shape[0])
+        contacts = contact_add(contacts, i, rndi)
+        is_SU = agent_comp(agents, rndi) == INDEX_SU
+        if is_SU and np.random.random() <= beta:
+            agent_set_state(agents, rndi, STATE_E)
+            pool_move(pools, rndi, INDEX_SU, INDEX_EU)
+    elif event == EVENT_ONSET:
         # E becomes I
-        wEI = alpha*E
+        k = agent_comp(agents, i)
+        agent_set_state(agents, i, STATE_I)
+        pool_move(pools, i, k, agent_comp(agents, i))
+    elif event == EVENT_RECOVERY:
         # I becomes R
-        wIR = gamma*I
-        # I is diagnosed
-        wIUID = theta*counts[INDEX_IU]
-        # Diagnosed S is released
-        wSDSU = kappa*counts[INDEX_SD]
-        # Diagnosed R is released
-        wRDRU = kappa*counts[INDEX_RD]
-        # Someone who's traceable gets quarantined
-        wCT = chi*counts[INDEX_CT]
-
-        Wtot = wIc + wEI + wIR + wIUID + wSDSU + wRDRU + wCT
+        contact_clear(contacts, i)
+        k = agent_comp(agents, i)
+        agent_set_state(agents, i, STATE_R)
+        pool_move(pools, i, k, agent_comp(agents, i))
+    elif event == EVENT_DIAGNOSIS:
+        # Diagnosis
+        agent_set_diagnosed(agents, i, True)
+        pool_move(pools, i, INDEX_IU, INDEX_ID)
+        agent_set_traceable(agents, i, False)
+        ntrace = trace_remove(tpool, tpos, ntrace, i)
+        # Also set all those who have it as an infector as traceable
+        for cti in contact_list(contacts, i):
+            if not agent_diagnosed(agents, cti) and np.random.random() < eta:
+                agent_set_traceable(agents, cti, True)
+                ntrace = trace_add(tpool, tpos, ntrace, cti)
+    elif event == EVENT_RELEASE_S or event == EVENT_RELEASE_R:
+        k = agent_comp(agents, i)
+        agent_set_diagnosed(agents, i, False)
+        pool_move(pools, i, k, k - 1)
+    else:
+        # Contact tracing
+        k = agent_comp(agents, i)
+        agent_set_diagnosed(agents, i, True)
+        agent_set_traceable(agents, i, False)
+        ntrace = trace_remove(tpool, tpos, ntrace, i)
+        pool_move(pools, i, k, k + 1)
+    return ntrace, contacts
+
+
+@jit(nopython=True, cache=True)
+def seirxud_abm_gill(t, tgrid, tmax, seed,
+                     agents, contacts, pools, tpool, tpos, ntrace, weights, traj,
+                     c=5,
+                     beta=0.05,
+                     alpha=0.2,
+                     gamma=0.1,
+                     theta=0.0,
+                     kappa=0.05,
+                     eta=0,
+                     chi=0,
+                     return_pcis=False,
+                     check=0):
+    """
+    Gillespie simulation of the agent-based SEIR-CT model, continuing
+    the population given by the agent bitfields, contact store, pools
+    and contact weights (as made by abm_new) from time t to tmax. The
+    agents are updated in place and the random number generator is
+    seeded with seed.
+
+    The state is sampled onto the output times tgrid as the simulation
+    passes them, into traj, which has shape (len(tgrid), 9) and may be a
+    view into a larger array, along with the corresponding fraction of
+    agents that have made contacts. Returns the end time, the
+    seed to continue the random number stream with, the number of
+    traceable agents, the contact store, which may have been reallocated,
+    the trajectory and the fractions.
+
+    If check is positive, the incrementally maintained counters are
+    verified against a full recount of the agents every check events.
+    """
+    np.random.seed(seed)
+    N = agents.shape[0]
+    hetero = len(weights[0]) > 0
+
+    tsteps = len(tgrid)
+    pcis = np.zeros(tsteps)
+
+    j = 0
+    events = 0
+    while t < tmax:
+
+        counts = pool_counts(pools, ntrace)
+        if check > 0 and events % check == 0:
+            if counts != count_states(agents):
+                raise AssertionError("ABM compartment counters are inconsistent")
+
+        wp = abm_propensities(counts, c, alpha, gamma, theta, kappa, chi)
+        if hetero:
+            wp[EVENT_CONTACT] = c*weights[1][0]/WEIGHT_SCALE
+        Wtot = np.sum(wp)
         if Wtot <= 0:
             break
-
-        wp = np.array([wIc, wEI, wIR, wIUID, wSDSU, wRDRU, wCT])
         wp = np.cumsum(wp)/Wtot
 
         dt = -np.log(np.random.random())/Wtot
 
-        rn = np.random.random()
-
-        if rn < wp[0]:
-            # Contact between a random individual and a random IU
-            rndi = np.random.randint(0, N)
-            ii = random_agent_i(states, diagnosed, STATE_I, False)
-            contactM[rndi, ii] = True
-            is_SU = (states[rndi] == STATE_S)*(not diagnosed[rndi])
-            if is_SU and np.random.random() <= beta:
-                states[rndi] = STATE_E
-        elif rn < wp[1]:
-            # E becomes I
-            ei = random_agent_i(states, diagnosed, STATE_E)
-            states[ei] = STATE_I
-        elif rn < wp[2]:
-            # I becomes R
-            ii = random_agent_i(states, diagnosed, STATE_I)
-            contactM[:, ii] = False
-            states[ii] = STATE_R
-        elif rn < wp[3]:
-            # Diagnosis
-            ii = random_agent_i(states, diagnosed, STATE_I, False)
-            diagnosed[ii] = True
-            traceable[ii] = False
-            # Also set all those who have it as an infector as traceable
-            ctis = np.where((contactM[:, ii]*(diagnosed == 0)))[0]
-            traceable[ctis] = np.logical_or(traceable[ctis],
-                                            np.random.random(len(ctis)) < eta)
-        elif rn < wp[4]:
-            si = random_agent_i(states, diagnosed, STATE_S, True)
-            diagnosed[si] = False
-        elif rn < wp[5]:
-            ri = random_agent_i(states, diagnosed, STATE_R, True)
-            diagnosed[ri] = False
+        # the current state holds until the event at t + dt
+        while j < tsteps and tgrid[j] < t + dt:
+            pool_record(pools, ntrace, traj[j])
+            if return_pcis:
+                pcis[j] = contacts[3][CONTACT_ACTIVE]/N
+            j += 1
+
+        # the next event is after the end, and since events are memoryless
+        # it can be dropped so that the simulation can continue from tmax
+        if t + dt > tmax:
+            break
+
+        event = np.searchsorted(wp, np.random.random(), side="right")
+        if hetero and event == EVENT_CONTACT:
+            i = weight_pick(weights[1])
         else:
-            # Contact tracing
-            # Random traceable?
-            cti = np.random.choice(np.where(traceable)[0])
-            diagnosed[cti] = True
-            traceable[cti] = False
+            i = abm_pick(event, pools, tpool, ntrace)
+        k = agent_comp(agents, i)
+        ntrace, contacts = abm_event(event, i, agents, contacts,
+                                     pools, tpool, tpos, ntrace, beta, eta)
+        if hetero:
+            weight_update(weights, agents, i, k)
 
         t += dt
+        events += 1
 
-    counts = count_states(states, diagnosed, traceable)
-    traj.append(counts)
-    times.append(t)
-    if return_pcis:
-        pcis.append(np.sum(np.sum(contactM, axis=0) > 0)/N)
-    else:
-        pcis.append(0)
+    while j < tsteps:
+        pool_record(pools, ntrace, traj[j])
+        if return_pcis:
+            pcis[j] = contacts[3][CONTACT_ACTIVE]/N
+        j += 1
+
+    return max(t, tmax), np.random.randint(0, 2**31 - 1), ntrace, contacts, traj, pcis
+
+
+# Compartment flows used to choose the leap size: the source and
+# destination column of each flow. Tracing only removes from CT here,
+# since which compartment the traced agent is in is not known upfront.
+LEAP_SRC = np.array([INDEX_SU, INDEX_EU, INDEX_ED, INDEX_IU, INDEX_ID,
+                     INDEX_IU, INDEX_SD, INDEX_RD, INDEX_CT])
+LEAP_DST = np.array([INDEX_EU, INDEX_IU, INDEX_ID, INDEX_RU, INDEX_RD,
+                     INDEX_ID, INDEX_SU, INDEX_RU, -1])
+
+# below this many expected events a leap is replaced by an exact step
+LEAP_MIN_EVENTS = 10.0
+
+@jit(nopython=True, cache=True)
+def abm_leap(counts, N, c, beta, alpha, gamma, theta, kappa, chi, epsilon):
+    """
+    Choose a leap size such that the expected change, and its standard
+    deviation, of every compartment is bounded by a fraction epsilon of
+    its size (Cao, Gillespie and Petzold, J Chem Phys 124, 044109, 2006).
+    """
+    rates = np.array([beta*c*counts[INDEX_IU]*counts[INDEX_SU]/N,
+                      alpha*counts[INDEX_EU], alpha*counts[INDEX_ED],
+                      gamma*counts[INDEX_IU], gamma*counts[INDEX_ID],
+                      theta*counts[INDEX_IU],
+                      kappa*counts[INDEX_SD], kappa*counts[INDEX_RD],
+                      chi*counts[INDEX_CT]])
+    mu = np.zeros(9)
+    sigma = np.zeros(9)
+    for f in range(len(rates)):
+        mu[LEAP_SRC[f]] -= rates[f]
+        sigma[LEAP_SRC[f]] += rates[f]
+        if LEAP_DST[f] >= 0:
+            mu[LEAP_DST[f]] += rates[f]
+            sigma[LEAP_DST[f]] += rates[f]
+
+    tau = np.inf
+    for k in range(9):
+        bound = max(epsilon*counts[k], 1.0)
+        if mu[k] != 0:
+            tau = min(tau, bound/abs(mu[k]))
+        if sigma[k] > 0:
+            tau = min(tau, bound*bound/sigma[k])
+    return tau
+
+
+@jit(nopython=True, cache=True)
+def seirxud_abm_tau(t, tgrid, tmax, seed,
+                    agents, contacts, pools, tpool, tpos, ntrace, weights, traj,
+                    G, Gonset,
+                    c=5,
+                    beta=0.05,
+                    alpha=0.2,
+                    gamma=0.1,
+                    theta=0.0,
+                    kappa=0.05,
+                    eta=0,
+                    chi=0,
+                    epsilon=0.01,
+                    return_pcis=False,
+                    check=0):
+    """
+    Approximate, tau-leaping, simulation of the agent-based SEIR-CT model.
+    Each leap draws Poisson numbers of each kind of event and applies them
+    to randomly chosen agents. The leap size is chosen adaptively by
+    abm_leap, and is bounded so that leaps end on the output times. When a
+    leap would contain only a few events an exact step is taken instead.
+
+    During a leap only the contacts that cause an infection are recorded
+    individually. For the others it is enough to know how many each
+    infector made, since their contactees are uniformly distributed: the
+    expected number of such contacts per infector, per unit of contact
+    weight, is accumulated in G, with Gonset holding its value when each
+    agent became infectious, and at diagnosis that many random agents,
+    scaled by the weight of the agent, are drawn to be made traceable
+    with probability eta, as in seirxud_abm_gill. The fraction of agents
+    with contacts, pcis, only counts recorded contacts.
+
+    Arguments and return values are as for seirxud_abm_gill, and the
+    new value of G is returned after the contact store.
+    """
+    np.random.seed(seed)
+    N = agents.shape[0]
+    hetero = len(weights[0]) > 0
+
+    tsteps = len(tgrid)
+    pcis = np.zeros(tsteps)
+
+    j = 0
+    steps = 0
+    while t < tmax:
+
+        # record the output times that have been reached
+        while j < tsteps and tgrid[j] <= t:
+            pool_record(pools, ntrace, traj[j])
+            if return_pcis:
+                pcis[j] = contacts[3][CONTACT_ACTIVE]/N
+            j += 1
+
+        counts = pool_counts(pools, ntrace)
+        if check > 0 and steps % check == 0:
+            if counts != count_states(agents):
+                raise AssertionError("ABM compartment counters are inconsistent")
+
+        wp = abm_propensities(counts, c, alpha, gamma, theta, kappa, chi)
+        if hetero:
+            wp[EVENT_CONTACT] = c*weights[1][0]/WEIGHT_SCALE
+        Wtot = np.sum(wp)
+        if Wtot <= 0:
+            break
 
-    return times, traj, pcis
+        tau = abm_leap(counts, N, c, beta, alpha, gamma, theta, kappa, chi, epsilon)
+        tau = min(tau, (tgrid[j] if j < tsteps else tmax) - t)
+
+        # only infecting contacts are events in a leap
+        pinf = beta*counts[INDEX_SU]/N
+        nleap = np.copy(wp)
+        nleap[EVENT_CONTACT] *= pinf
+
+        leap = tau*np.sum(nleap) >= LEAP_MIN_EVENTS
+        if not leap:
+            # exact step, as in seirxud_abm_gill
+            dt = -np.log(np.random.random())/Wtot
+            while j < tsteps and tgrid[j] < t + dt:
+                pool_record(pools, ntrace, traj[j])
+                if return_pcis:
+                    pcis[j] = contacts[3][CONTACT_ACTIVE]/N
+                j += 1
+            if t + dt > tmax:
+                break
+            events = np.zeros(len(wp), dtype=np.int64)
+            events[np.searchsorted(np.cumsum(wp)/Wtot, np.random.random(), side="right")] = 1
+            t += dt
+        else:
+            events = np.zeros(len(wp), dtype=np.int64)
+            for event in range(len(wp)):
+                events[event] = np.random.poisson(nleap[event]*tau)
+            G += c*(1 - pinf)*tau
+            t += tau
+
+        for event in range(len(events)):
+            for _ in range(events[event]):
+                if not abm_possible(event, pools, ntrace):
+                    break
+                if hetero and event == EVENT_CONTACT:
+                    i = weight_pick(weights[1])
+                else:
+                    i = abm_pick(event, pools, tpool, ntrace)
+                if leap and event == EVENT_CONTACT:
+                    # infection in a leap
+                    if pool_counts(pools, ntrace)[INDEX_SU] == 0:
+                        break
+                    si = random_agent_i(pools, STATE_S, False)
+                    contacts = contact_add(contacts, i, si)
+                    agent_set_state(agents, si, STATE_E)
+                    pool_move(pools, si, INDEX_SU, INDEX_EU)
+                    continue
+                k = agent_comp(agents, i)
+                ntrace, contacts = abm_event(event, i, agents, contacts,
+                                             pools, tpool, tpos, ntrace, beta, eta)
+                if hetero:
+                    weight_update(weights, agents, i, k)
+                if event == EVENT_ONSET:
+                    Gonset[i] = G
+                elif event == EVENT_DIAGNOSIS:
+                    made = G - Gonset[i]
+                    if hetero:
+                        made *= weights[0][i]/WEIGHT_SCALE
+                    for _ in range(np.random.poisson(made)):
+                        cti = np.random.randint(0, N)
+                        if not agent_diagnosed(agents, cti) and np.random.random() < eta:
+                            agent_set_traceable(agents, cti, True)
+                            ntrace = trace_add(tpool, tpos, ntrace, cti)
+
+        steps += 1
+
+    while j < tsteps:
+        pool_record(pools, ntrace, traj[j])
+        if return_pcis:
+            pcis[j] = contacts[3][CONTACT_ACTIVE]/N
+        j += 1
+
+    return max(t, tmax), np.random.randint(0, 2**31 - 1), ntrace, contacts, G, traj, pcis
+
+
+# Columns of the parameter matrix given to seirxud_abm_batch
+BATCH_PARAMS = ["c", "beta", "alpha", "gamma", "theta", "kappa", "eta", "chi", "epsilon"]
+
+@jit(nopython=True, parallel=True, cache=True)
+def seirxud_abm_batch(seeds, N, I0, dispersion, tgrid, segstart, segend, params, out, check=0):
+    """
+    Simulate many replicas of the agent-based SEIR-CT model in parallel,
+    one for each of seeds. Every replica starts from a fresh population of
+    N agents of whom I0 are infectious, with contact weights of the given
+    dispersion, as made by abm_new, and runs through
+    the segments given by segstart, the index in tgrid of the first output
+    time of each segment, and segend, the time at which each segment ends.
+    The parameters in force during each segment are given by
+    params[k, s] for replica k and segment s, as in BATCH_PARAMS. Segments with a positive epsilon are
+    simulated by tau-leaping, the others exactly.
+
+    Each replica uses its own random number stream, seeded from its seed,
+    so it gives the same trajectory as when simulated on its own. The
+    trajectories are written into out, of shape (len(seeds), len(tgrid), 9).
+    """
+    K = len(seeds)
+    tsteps = len(tgrid)
+    nseg = len(segstart)
+
+    for k in prange(K):
+        (agents, contacts, pools, tpool, tpos, ntrace, weights,
+         seed) = abm_new(N, I0, seeds[k], dispersion)
+        G = 0.0
+        Gonset = np.zeros(N)
+
+        t = tgrid[0]
+        for s in range(nseg):
+            lo = segstart[s]
+            hi = segstart[s+1] if s + 1 < nseg else tsteps
+            c, beta, alpha, gamma = params[k, s, 0], params[k, s, 1], params[k, s, 2], params[k, s, 3]
+            theta, kappa, eta, chi = params[k, s, 4], params[k, s, 5], params[k, s, 6], params[k, s, 7]
+            epsilon = params[k, s, 8]
+            if epsilon > 0:
+                (t, seed, ntrace, contacts, G,
+                 _, _) = seirxud_abm_tau(t, tgrid[lo:hi], segend[s], seed,
+                                         agents, contacts, pools, tpool, tpos, ntrace,
+                                         weights, out[k, lo:hi], G, Gonset,
+                                         c, beta, alpha, gamma, theta, kappa,
+                                         eta, chi, epsilon, False, check)
+            else:
+                (t, seed, ntrace, contacts,
+                 _, _) = seirxud_abm_gill(t, tgrid[lo:hi], segend[s], seed,
+                                          agents, contacts, pools, tpool, tpos, ntrace,
+                                          weights, out[k, lo:hi],
+                                          c, beta, alpha, gamma, theta, kappa,
+                                          eta, chi, False, check)
+
+
+class ABMState(object):
+    """
+    State of an agent-based simulation: the agents, their contacts, the
+    state of the random number generator and the current time. It is
+    updated in place by `SEIRCTABM.run`, so that a simulation continues
+    from where it stopped across interventions.
+    """
+    def __init__(self, N, I0, seed, dispersion=0.0):
+        self.N = N
+        ## the current time, or None if the simulation has not started
+        self.t = None
+        (self.agents, self.contacts,
+         self.pools, self.tpool, self.tpos, self.ntrace, self.weights,
+         self.seed) = abm_new(N, I0, seed, dispersion)
+        ## accumulated and per-agent contacts for the tau-leaping kernel
+        self.G = 0.0
+        self.Gonset = None
+        ## per-agent timers and the rates and shapes they were drawn
+        ## with for the next-reaction kernel
+        self.timers = None
+        self.rates = None
+        self.shapes = None
+
+    def counts(self):
+        """
+        Return the number of agents in each compartment, and the
+        number traceable, in the order of the observables.
+        """
+        return pool_counts(self.pools, self.ntrace)
+
+    def __repr__(self):
+        counts = ", ".join("{}={}".format(o["name"], n)
+                           for o, n in zip(SEIRCTABM.observables, self.counts()))
+        return "ABMState(t={}, N={}, {})".format(self.t, self.N, counts)
 
 
 class SEIRCTABM(Model):
     name = "SEIR-CT ABM"
     observables = yaml.load(yaml_obs, yaml.FullLoader)
 
-    def initial_conditions(self, N, IU=None):
+    ## debugging aid: if positive, cross-check the compartment counters
+    ## against a full recount of the agents every this many events
+    check = 0
+
+    def initial_conditions(self, N, IU=None, dispersion=0.0):
+        """
+        Create a population of N agents of whom IU are infectious. The
+        random number stream of the simulation is seeded from numpy's
+        global generator, so it follows the seed given to runModel.
+
+        If dispersion is positive, agents make contacts at individual
+        rates, c times a gamma distributed weight with mean one and shape
+        dispersion. Small values, such as 0.1, give superspreading.
+        """
+        if IU is None:
+            IU = int(0.01 * N)
+        return ABMState(N, IU, np.random.randint(0, 2**31 - 1), dispersion)
+
+    def _simulate(self, t, tmax, state, traj, return_pcis):
+        (state.t, state.seed, state.ntrace, state.contacts,
+         traj, pcis) = seirxud_abm_gill(state.t, t, tmax, state.seed,
+                                        state.agents, state.contacts, state.pools,
+                                        state.tpool, state.tpos, state.ntrace,
+                                        state.weights, traj,
+                                        c=self.c, beta=self.beta,
+                                        alpha=self.alpha, gamma=self.gamma,
+                                        theta=self.theta, kappa=self.kappa,
+                                        eta=self.eta, chi=self.chi,
+                                        return_pcis=return_pcis,
+                                        check=self.check)
+        return traj, pcis
+
+    def run_batch(self, segments, parameters, seeds, N, IU=None, dispersion=0.0, out=None):
+        """
+        Run one sample for each of seeds through the given segments,
+        with the given parameters in each, in parallel threads. Sample
+        i gets the same random number stream as `runModel` with seed
+        `seeds[i]` would give it, so the result is the same. Parameters
+        may be sequences with one value for each sample.
+        """
         if IU is None:
             IU = int(0.01 * N)
-        return (N, IU)
 
-    def run(self, t0, tmax, tsteps, state, return_pcis=False):
-        N, I0 = state
+        ## seed each replica as initial_conditions would
+        rseeds = np.zeros(len(seeds), dtype=np.int64)
+        for i, seed in enumerate(seeds):
+            np.random.seed(seed)
+            rseeds[i] = np.random.randint(0, 2**31 - 1)
+
+        t, segstart, segtime = segment_grid(segments)
+        segend = segtime[:, 1].copy()
+        K = len(seeds)
+        params = np.array([[np.broadcast_to(p.get(k, 0.0), K) for k in BATCH_PARAMS]
+                           for p in parameters], dtype=np.float64).transpose(2, 0, 1).copy()
+
+        if out is None:
+            out = np.empty((K, len(t), 9))
+        seirxud_abm_batch(rseeds, N, IU, dispersion, t, segstart, segend,
+                          params, out, check=self.check)
+        return t, out
+
+    def run(self, t0, tmax, tsteps, state, out=None, return_pcis=False):
+        """
+        Continue the simulation in state up to tmax, reporting in
+        tsteps steps from t0. The state is updated in place.
+        """
         t = np.linspace(t0, tmax, tsteps)
+        if state.t is None:
+            state.t = t0
+        traj = np.empty((tsteps, 9)) if out is None else out
 
-        times, traj, pcis = seirxud_abm_gill(tmax=t[-1],
-                                             N=N, I0=I0,
-                                             c=self.c, beta=self.beta,
-                                             alpha=self.alpha, gamma=self.gamma,
-                                             theta=self.theta, kappa=self.kappa,
-                                             eta=self.eta, chi=self.chi)
-        traj = np.array(traj).T
+        traj, pcis = self._simulate(t, tmax, state, traj, return_pcis)
 
+        if return_pcis:
+            return t, (traj, pcis), state
+        else:
+            return t, traj, state
 
-        intptraj = interp1d(times, traj, kind="previous", bounds_error=False,
-                            fill_value=(traj[:, 0], traj[:,-1]))(t)
 
-        if return_pcis:
-            intppcis = interp1d(tr[0], pcis, kind="previous", bounds_error=False,
-                               fill_value=(pcis[0], pcis[-1]))(t)
+yaml_tau_params = """
+epsilon:
+  descr:   tau-leaping error control
+  default: 0.01
+"""
 
-            return t, (intptraj.T, intppcis), state
-        else:
-            return t, intptraj.T, state
+class SEIRCTABMTau(SEIRCTABM):
+    """
+    Approximate version of the agent-based model that advances by
+    tau-leaping rather than one event at a time. The leap size is
+    controlled by `epsilon`, the largest relative change of any
+    compartment expected in one leap. Smaller values are more accurate
+    and slower.
+    """
+    name = "SEIR-CT ABM tau-leaping"
+    parameters = dict(SEIRCTABM.parameters, **yaml.load(yaml_tau_params, yaml.FullLoader))
+
+    def _simulate(self, t, tmax, state, traj, return_pcis):
+        if state.Gonset is None:
+            state.Gonset = np.zeros(state.N)
+        (state.t, state.seed, state.ntrace, state.contacts, state.G,
+         traj, pcis) = seirxud_abm_tau(state.t, t, tmax, state.seed,
+                                       state.agents, state.contacts, state.pools,
+                                       state.tpool, state.tpos, state.ntrace,
+                                       state.weights, traj, state.G, state.Gonset,
+                                       c=self.c, beta=self.beta,
+                                       alpha=self.alpha, gamma=self.gamma,
+                                       theta=self.theta, kappa=self.kappa,
+                                       eta=self.eta, chi=self.chi,
+                                       epsilon=self.epsilon,
+                                       return_pcis=return_pcis,
+                                       check=self.check)
+        return traj, pcis
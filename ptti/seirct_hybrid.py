@@ -0,0 +1,394 @@
+__all__ = ['HybridAgents', 'HybridState', 'SEIRCTHybrid']
+
+import numpy as np
+from numba import jit
+import yaml
+import logging
+from ptti.seirct_abm import \
+    STATE_E, INDEX_SU, INDEX_EU, INDEX_ED, INDEX_IU, INDEX_ID, INDEX_RU, \
+    EVENT_CONTACT, CONTACT_BLOCK, \
+    agent_comp, agent_diagnosed, agent_set_state, contacts_new, contact_add, \
+    contact_list, pool_move, pool_counts, abm_propensities, abm_pick, abm_event
+from ptti.seirct_ode import SEIRCTODEMem, coupling_rhs, coupling_jac, integrate_segment
+
+log = logging.getLogger(__name__)
+
+# Columns of the ODE state beyond the eight compartments, which are in
+# the same order as the INDEX_* columns of the agent-based model
+INDEX_CIS = 8
+INDEX_CIR = 9
+
+# While agents are simulated, only those who matter as individuals are:
+# the exposed, infectious and isolated, and the susceptible and removed
+# who have been contacted by the infectious, since they may be traced.
+# The other susceptible and removed are interchangeable, and are only
+# counted, in bulk[INDEX_SU] and bulk[INDEX_RU], until they are first
+# contacted. The individuals are held in the same arrays as in the
+# agent-based model, which have room for more, and are doubled in size
+# when it runs out, so the memory needed does not depend on N.
+
+@jit(nopython=True, cache=True)
+def grow(a, size, fill):
+    b = np.full(size, fill, dtype=a.dtype)
+    b[:len(a)] = a
+    return b
+
+
+@jit(nopython=True, cache=True)
+def hybrid_add(agents, contacts, pools, tpool, tpos, bulk, k):
+    """
+    Make one of the agents counted in bulk in compartment k into an
+    individual. Returns its index, and the agents, contact store, pools
+    and traceable pool, which may have been reallocated.
+    """
+    order, pos, bounds = pools
+    head, link, peer, meta = contacts
+    i = bounds[8]
+    if i == len(agents):
+        size = max(2*i, CONTACT_BLOCK)
+        agents = grow(agents, size, 0)
+        order = grow(order, size, 0)
+        pos = grow(pos, size, 0)
+        tpool = grow(tpool, size, 0)
+        tpos = grow(tpos, size, -1)
+        head = grow(head, size, -1)
+
+    # it starts at the end of the last compartment and moves down to k
+    agents[i] = k
+    order[i] = i
+    pos[i] = i
+    bounds[8] += 1
+    pools = (order, pos, bounds)
+    pool_move(pools, i, 7, k)
+    bulk[k] -= 1
+    return i, agents, (head, link, peer, meta), pools, tpool, tpos
+
+
+@jit(nopython=True, cache=True)
+def hybrid_agents(counts, ncis, ncir, seed):
+    """
+    Create agents with counts[k] in each compartment k, as in the
+    INDEX_* columns, none of them traceable, with the susceptible and
+    removed in bulk. The individuals are interchangeable, so they are
+    laid out in compartment order. The infectious are given ncis
+    contacts with susceptible agents and ncir with removed ones, each
+    with a random infector, and those contacted become individuals.
+    Returns the agent bitfields, the contact store, the compartment and
+    traceable pools, the bulk and the seed to continue the random number
+    stream with.
+    """
+    np.random.seed(seed)
+
+    bulk = np.zeros(8, dtype=np.int64)
+    bulk[INDEX_SU] = counts[INDEX_SU]
+    bulk[INDEX_RU] = counts[INDEX_RU]
+
+    bounds = np.zeros(9, dtype=np.int64)
+    for k in range(8):
+        bounds[k+1] = bounds[k] + counts[k] - bulk[k]
+    size = max(bounds[8] + ncis + ncir, CONTACT_BLOCK)
+    agents = np.zeros(size, dtype=np.uint8)
+    for k in range(8):
+        agents[bounds[k]:bounds[k+1]] = k
+    pools = (np.arange(size), np.arange(size), bounds)
+    contacts = contacts_new(size)
+    tpool = np.zeros(size, dtype=np.int64)
+    tpos = -np.ones(size, dtype=np.int64)
+
+    # the infectious are both IU and ID
+    nI = bounds[INDEX_RU] - bounds[INDEX_IU]
+    for k, n in ((INDEX_SU, ncis), (INDEX_RU, ncir)):
+        for _ in range(n):
+            if nI == 0 or bulk[k] == 0:
+                break
+            infector = pools[0][pools[2][INDEX_IU] + np.random.randint(0, nI)]
+            (i, agents, contacts, pools,
+             tpool, tpos) = hybrid_add(agents, contacts, pools, tpool, tpos, bulk, k)
+            contacts = contact_add(contacts, infector, i)
+
+    return (agents, contacts, pools, tpool, tpos, bulk,
+            np.random.randint(0, 2**31 - 1))
+
+
+@jit(nopython=True, cache=True)
+def hybrid_gill(t, tmax, seed, N, agents, contacts, pools, tpool, tpos, ntrace, bulk,
+                c, beta, alpha, gamma, theta, kappa, eta, chi):
+    """
+    Gillespie simulation of the agents, as made by hybrid_agents, from
+    time t to tmax, as in seirxud_abm_gill with homogeneous contacts,
+    except that a contact with one of the N agents that is in bulk makes
+    it an individual. The agents are updated in place and the random
+    number generator is seeded with seed. Returns the end time, the seed
+    to continue with, the agents, contact store, pools and traceable
+    pool, which may have been reallocated, and the size of the latter.
+    """
+    np.random.seed(seed)
+
+    while t < tmax:
+        wp = abm_propensities(pool_counts(pools, ntrace), c, alpha, gamma, theta, kappa, chi)
+        Wtot = np.sum(wp)
+        if Wtot <= 0:
+            break
+        wp = np.cumsum(wp)/Wtot
+
+        dt = -np.log(np.random.random())/Wtot
+        if t + dt > tmax:
+            break
+
+        event = np.searchsorted(wp, np.random.random(), side="right")
+        i = abm_pick(event, pools, tpool, ntrace)
+        if event == EVENT_CONTACT:
+            # Contact between a random agent and the IU, as in abm_event
+            rndi = np.random.randint(0, N)
+            n = pools[2][8]
+            if rndi >= n:
+                k = INDEX_SU if rndi - n < bulk[INDEX_SU] else INDEX_RU
+                (rndi, agents, contacts, pools,
+                 tpool, tpos) = hybrid_add(agents, contacts, pools, tpool, tpos, bulk, k)
+            contacts = contact_add(contacts, i, rndi)
+            if agent_comp(agents, rndi) == INDEX_SU and np.random.random() <= beta:
+                agent_set_state(agents, rndi, STATE_E)
+                pool_move(pools, rndi, INDEX_SU, INDEX_EU)
+        else:
+            ntrace, contacts = abm_event(event, i, agents, contacts,
+                                         pools, tpool, tpos, ntrace, beta, eta)
+        t += dt
+
+    return (max(t, tmax), np.random.randint(0, 2**31 - 1),
+            agents, contacts, pools, tpool, tpos, ntrace)
+
+
+@jit(nopython=True, cache=True)
+def abm_observe(agents, contacts, pools, tpool, ntrace, bulk, traced):
+    """
+    The observables of the ODE model for the agents: the number in each
+    compartment, and the number of contacts of the infectious that are
+    susceptible and removed, for CIS and CIR. If traced is true, the
+    agents waiting to be traced are counted as having been, for handing
+    over to the ODE model, which has no compartment for them.
+    """
+    order, pos, bounds = pools
+    y = np.zeros(10)
+    for k in range(8):
+        y[k] = bounds[k+1] - bounds[k] + bulk[k]
+
+    if traced:
+        for n in range(ntrace):
+            k = agent_comp(agents, tpool[n])
+            if not agent_diagnosed(agents, tpool[n]):
+                y[k] -= 1
+                y[k+1] += 1
+
+    # contacts are made by IU and forgotten on recovery, so they are
+    # held by IU and ID
+    for p in range(bounds[INDEX_IU], bounds[INDEX_RU]):
+        for cti in contact_list(contacts, order[p]):
+            k = agent_comp(agents, cti)
+            if k == INDEX_SU:
+                y[INDEX_CIS] += 1
+            elif k == INDEX_RU:
+                y[INDEX_CIR] += 1
+    return y
+
+
+class HybridAgents(object):
+    """
+    The agents of a hybrid simulation, of whom only as many are
+    individuals as need to be, as made by `hybrid_agents`, the state of
+    the random number generator and the current time.
+    """
+    def __init__(self, counts, ncis, ncir, seed):
+        counts = np.asarray(counts, dtype=np.int64)
+        self.N = int(np.sum(counts))
+        self.t = None
+        (self.agents, self.contacts, self.pools, self.tpool, self.tpos,
+         self.bulk, self.seed) = hybrid_agents(counts, ncis, ncir, seed)
+        self.ntrace = 0
+
+    def simulate(self, tmax, **params):
+        (self.t, self.seed, self.agents, self.contacts, self.pools,
+         self.tpool, self.tpos, self.ntrace) = hybrid_gill(self.t, tmax, self.seed, self.N,
+                                                           self.agents, self.contacts,
+                                                           self.pools, self.tpool, self.tpos,
+                                                           self.ntrace, self.bulk, **params)
+
+    def observe(self, traced=False):
+        return abm_observe(self.agents, self.contacts, self.pools, self.tpool,
+                           self.ntrace, self.bulk, traced)
+
+    def __repr__(self):
+        counts = ", ".join("{}={:.0f}".format(o["name"], n)
+                           for o, n in zip(SEIRCTODEMem.observables, self.observe()))
+        return "HybridAgents(t={}, N={}, individuals={}, {})".format(
+            self.t, self.N, self.pools[2][8], counts)
+
+
+class HybridState(object):
+    """
+    State of a hybrid simulation: either the agents, or the state
+    vector of the ODE model, the state of the random number generator
+    and the current time.
+    """
+    def __init__(self, N, y, seed):
+        self.N = N
+        ## the current time, or None if the simulation has not started
+        self.t = None
+        ## the ODE state, or None while the agents are simulated
+        self.y = y
+        ## the agents, or None while the ODE is integrated
+        self.abm = None
+        self.seed = seed
+
+    def to_abm(self):
+        """
+        Switch from the ODE to agents, rounding the compartments to
+        whole numbers, and keeping the total.
+        """
+        counts = np.round(self.y[:8]).astype(np.int64)
+        counts[INDEX_SU] = self.N - (np.sum(counts) - counts[INDEX_SU])
+        self.abm = HybridAgents(counts,
+                                int(round(self.y[INDEX_CIS])),
+                                int(round(self.y[INDEX_CIR])),
+                                self.seed)
+        self.abm.t = self.t
+        self.seed = self.abm.seed
+        self.y = None
+
+    def to_ode(self):
+        """
+        Switch from agents to the ODE.
+        """
+        self.y = self.abm.observe(traced=True)
+        self.seed = self.abm.seed
+        self.abm = None
+
+    def __repr__(self):
+        if self.abm is not None:
+            return "HybridState(t={}, {})".format(self.t, self.abm)
+        return "HybridState(t={}, N={}, y={})".format(self.t, self.N, self.y)
+
+
+yaml_hybrid_params = """
+threshold:
+  descr:   number exposed and infectious above which the ODE is used
+  default: 1000
+threshold_down:
+  descr:   number exposed and infectious below which agents are used again
+  default: 100
+"""
+
+class SEIRCTHybrid(SEIRCTODEMem):
+    """
+    Hybrid of the agent-based and ODE models. While there are few
+    exposed and infectious individuals, fewer than `threshold`, the
+    epidemic is simulated stochastically with agents, as in SEIRCTABM,
+    and once there are more it continues as the ODE, SEIRCTODEMem, much
+    more cheaply, until they are fewer than `threshold_down`, when it
+    goes back to agents. The regime is chosen at the output times, and
+    the integration of the ODE stops at the first where there are few.
+    Only the agents who matter as individuals are held as such, the
+    others are counted, so the memory needed does not grow with N.
+
+    The state is carried over both ways. The ODE model's memory of the
+    contacts of the infectious, CIS and CIR, is made of contacts of
+    random infectious agents with random susceptible and removed ones,
+    and the other way around, the contacts of infectious agents are
+    counted. Agents who are waiting to be traced are taken to have been
+    traced when handing over to the ODE, which does not have them.
+    """
+    name = "SEIR-CT hybrid"
+    parameters = dict(SEIRCTODEMem.parameters, **yaml.load(yaml_hybrid_params, yaml.FullLoader))
+
+    ## samples are run one at a time, one segment at a time
+    run_schedule = None
+    run_batch = None
+    run_sensitivity = None
+
+    def initial_conditions(self, N, **o):
+        """
+        Populate the initial conditions as for SEIRCTODEMem, starting
+        with agents unless there are already many exposed and infectious.
+        The random number stream of the agents is seeded from numpy's
+        global generator, so it follows the seed given to runModel.
+        """
+        y, N = SEIRCTODEMem.initial_conditions(self, N, **o)
+        state = HybridState(N, y, np.random.randint(0, 2**31 - 1))
+        if self._infected(y) < self.threshold:
+            state.to_abm()
+        return state
+
+    def _infected(self, y):
+        return y[..., INDEX_EU] + y[..., INDEX_ED] + y[..., INDEX_IU] + y[..., INDEX_ID]
+
+    def _agents(self, t, tmax, state, traj):
+        """
+        Simulate the agents one output time at a time, until there are
+        enough exposed and infectious for the ODE. Returns the number of
+        rows of traj done.
+        """
+        a = state.abm
+        params = dict(c=self.c, beta=self.beta, alpha=self.alpha, gamma=self.gamma,
+                      theta=self.theta, kappa=self.kappa, eta=self.eta, chi=self.chi)
+        for j in range(len(t)):
+            a.simulate(t[j], **params)
+            traj[j] = a.observe()
+            state.t = a.t
+            if self._infected(traj[j]) >= self.threshold:
+                log.info("Switching to ODE at t = {}".format(state.t))
+                state.to_ode()
+                return j + 1
+
+        ## carry on to the end, after the last output time
+        if state.t < tmax:
+            a.simulate(tmax, **params)
+            state.t = a.t
+        return len(t)
+
+    def _ode(self, t, tmax, state, traj):
+        """
+        Integrate the ODE to tmax, and go back to agents at the first
+        output time when there are few enough exposed and infectious,
+        where the integration stops. Returns the number of rows of traj
+        done.
+        """
+        index = self._index()
+        C = np.array([C for _, C in self._couplings(state.N)], dtype=np.float64)
+        fun = lambda t, y: coupling_rhs(y, C, index)
+        jac = lambda t, y: coupling_jac(y, C, index)
+        below = lambda y: self._infected(y) < self.threshold_down
+        y, _, j = integrate_segment(self.method, fun, jac, state.t, tmax, state.y, t, traj,
+                                    stop=below, rtol=self.rtol, atol=self.atol)
+
+        ## the first rows may be where the ODE took over
+        if j == 0 or t[j-1] <= state.t or not below(traj[j-1]):
+            state.y = np.array(y)
+            state.t = tmax
+            return len(t)
+
+        state.y = traj[j-1].copy()
+        state.t = t[j-1]
+        log.info("Switching to agents at t = {}".format(state.t))
+        state.to_abm()
+        return j
+
+    def run(self, t0, tmax, tsteps, state, out=None):
+        """
+        Continue the simulation in state up to tmax, reporting in
+        tsteps steps from t0, with agents or the ODE as appropriate.
+        The state is updated in place.
+        """
+        t = np.linspace(t0, tmax, tsteps)
+        if state.t is None:
+            state.t = t0
+            if state.abm is not None:
+                state.abm.t = t0
+        traj = np.empty((tsteps, len(self.observables))) if out is None else out
+
+        j = 0
+        while j < tsteps or state.t < tmax:
+            if state.abm is not None:
+                j += self._agents(t[j:], tmax, state, traj[j:])
+            else:
+                j += self._ode(t[j:], tmax, state, traj[j:])
+
+        return t, traj, state
@@ -1,14 +1,49 @@
-__all__ = ['SEIRCTKappa']
+__all__ = ['KappaState', 'SEIRCTKappa']
 
 import numpy as np
-import kappy
+import functools
 import logging
+import os
 import yaml
 import pkg_resources
+from ptti.kappa import KappaSystem
 from ptti.model import Model
 
+## KaSim is only needed to run the rules outside of python
+try:
+    import kappy
+except ImportError:
+    kappy = None
+
 log = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=None)
+def _rules_text():
+    return pkg_resources.resource_string(__name__, "seir-ct.ka").decode("utf-8")
+
+## the KaSim client of each process, and the text that it has parsed
+_kasim = {}
+
+def kasim_client(kappa_text):
+    """
+    Return the KaSim client of this process, with kappa_text parsed.
+    The client is started on first use in each process, so that worker
+    processes each get their own, and the text is only parsed again
+    when it changes, so samples of the same configuration share it.
+    """
+    pid = os.getpid()
+    if pid not in _kasim:
+        _kasim[pid] = [kappy.KappaStd(), None]
+    client, parsed = _kasim[pid]
+
+    if kappa_text != parsed:
+        if parsed is not None:
+            client.file_delete("model.ka")
+        client.add_model_string(kappa_text, file_id="model.ka")
+        client.project_parse()
+        _kasim[pid][1] = kappa_text
+    return client
+
 yaml_obs = """
 - name:  SU
   descr: susceptible and unconfined
@@ -48,6 +83,24 @@ yaml_obs = """
   kappa: "|C(s{r})|"
 """
 
+class KappaState(object):
+    """
+    State of a Kappa simulation: the Kappa program, which holds the
+    current numbers of agents as its initial conditions, and the seed
+    of the random number stream to carry on with. As a string it is the
+    program, so that it can be given to KaSim directly.
+    """
+    def __init__(self, text, seed):
+        self.text = text
+        self.seed = seed
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return "KappaState(seed={})\n{}".format(self.seed, self.text)
+
+
 class SEIRCTKappa(Model):
     """
     /////////////////////////////////////////////
@@ -57,6 +110,9 @@ class SEIRCTKappa(Model):
     name = "SEIR-CT Kappa"
     observables = yaml.load(yaml_obs, yaml.FullLoader)
 
+    ## run the rules with KaSim rather than in process
+    kasim = False
+
     def _vars(self, N):
         params = ["%var: {}\t{}\t// {}".format(k, getattr(self, k), self.parameters[k]["descr"])
                   for k in self.parameters.keys()]
@@ -64,7 +120,7 @@ class SEIRCTKappa(Model):
         return "\n".join(params)
 
     def _rules(self):
-        return pkg_resources.resource_string(__name__, "seir-ct.ka").decode("utf-8")
+        return _rules_text()
 
     def _init(self, N, **ivs):
         obs = dict((o["name"], o) for o in self.observables)
@@ -81,47 +137,106 @@ class SEIRCTKappa(Model):
                for o in self.observables]
         return "\n".join(obs)
 
-    def initial_conditions(self, N, **inits):
+    def _text(self, N, **inits):
         kappa_text = "\n\n".join((self.__doc__, self._vars(N), self._rules(), self._obs(), self._init(N, **inits)))
         log.debug(kappa_text)
         return kappa_text
 
-    def run(self, t0, tmax, steps, kappa_text):
+    def initial_conditions(self, N, **inits):
         """
-        For the Kappa model, the state is simply the Kappa text
+        The state is the Kappa text and the seed of the random number
+        stream, which is seeded from numpy's global generator, so it
+        follows the seed given to runModel.
         """
-        stepsize = (tmax - t0) / steps
+        return KappaState(self._text(N, **inits), np.random.randint(0, 2**31 - 1))
 
-        client = kappy.KappaStd()
-        client.add_model_string(kappa_text)
-        client.project_parse()
+    def _with_vars(self, kappa_text, parameters):
+        """
+        Set the values of the `%var`s in kappa_text to the parameters.
+        """
+        lines = []
+        for line in kappa_text.splitlines():
+            if line.startswith("%var:"):
+                k = line[5:].split()[0]
+                if k in parameters:
+                    line = "%var: {}\t{}\t// {}".format(k, parameters[k], self.parameters[k]["descr"])
+            lines.append(line)
+        return "\n".join(lines)
+
+    def _mods(self, segments, parameters):
+        """
+        Perturbations that change the `%var`s at the start of each
+        segment, to the parameters in force during it.
+        """
+        t0 = segments[0][0]
+        mods = []
+        for (ts, _, _, _), prev, p in zip(segments[1:], parameters, parameters[1:]):
+            mods.extend("%mod: alarm {} do $UPDATE {} {};".format(ts - t0, k, v)
+                        for k, v in p.items() if v != prev.get(k))
+        return "\n".join(mods)
+
+    def run(self, t0, tmax, steps, state, out=None):
+        """
+        For the Kappa model, the state is a KappaState
+        """
+        params = dict((k, getattr(self, k)) for k in self.parameters)
+        return self.run_schedule([(t0, tmax, steps, None)], [params], state, out)
+
+    def run_schedule(self, segments, parameters, state, out=None):
+        """
+        Run the Kappa text through all of the segments, with the given
+        parameters in force during each, in a single simulation. The
+        rules are compiled and simulated in process by `KappaSystem`,
+        unless `kasim` is set, and the state carries on the random
+        number stream, so that this is the same as calling `run` for
+        each segment in turn. KaSim does not give its stream back, so
+        with it, that is only true on average.
+        """
+        kappa_text, seed = state.text, state.seed
+        kappa_text = self._with_vars(kappa_text, parameters[0])
+
+        if self.kasim:
+            t, series, last = self._run_kasim(segments, parameters, kappa_text, seed)
+            seed = np.random.RandomState(seed).randint(0, 2**31 - 1)
+        else:
+            ks = KappaSystem(kappa_text)
+            t, series, x, seed = ks.simulate_schedule(segments, parameters, seed)
+            series = series[:, [[name for name, _ in ks.obs].index(o["name"]) for o in self.observables]]
+            last = ks.obsmatrix @ x
+
+        traj = np.empty(series.shape) if out is None else out
+        traj[:] = series
+
+        ## construct a new Kappa program to carry on from the end
+        onames = [o["name"] for o in self.observables]
+        init   = dict((o, last[self.colindex(o)]) for o in onames)
+        N      = last[list(self.pcols[:8])].sum()
+        return t, traj, KappaState(self._text(N, **init), seed)
+
+    def _run_kasim(self, segments, parameters, kappa_text, seed):
+        """
+        Run the Kappa text with KaSim, through kappy, with the changes
+        of parameters between segments as perturbations. Returns the
+        times, the observables at them, and the observables at the end
+        of the simulation.
+        """
+        if kappy is None:
+            raise ImportError("kappy is needed to run the Kappa model with KaSim")
+
+        t = np.hstack([np.linspace(ts, te, tsteps) for ts, te, tsteps, _ in segments])
+        t0, tmax = segments[0][0], segments[-1][1]
+        stepsize = (tmax - t0) / max(len(t), 1)
 
-        client.simulation_start(kappy.SimulationParameter(stepsize, "[T] > {0}".format(tmax - t0)))
+        client = kasim_client("\n\n".join((kappa_text, self._mods(segments, parameters))))
+        client.simulation_delete()
+        client.simulation_start(kappy.SimulationParameter(stepsize, "[T] > {0}".format(tmax - t0), seed=seed))
         client.wait_for_simulation_stop()
 
         plot = client.simulation_plot()
         series = np.array(plot["series"])[::-1, :]
 
-        t = series[:, 0]
-        traj = series[:, 1:]
-
         ## Kappa will stop running when no more events are possible,
-        ## so pad to the end
-        skipped = steps - traj.shape[0]
-        if skipped > 0:
-            maxt = max(t)
-            stepsize = (tmax - t0) / steps
-            t = np.hstack([t, np.linspace(t[-1] + stepsize, tmax-t0, skipped)])
-            traj = np.pad(traj, ((0,skipped), (0, 0)), "edge")
-
-        ## correct time-series because Kappa always starts at 0
-        t = t + t0
-
-        ## construct a new Kappa program to support exogeneous interventions
-        last   = traj[-1]
-        onames = [o["name"] for o in self.observables]
-        init   = dict((o, last[self.colindex(o)]) for o in onames)
-        N      = np.sum(last[i] for i in self.pcols[:8])
-        kappa_text = self.initial_conditions(N, **init)
-
-        return t, traj, kappa_text
+        ## and reports on its own grid, which starts at 0, so sample
+        ## the state in force at each of our output times
+        idx = np.searchsorted(series[:, 0], t - t0, side="right") - 1
+        return t, series[np.maximum(idx, 0), 1:], series[-1, 1:]
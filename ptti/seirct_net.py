@@ -0,0 +1,386 @@
+__all__ = ['NetState', 'SEIRCTNet', 'network_er', 'network_config',
+           'network_household', 'network_load', 'network_save']
+
+import numpy as np
+from numba import jit
+import logging as log
+from ptti.model import Model
+from ptti.seirct_abm import SEIRCTABM, \
+    STATE_E, STATE_I, STATE_R, INDEX_SU, INDEX_EU, INDEX_IU, INDEX_ID, \
+    EVENT_CONTACT, EVENT_ONSET, EVENT_RECOVERY, EVENT_DIAGNOSIS, \
+    EVENT_RELEASE_S, EVENT_RELEASE_R, \
+    agent_comp, agent_diagnosed, agent_set_state, agent_set_diagnosed, \
+    agent_set_traceable, count_states, pools_new, pool_move, pool_counts, \
+    pool_record, trace_add, trace_remove, abm_propensities, abm_pick
+
+# Networks are undirected and stored in compressed sparse row form: the
+# neighbours of node i are indices[indptr[i]:indptr[i+1]]. The edges of
+# the network double as the contact store, so there is one used flag per
+# directed edge, set when the node at its start contacts the node at its
+# end while infectious.
+
+@jit(nopython=True, cache=True)
+def network_csr(N, src, dst):
+    """
+    Build the CSR arrays of the undirected network on N nodes with the
+    edges between src and dst, dropping self-loops and repeated edges.
+    """
+    ## counting sort of both directions of each edge by their start
+    indptr = np.zeros(N + 1, dtype=np.int64)
+    for e in range(len(src)):
+        if src[e] != dst[e]:
+            indptr[src[e] + 1] += 1
+            indptr[dst[e] + 1] += 1
+    indptr = np.cumsum(indptr)
+    fill = indptr[:-1].copy()
+    indices = np.empty(indptr[N], dtype=np.int32)
+    for e in range(len(src)):
+        if src[e] != dst[e]:
+            indices[fill[src[e]]] = dst[e]
+            fill[src[e]] += 1
+            indices[fill[dst[e]]] = src[e]
+            fill[dst[e]] += 1
+
+    ## sort each row and squeeze out repeats in place
+    n = 0
+    lo = 0
+    for i in range(N):
+        hi = indptr[i+1]
+        row = np.sort(indices[lo:hi])
+        indptr[i] = n
+        for r in range(len(row)):
+            if r == 0 or row[r] != row[r-1]:
+                indices[n] = row[r]
+                n += 1
+        lo = hi
+    indptr[N] = n
+    return indptr, indices[:n].copy()
+
+def network_er(N, k, rng=np.random):
+    """
+    Erdős–Rényi random network on N nodes with mean degree k.
+    """
+    M = rng.poisson(N * k / 2)
+    return network_csr(N, rng.randint(0, N, M, dtype=np.int32),
+                       rng.randint(0, N, M, dtype=np.int32))
+
+def network_config(N, k, dispersion=1.0, rng=np.random):
+    """
+    Configuration model network on N nodes whose degrees are negative
+    binomially distributed with mean k and the given dispersion. Smaller
+    dispersion gives more heterogeneous degrees. Self-loops and repeated
+    edges are removed, so the mean degree is slightly below k.
+    """
+    p = dispersion / (dispersion + k)
+    degrees = rng.negative_binomial(dispersion, p, N)
+    stubs = rng.permutation(np.repeat(np.arange(N, dtype=np.int32), degrees))
+    if len(stubs) % 2:
+        stubs = stubs[:-1]
+    return network_csr(N, stubs[0::2], stubs[1::2])
+
+def network_household(N, k, household=3.0, rng=np.random):
+    """
+    Two-layer network on N nodes: fully connected households whose
+    sizes are one more than a Poisson number with mean household - 1,
+    overlaid with an Erdős–Rényi community layer of mean degree k.
+    """
+    sizes = 1 + rng.poisson(household - 1, N)
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), N) + 1]
+    sizes[-1] -= np.sum(sizes) - N
+    starts = np.cumsum(sizes) - sizes
+
+    M = rng.poisson(N * k / 2)
+    src = [rng.randint(0, N, M, dtype=np.int32)]
+    dst = [rng.randint(0, N, M, dtype=np.int32)]
+    for s in np.unique(sizes):
+        hs = starts[sizes == s]
+        for a in range(s):
+            for b in range(a + 1, s):
+                src.append(hs + a)
+                dst.append(hs + b)
+
+    ## households are consecutive runs of nodes before relabelling
+    relabel = rng.permutation(N).astype(np.int32)
+    src, dst = np.concatenate(src), np.concatenate(dst)
+    return network_csr(N, relabel[src], relabel[dst])
+
+def network_load(filename):
+    """
+    Read a network saved by network_save.
+    """
+    data = np.load(filename)
+    return data["indptr"].astype(np.int64), data["indices"].astype(np.int32)
+
+def network_save(filename, indptr, indices):
+    """
+    Save a network in CSR form as the arrays indptr and indices of
+    a numpy .npz file.
+    """
+    np.savez(filename, indptr=indptr, indices=indices)
+
+
+# Agent bit recording that it has used at least one of its edges, in
+# addition to those defined in seirct_abm
+AGENT_CONTACTED = 16
+
+@jit(nopython=True, cache=True)
+def net_new(indptr, I0, seed):
+    """
+    Create a population of agents on the nodes of a network of whom I0,
+    chosen at random, are infectious. Returns the agent bitfields, the
+    edge used flags, the compartment and traceable pools and the seed to
+    continue the random number stream with.
+    """
+    np.random.seed(seed)
+    N = len(indptr) - 1
+
+    agents = np.zeros(N, dtype=np.uint8)
+    used = np.zeros(indptr[N], dtype=np.bool_)
+
+    istart = np.random.choice(np.arange(N), size=I0, replace=False)
+    for i in istart:
+        agent_set_state(agents, i, STATE_I)
+
+    pools = pools_new(agents)
+    tpool = np.zeros(N, dtype=np.int64)
+    tpos = -np.ones(N, dtype=np.int64)
+    ntrace = 0
+
+    return (agents, used, pools, tpool, tpos, ntrace,
+            np.random.randint(0, 2**31 - 1))
+
+
+@jit(nopython=True, cache=True)
+def net_event(event, i, agents, indptr, indices, used, nactive, pools,
+              tpool, tpos, ntrace, beta, eta):
+    """
+    Apply one event of the given kind to agent i, as abm_event does for
+    the well-mixed model, except that contacts are made along the edges
+    of the network. Returns the new size of the traceable pool and the
+    number of agents that have made contacts.
+    """
+    if event == EVENT_CONTACT:
+        # Contact between a random neighbour and the IU
+        lo, hi = indptr[i], indptr[i+1]
+        if hi > lo:
+            e = lo + np.random.randint(0, hi - lo)
+            used[e] = True
+            if not agents[i] & AGENT_CONTACTED:
+                agents[i] |= AGENT_CONTACTED
+                nactive += 1
+            j = indices[e]
+            if agent_comp(agents, j) == INDEX_SU and np.random.random() <= beta:
+                agent_set_state(agents, j, STATE_E)
+                pool_move(pools, j, INDEX_SU, INDEX_EU)
+    elif event == EVENT_ONSET:
+        # E becomes I
+        k = agent_comp(agents, i)
+        agent_set_state(agents, i, STATE_I)
+        pool_move(pools, i, k, agent_comp(agents, i))
+    elif event == EVENT_RECOVERY:
+        # I becomes R, forgetting its contacts
+        if agents[i] & AGENT_CONTACTED:
+            used[indptr[i]:indptr[i+1]] = False
+            agents[i] &= ~AGENT_CONTACTED
+            nactive -= 1
+        k = agent_comp(agents, i)
+        agent_set_state(agents, i, STATE_R)
+        pool_move(pools, i, k, agent_comp(agents, i))
+    elif event == EVENT_DIAGNOSIS:
+        agent_set_diagnosed(agents, i, True)
+        pool_move(pools, i, INDEX_IU, INDEX_ID)
+        agent_set_traceable(agents, i, False)
+        ntrace = trace_remove(tpool, tpos, ntrace, i)
+        # Neighbours that it has contacted become traceable
+        for e in range(indptr[i], indptr[i+1]):
+            cti = indices[e]
+            if used[e] and not agent_diagnosed(agents, cti) and np.random.random() < eta:
+                agent_set_traceable(agents, cti, True)
+                ntrace = trace_add(tpool, tpos, ntrace, cti)
+    elif event == EVENT_RELEASE_S or event == EVENT_RELEASE_R:
+        k = agent_comp(agents, i)
+        agent_set_diagnosed(agents, i, False)
+        pool_move(pools, i, k, k - 1)
+    else:
+        # Contact tracing
+        k = agent_comp(agents, i)
+        agent_set_diagnosed(agents, i, True)
+        agent_set_traceable(agents, i, False)
+        ntrace = trace_remove(tpool, tpos, ntrace, i)
+        pool_move(pools, i, k, k + 1)
+    return ntrace, nactive
+
+
+@jit(nopython=True, cache=True)
+def seirxud_net_gill(t, tgrid, tmax, seed,
+                     agents, indptr, indices, used, nactive, pools,
+                     tpool, tpos, ntrace, traj,
+                     c=5,
+                     beta=0.05,
+                     alpha=0.2,
+                     gamma=0.1,
+                     theta=0.0,
+                     kappa=0.05,
+                     eta=0,
+                     chi=0,
+                     return_pcis=False,
+                     check=0):
+    """
+    Gillespie simulation of the SEIR-CT model on a network. Each IU agent
+    makes contacts at rate c, each with a neighbour chosen uniformly at
+    random, so the cost of an event does not depend on the size of the
+    population, and that of a diagnosis is proportional to the degree.
+
+    Arguments and return values are as for seirxud_abm_gill, with the
+    network and its edge used flags in place of the contact store, and
+    the number of agents that have made contacts returned instead of it.
+    """
+    np.random.seed(seed)
+    N = agents.shape[0]
+
+    tsteps = len(tgrid)
+    pcis = np.zeros(tsteps)
+
+    j = 0
+    events = 0
+    while t < tmax:
+
+        counts = pool_counts(pools, ntrace)
+        if check > 0 and events % check == 0:
+            if counts != count_states(agents):
+                raise AssertionError("Network compartment counters are inconsistent")
+
+        wp = abm_propensities(counts, c, alpha, gamma, theta, kappa, chi)
+        Wtot = np.sum(wp)
+        if Wtot <= 0:
+            break
+        wp = np.cumsum(wp)/Wtot
+
+        dt = -np.log(np.random.random())/Wtot
+
+        while j < tsteps and tgrid[j] < t + dt:
+            pool_record(pools, ntrace, traj[j])
+            if return_pcis:
+                pcis[j] = nactive/N
+            j += 1
+
+        if t + dt > tmax:
+            break
+
+        event = np.searchsorted(wp, np.random.random(), side="right")
+        i = abm_pick(event, pools, tpool, ntrace)
+        ntrace, nactive = net_event(event, i, agents, indptr, indices, used,
+                                    nactive, pools, tpool, tpos, ntrace,
+                                    beta, eta)
+
+        t += dt
+        events += 1
+
+    while j < tsteps:
+        pool_record(pools, ntrace, traj[j])
+        if return_pcis:
+            pcis[j] = nactive/N
+        j += 1
+
+    return max(t, tmax), np.random.randint(0, 2**31 - 1), ntrace, nactive, traj, pcis
+
+
+class NetState(object):
+    """
+    State of a network simulation: the network, the agents on its
+    nodes, which edges have been used for contacts, the state of the
+    random number generator and the current time.
+    """
+    def __init__(self, indptr, indices, I0, seed):
+        self.N = len(indptr) - 1
+        self.t = None
+        self.indptr, self.indices = indptr, indices
+        (self.agents, self.used, self.pools, self.tpool, self.tpos,
+         self.ntrace, self.seed) = net_new(indptr, I0, seed)
+        self.nactive = 0
+
+    def counts(self):
+        """
+        Return the number of agents in each compartment, and the
+        number traceable, in the order of the observables.
+        """
+        return pool_counts(self.pools, self.ntrace)
+
+    def __repr__(self):
+        counts = ", ".join("{}={}".format(o["name"], n)
+                           for o, n in zip(SEIRCTNet.observables, self.counts()))
+        return "NetState(t={}, N={}, edges={}, {})".format(
+            self.t, self.N, len(self.indices) // 2, counts)
+
+
+class SEIRCTNet(Model):
+    """
+    Agent-based SEIR-CT model in which agents only contact their
+    neighbours on a contact network, and tracing follows the edges
+    along which contacts were made.
+    """
+    name = "SEIR-CT network ABM"
+    parameters = SEIRCTABM.parameters
+    observables = SEIRCTABM.observables
+
+    ## see SEIRCTABM.check
+    check = 0
+
+    def initial_conditions(self, N, IU=None, network="er", k=10.0,
+                           dispersion=1.0, household=3.0, netseed=None):
+        """
+        Create a population of N agents on a network, of whom IU are
+        infectious. The network is one of "er" (Erdős–Rényi), "config"
+        (configuration model with negative binomial degrees) or
+        "household" (households and an Erdős–Rényi community layer),
+        with mean (community) degree k, or else the name of a file
+        written by network_save. Generated networks are drawn from the
+        random seed given to runModel, so each sample has a different
+        one, unless netseed is given to fix the network.
+        """
+        if IU is None:
+            IU = int(0.01 * N)
+
+        rng = np.random if netseed is None else np.random.RandomState(netseed)
+        if network == "er":
+            indptr, indices = network_er(N, k, rng)
+        elif network == "config":
+            indptr, indices = network_config(N, k, dispersion, rng)
+        elif network == "household":
+            indptr, indices = network_household(N, k, household, rng)
+        else:
+            indptr, indices = network_load(network)
+            if len(indptr) - 1 != N:
+                raise ValueError("Network {} has {} nodes, not N = {}".format(
+                    network, len(indptr) - 1, N))
+        log.info("Network {}: {} nodes, mean degree {:.2f}".format(
+            network, N, len(indices) / N))
+
+        return NetState(indptr, indices, IU, np.random.randint(0, 2**31 - 1))
+
+    def run(self, t0, tmax, tsteps, state, out=None, return_pcis=False):
+        """
+        Continue the simulation in state up to tmax, reporting in
+        tsteps steps from t0. The state is updated in place.
+        """
+        t = np.linspace(t0, tmax, tsteps)
+        if state.t is None:
+            state.t = t0
+        traj = np.empty((tsteps, 9)) if out is None else out
+
+        (state.t, state.seed, state.ntrace, state.nactive,
+         traj, pcis) = seirxud_net_gill(state.t, t, tmax, state.seed,
+                                        state.agents, state.indptr, state.indices,
+                                        state.used, state.nactive, state.pools,
+                                        state.tpool, state.tpos, state.ntrace, traj,
+                                        c=self.c, beta=self.beta,
+                                        alpha=self.alpha, gamma=self.gamma,
+                                        theta=self.theta, kappa=self.kappa,
+                                        eta=self.eta, chi=self.chi,
+                                        return_pcis=return_pcis,
+                                        check=self.check)
+
+        if return_pcis:
+            return t, (traj, pcis), state
+        else:
+            return t, traj, state
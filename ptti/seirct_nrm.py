@@ -0,0 +1,403 @@
+__all__ = ['SEIRCTABMNRM']
+
+import numpy as np
+from numba import jit
+import yaml
+from ptti.seirct_abm import SEIRCTABM, \
+    STATE_E, STATE_I, INDEX_SU, INDEX_EU, INDEX_IU, \
+    INDEX_SD, INDEX_RD, \
+    EVENT_ONSET, EVENT_RECOVERY, EVENT_DIAGNOSIS, EVENT_RELEASE_S, \
+    EVENT_RELEASE_R, EVENT_TRACING, CONTACT_ACTIVE, \
+    agent_state, agent_comp, agent_traceable, agent_set_state, \
+    contact_add, contact_list, count_states, pool_move, pool_counts, \
+    pool_record, random_agent_i, abm_event, WEIGHT_SCALE, weight_pick, \
+    weight_update
+
+# Timers. Each agent has up to three pending timers, one in each slot:
+# progression (onset when E, recovery when I), testing (diagnosis when IU,
+# release from isolation when SD or RD) and tracing (quarantine when
+# traceable). The timer for slot s of agent i is numbered NSLOTS*i + s.
+SLOT_PROGRESS = 0
+SLOT_TEST     = 1
+SLOT_TRACE    = 2
+NSLOTS        = 3
+
+# The pending timers are kept in an indexed binary min-heap, a tuple
+# (heap, hpos, htime, meta). heap[:meta[0]] holds timer numbers in heap
+# order of their times htime, and hpos is the inverse of heap, or -1 for
+# timers that are not pending, so that any timer can be changed or
+# cancelled in O(log n).
+@jit(nopython=True, cache=True)
+def timers_new(n):
+    heap = np.zeros(n, dtype=np.int64)
+    hpos = -np.ones(n, dtype=np.int64)
+    htime = np.full(n, np.inf)
+    meta = np.zeros(1, dtype=np.int64)
+    return (heap, hpos, htime, meta)
+
+
+@jit(nopython=True, cache=True)
+def timer_up(timers, p):
+    heap, hpos, htime, meta = timers
+    k = heap[p]
+    while p > 0:
+        q = (p - 1) // 2
+        if htime[heap[q]] <= htime[k]:
+            break
+        heap[p] = heap[q]
+        hpos[heap[p]] = p
+        p = q
+    heap[p] = k
+    hpos[k] = p
+
+
+@jit(nopython=True, cache=True)
+def timer_down(timers, p):
+    heap, hpos, htime, meta = timers
+    n = meta[0]
+    k = heap[p]
+    while True:
+        q = 2*p + 1
+        if q >= n:
+            break
+        if q + 1 < n and htime[heap[q+1]] < htime[heap[q]]:
+            q += 1
+        if htime[k] <= htime[heap[q]]:
+            break
+        heap[p] = heap[q]
+        hpos[heap[p]] = p
+        p = q
+    heap[p] = k
+    hpos[k] = p
+
+
+@jit(nopython=True, cache=True)
+def timer_set(timers, k, time):
+    """
+    Schedule timer k to go off at the given time, replacing any time
+    it was already set for.
+    """
+    heap, hpos, htime, meta = timers
+    htime[k] = time
+    if hpos[k] < 0:
+        heap[meta[0]] = k
+        hpos[k] = meta[0]
+        meta[0] += 1
+    timer_up(timers, hpos[k])
+    timer_down(timers, hpos[k])
+
+
+@jit(nopython=True, cache=True)
+def timer_cancel(timers, k):
+    heap, hpos, htime, meta = timers
+    p = hpos[k]
+    if p < 0:
+        return
+    meta[0] -= 1
+    last = heap[meta[0]]
+    hpos[k] = -1
+    htime[k] = np.inf
+    if last != k:
+        heap[p] = last
+        hpos[last] = p
+        timer_up(timers, p)
+        timer_down(timers, hpos[last])
+
+
+@jit(nopython=True, cache=True)
+def timer_next(timers):
+    """
+    The next timer to go off and its time, or -1 and infinity.
+    """
+    heap, hpos, htime, meta = timers
+    if meta[0] == 0:
+        return -1, np.inf
+    return heap[0], htime[heap[0]]
+
+
+@jit(nopython=True, cache=True)
+def nrm_rate(agents, i, slot, rates):
+    """
+    The rate, from rates = (alpha, gamma, theta, kappa, chi), at which the
+    timer in the given slot of agent i runs in its current state, or zero
+    if it has no timer there.
+    """
+    k = agent_comp(agents, i)
+    if slot == SLOT_PROGRESS:
+        s = agent_state(agents, i)
+        if s == STATE_E:
+            return rates[0]
+        elif s == STATE_I:
+            return rates[1]
+    elif slot == SLOT_TEST:
+        if k == INDEX_IU:
+            return rates[2]
+        elif k == INDEX_SD or k == INDEX_RD:
+            return rates[3]
+    elif agent_traceable(agents, i):
+        return rates[4]
+    return 0.0
+
+
+@jit(nopython=True, cache=True)
+def nrm_shape(agents, i, slot, shapes):
+    """
+    Shape of the gamma distributed duration of the timer in the given
+    slot of agent i, from shapes = (alpha_k, gamma_k, theta_k, kappa_k).
+    """
+    if slot == SLOT_PROGRESS:
+        if agent_state(agents, i) == STATE_E:
+            return shapes[0]
+        return shapes[1]
+    elif slot == SLOT_TEST:
+        if agent_comp(agents, i) == INDEX_IU:
+            return shapes[2]
+        return shapes[3]
+    return 1.0
+
+
+@jit(nopython=True, cache=True)
+def nrm_schedule(timers, agents, i, slot, t, rates, shapes):
+    """
+    Start the timer in the given slot of agent i from time t, with a
+    gamma distributed duration of mean one over its rate, or cancel it
+    if the agent has no timer in that slot in its current state.
+    """
+    rate = nrm_rate(agents, i, slot, rates)
+    if rate > 0:
+        shape = nrm_shape(agents, i, slot, shapes)
+        timer_set(timers, NSLOTS*i + slot, t + np.random.gamma(shape, 1/(shape*rate)))
+    else:
+        timer_cancel(timers, NSLOTS*i + slot)
+
+
+@jit(nopython=True, cache=True)
+def nrm_retime(t, seed, agents, timers, old, rates, oldshapes, shapes):
+    """
+    Bring the timers of all agents in line with new rates and shapes at
+    time t. Only exponential timers, of shape one, are retimed exactly:
+    when their rate changed from old, the remaining time is rescaled by
+    the ratio of the rates (Gibson and Bruck, J Phys Chem A 104, 1876,
+    2000). A gamma distributed timer whose rate or shape changed gets a
+    new duration from the new distribution, which forgets the time
+    already spent. Timers that should now be running but are not are
+    started, and those that should not are cancelled. Called with all
+    old rates zero, this schedules the timers of a new population.
+    """
+    np.random.seed(seed)
+    htime = timers[2]
+    for i in range(agents.shape[0]):
+        for slot in range(NSLOTS):
+            k = NSLOTS*i + slot
+            rate = nrm_rate(agents, i, slot, rates)
+            orate = nrm_rate(agents, i, slot, old)
+            shape = nrm_shape(agents, i, slot, shapes)
+            oshape = nrm_shape(agents, i, slot, oldshapes)
+            if timers[1][k] >= 0 and rate > 0 and orate > 0:
+                if shape == 1.0 and oshape == 1.0:
+                    if rate != orate:
+                        timer_set(timers, k, t + (htime[k] - t)*orate/rate)
+                elif rate != orate or shape != oshape:
+                    nrm_schedule(timers, agents, i, slot, t, rates, shapes)
+            elif timers[1][k] >= 0 or rate > 0:
+                nrm_schedule(timers, agents, i, slot, t, rates, shapes)
+    return np.random.randint(0, 2**31 - 1)
+
+
+@jit(nopython=True, cache=True)
+def seirxud_abm_nrm(t, tgrid, tmax, seed,
+                    agents, contacts, pools, tpool, tpos, ntrace, weights, timers, traj,
+                    c=5,
+                    beta=0.05,
+                    alpha=0.2,
+                    gamma=0.1,
+                    theta=0.0,
+                    kappa=0.05,
+                    eta=0,
+                    chi=0,
+                    alpha_k=1.0,
+                    gamma_k=1.0,
+                    theta_k=1.0,
+                    kappa_k=1.0,
+                    return_pcis=False,
+                    check=0):
+    """
+    Next-reaction simulation of the agent-based SEIR-CT model. Instead
+    of aggregate propensities, every agent carries its own timers for
+    its next change of state, held in a priority queue, so durations
+    need not be exponential: the incubation, infectious, test and
+    isolation periods are gamma distributed with means 1/alpha, 1/gamma,
+    1/theta and 1/kappa and shapes alpha_k, gamma_k, theta_k and kappa_k,
+    and a shape of one gives the exponential durations of
+    seirxud_abm_gill. Each event costs O(log N). Contacts remain a
+    Poisson process of rate c for each IU agent, times its contact
+    weight if they are heterogeneous.
+
+    The timers must have been scheduled with nrm_retime for the current
+    rates. Arguments and return values are otherwise as for
+    seirxud_abm_gill.
+    """
+    np.random.seed(seed)
+    N = agents.shape[0]
+    rates = np.array([alpha, gamma, theta, kappa, chi])
+    shapes = np.array([alpha_k, gamma_k, theta_k, kappa_k])
+
+    tsteps = len(tgrid)
+    pcis = np.zeros(tsteps)
+
+    # the contact clock, redrawn whenever the number (or total contact
+    # weight) of IU changes
+    hetero = len(weights[0]) > 0
+    nIU = weights[1][0]/WEIGHT_SCALE if hetero else pool_counts(pools, ntrace)[INDEX_IU]
+    tc = t - np.log(np.random.random())/(c*nIU) if c*nIU > 0 else np.inf
+
+    j = 0
+    events = 0
+    while t < tmax:
+
+        if check > 0 and events % check == 0:
+            if pool_counts(pools, ntrace) != count_states(agents):
+                raise AssertionError("ABM compartment counters are inconsistent")
+
+        k, tn = timer_next(timers)
+        contact = tc < tn
+        if contact:
+            tn = tc
+        if tn == np.inf:
+            break
+
+        while j < tsteps and tgrid[j] < tn:
+            pool_record(pools, ntrace, traj[j])
+            if return_pcis:
+                pcis[j] = contacts[3][CONTACT_ACTIVE]/N
+            j += 1
+
+        # pending timers keep their times, and the contact clock is
+        # memoryless, so the simulation can continue from tmax
+        if tn > tmax:
+            break
+        t = tn
+
+        if contact:
+            # Contact between a random individual and a random IU
+            if hetero:
+                i = weight_pick(weights[1])
+            else:
+                i = random_agent_i(pools, STATE_I, False)
+            rndi = np.random.randint(0, N)
+            contacts = contact_add(contacts, i, rndi)
+            if agent_comp(agents, rndi) == INDEX_SU and np.random.random() <= beta:
+                agent_set_state(agents, rndi, STATE_E)
+                pool_move(pools, rndi, INDEX_SU, INDEX_EU)
+                nrm_schedule(timers, agents, rndi, SLOT_PROGRESS, t, rates, shapes)
+            tc = t - np.log(np.random.random())/(c*nIU)
+        else:
+            i, slot = k // NSLOTS, k % NSLOTS
+            timer_cancel(timers, k)
+            comp = agent_comp(agents, i)
+            if slot == SLOT_PROGRESS:
+                event = EVENT_ONSET if agent_state(agents, i) == STATE_E else EVENT_RECOVERY
+            elif slot == SLOT_TEST:
+                if comp == INDEX_IU:
+                    event = EVENT_DIAGNOSIS
+                elif comp == INDEX_SD:
+                    event = EVENT_RELEASE_S
+                else:
+                    event = EVENT_RELEASE_R
+            else:
+                event = EVENT_TRACING
+
+            ntrace, contacts = abm_event(event, i, agents, contacts,
+                                         pools, tpool, tpos, ntrace, beta, eta)
+            if hetero:
+                weight_update(weights, agents, i, comp)
+
+            # the timers of agent i that depend on its new state
+            if event == EVENT_ONSET or event == EVENT_RECOVERY:
+                nrm_schedule(timers, agents, i, SLOT_PROGRESS, t, rates, shapes)
+                nrm_schedule(timers, agents, i, SLOT_TEST, t, rates, shapes)
+            elif event == EVENT_DIAGNOSIS or event == EVENT_TRACING:
+                nrm_schedule(timers, agents, i, SLOT_TEST, t, rates, shapes)
+                timer_cancel(timers, NSLOTS*i + SLOT_TRACE)
+            if event == EVENT_DIAGNOSIS:
+                for cti in contact_list(contacts, i):
+                    if agent_traceable(agents, cti) and timers[1][NSLOTS*cti + SLOT_TRACE] < 0:
+                        nrm_schedule(timers, agents, cti, SLOT_TRACE, t, rates, shapes)
+
+            n = weights[1][0]/WEIGHT_SCALE if hetero else pool_counts(pools, ntrace)[INDEX_IU]
+            if n != nIU:
+                nIU = n
+                tc = t - np.log(np.random.random())/(c*nIU) if c*nIU > 0 else np.inf
+
+        events += 1
+
+    while j < tsteps:
+        pool_record(pools, ntrace, traj[j])
+        if return_pcis:
+            pcis[j] = contacts[3][CONTACT_ACTIVE]/N
+        j += 1
+
+    return max(t, tmax), np.random.randint(0, 2**31 - 1), ntrace, contacts, traj, pcis
+
+
+yaml_nrm_params = """
+alpha_k:
+  descr:   shape of the incubation period distribution (1 is exponential)
+  default: 1.0
+gamma_k:
+  descr:   shape of the infectious period distribution (1 is exponential)
+  default: 1.0
+theta_k:
+  descr:   shape of the time to test distribution (1 is exponential)
+  default: 1.0
+kappa_k:
+  descr:   shape of the isolation period distribution (1 is exponential)
+  default: 1.0
+"""
+
+class SEIRCTABMNRM(SEIRCTABM):
+    """
+    Version of the agent-based model simulated by the next-reaction
+    method, with a timer for each agent, so that the incubation,
+    infectious, testing and isolation periods can have gamma
+    distributions with the given shapes. Large shapes give nearly
+    fixed durations. With all shapes one it is equivalent to SEIRCTABM.
+    """
+    name = "SEIR-CT ABM next-reaction"
+    parameters = dict(SEIRCTABM.parameters, **yaml.load(yaml_nrm_params, yaml.FullLoader))
+
+    ## samples are run one at a time
+    run_batch = None
+
+    def _rates(self):
+        return np.array([self.alpha, self.gamma, self.theta, self.kappa, self.chi],
+                        dtype=np.float64)
+
+    def _simulate(self, t, tmax, state, traj, return_pcis):
+        rates = self._rates()
+        shapes = np.array([self.alpha_k, self.gamma_k, self.theta_k, self.kappa_k],
+                          dtype=np.float64)
+        if state.timers is None:
+            state.timers = timers_new(3*state.N)
+            state.rates = np.zeros(5)
+            state.shapes = shapes
+        if not (np.array_equal(state.rates, rates) and np.array_equal(state.shapes, shapes)):
+            state.seed = nrm_retime(state.t, state.seed, state.agents, state.timers,
+                                    state.rates, rates, state.shapes, shapes)
+            state.rates = rates
+            state.shapes = shapes
+
+        (state.t, state.seed, state.ntrace, state.contacts,
+         traj, pcis) = seirxud_abm_nrm(state.t, t, tmax, state.seed,
+                                       state.agents, state.contacts, state.pools,
+                                       state.tpool, state.tpos, state.ntrace,
+                                       state.weights, state.timers, traj,
+                                       c=self.c, beta=self.beta,
+                                       alpha=self.alpha, gamma=self.gamma,
+                                       theta=self.theta, kappa=self.kappa,
+                                       eta=self.eta, chi=self.chi,
+                                       alpha_k=self.alpha_k, gamma_k=self.gamma_k,
+                                       theta_k=self.theta_k, kappa_k=self.kappa_k,
+                                       return_pcis=return_pcis,
+                                       check=self.check)
+        return traj, pcis
@@ -2,8 +2,10 @@ __all__ = ['SEIRCTODEMem']
 
 import numpy as np
 import yaml
-from ptti.model import Model
+from ptti.model import Model, segment_grid
 from scipy.interpolate import interp1d
+from scipy.integrate import LSODA
+from numba import jit
 from cpyment import CModel
 import logging
 
@@ -32,7 +34,384 @@ yaml_seirct_obs = """
   descr: traceable and exposed
 """
 
-class SEIRCTODEMem(Model):
+def coupling_index(descr, states):
+    """
+    Parse a coupling description of the form "S1*S2:S3=>S4", as used
+    by cpyment's CModel, into the indexes of the four states, using
+    len(states) for those that are missing. The rate of the coupling
+    is C*y[i1]*y[i2], and it is taken from i3 and added to i4, with the
+    same defaults for missing states as CModel.
+    """
+    s12, s34 = descr.split(":") if ":" in descr else (
+        (None, descr) if "=>" in descr else (descr, None))
+
+    s1 = s2 = s3 = s4 = None
+    if s12:
+        s1, s2 = s12.split("*") if "*" in s12 else (s12, None)
+        s1, s2 = s1 or None, s2 or None
+        if s1 is None:
+            s1, s2 = s2, s1
+    if s34:
+        s3, s4 = s34.split("=>") if "=>" in s34 else (None, s34)
+        s3, s4 = s3 or None, s4 or None
+
+    n = len(states)
+    i1, i2, i3, i4 = (states.index(s) if s is not None else n for s in (s1, s2, s3, s4))
+    if i3 == n and i4 == n:
+        if i2 == n:
+            i4 = i1
+        else:
+            i3, i4 = i1, i2
+    return i1, i2, i3, i4
+
+@jit(nopython=True, cache=True)
+def coupling_rhs(y, C, index):
+    """
+    Time derivative of the state y of a compartmental model with the
+    coupling constants C and the coupling indexes given by
+    coupling_index.
+    """
+    n = len(y)
+    dydt = np.zeros(n)
+    for k in range(len(C)):
+        i1, i2, i3, i4 = index[k, 0], index[k, 1], index[k, 2], index[k, 3]
+        v = C[k]
+        if i1 < n:
+            v *= y[i1]
+        if i2 < n:
+            v *= y[i2]
+        if i3 < n:
+            dydt[i3] -= v
+        if i4 < n:
+            dydt[i4] += v
+    return dydt
+
+@jit(nopython=True, cache=True)
+def coupling_jac(y, C, index):
+    """
+    Jacobian of coupling_rhs with respect to y.
+    """
+    n = len(y)
+    jac = np.zeros((n, n))
+    for k in range(len(C)):
+        i1, i2, i3, i4 = index[k, 0], index[k, 1], index[k, 2], index[k, 3]
+        for a, b in ((i1, i2), (i2, i1)):
+            if a < n:
+                d = C[k]*y[b] if b < n else C[k]
+                if i3 < n:
+                    jac[i3, a] -= d
+                if i4 < n:
+                    jac[i4, a] += d
+    return jac
+
+@jit(nopython=True, cache=True)
+def coupling_rhs_batch(y, C, index):
+    """
+    Time derivative of the state y of len(C) independent copies of a
+    compartmental model, one after the other, each with its own row of
+    coupling constants in C.
+    """
+    M = C.shape[0]
+    n = len(y) // M
+    dydt = np.empty(len(y))
+    for k in range(M):
+        dydt[k*n:(k+1)*n] = coupling_rhs(y[k*n:(k+1)*n], C[k], index)
+    return dydt
+
+@jit(nopython=True, cache=True)
+def coupling_jac_batch(y, C, index):
+    """
+    Jacobian of coupling_rhs_batch. It is block diagonal, and is given
+    in the packed banded form used by LSODA with lband = uband = n - 1
+    for n states in each copy, so that jac[n-1 + i - j, j] is the
+    derivative of the ith component with respect to the jth. LSODA
+    factorises it in place, so it needs another lband rows at the end.
+    """
+    M = C.shape[0]
+    n = len(y) // M
+    jac = np.zeros((3*n - 2, len(y)))
+    for k in range(M):
+        block = coupling_jac(y[k*n:(k+1)*n], C[k], index)
+        for i in range(n):
+            for j in range(n):
+                jac[n - 1 + i - j, k*n + j] = block[i, j]
+    return jac
+
+@jit(nopython=True, cache=True)
+def coupling_sens_rhs(z, C, dC, index):
+    """
+    Time derivative of the state y of a compartmental model together
+    with its sensitivities s_j = dy/dp_j to P parameters, laid out as
+    z = [y, s_1, ..., s_P], where dC[j] are the derivatives of the
+    coupling constants C with respect to p_j. The sensitivities follow
+    the forward sensitivity equations, ds_j/dt = J s_j + df/dp_j, and
+    since the right hand side is linear in the coupling constants,
+    df/dp_j is coupling_rhs with dC[j] in place of C.
+    """
+    P = dC.shape[0]
+    n = len(z) // (P + 1)
+    y = z[:n]
+    J = coupling_jac(y, C, index)
+    dzdt = np.empty(len(z))
+    dzdt[:n] = coupling_rhs(y, C, index)
+    for j in range(P):
+        dzdt[(j+1)*n:(j+2)*n] = np.dot(J, z[(j+1)*n:(j+2)*n]) + coupling_rhs(y, dC[j], index)
+    return dzdt
+
+@jit(nopython=True, cache=True)
+def coupling_sens_jac(z, C, dC, index):
+    """
+    Jacobian of coupling_sens_rhs with respect to z. The blocks on the
+    diagonal are the Jacobian J of the model, and the sensitivities
+    also depend on y through J, for the quadratic couplings, and
+    through df/dp_j.
+    """
+    P = dC.shape[0]
+    n = len(z) // (P + 1)
+    y = z[:n]
+    J = coupling_jac(y, C, index)
+    jac = np.zeros((len(z), len(z)))
+    for j in range(P + 1):
+        jac[j*n:(j+1)*n, j*n:(j+1)*n] = J
+    for j in range(P):
+        s = z[(j+1)*n:(j+2)*n]
+        block = coupling_jac(y, dC[j], index)
+        for k in range(len(C)):
+            i1, i2, i3, i4 = index[k, 0], index[k, 1], index[k, 2], index[k, 3]
+            if i1 < n and i2 < n:
+                for a, b in ((i1, i2), (i2, i1)):
+                    d = C[k]*s[a]
+                    if i3 < n:
+                        block[i3, b] -= d
+                    if i4 < n:
+                        block[i4, b] += d
+        jac[(j+1)*n:(j+2)*n, :n] = block
+    return jac
+
+def integrate_segment(method, fun, jac, t0, t1, y0, t, out, first_step=None, stop=None,
+                      **options):
+    """
+    Integrate dy/dt = fun(t, y) from t0 to t1 starting from y0 with the
+    given scipy solver class, writing the solution at the times t into
+    the rows of out, as solve_ivp would. If first_step is given the
+    integration starts with that step size rather than choosing one
+    afresh. If stop is given, it is called with the rows of out as they
+    are written, and returns for each whether to stop there, and the
+    integration stops at the first such row. Returns the state at t1,
+    or at the row where it stopped, the step size to continue with and
+    the number of rows of out written. Any other options are given to
+    the solver.
+    """
+    j = 0
+    while j < len(t) and t[j] <= t0:
+        out[j] = y0
+        j += 1
+    if t1 <= t0:
+        return y0, first_step, j
+
+    if first_step is not None:
+        first_step = min(first_step, t1 - t0)
+    solver = method(fun, t0, y0, t1, first_step=first_step, jac=jac, **options)
+
+    h = first_step
+    while solver.status == "running":
+        message = solver.step()
+        if solver.status == "failed":
+            raise RuntimeError(message)
+        ## the last step is cut short to land on t1, so remember
+        ## the one before
+        if solver.status == "running":
+            h = solver.step_size
+
+        k = np.searchsorted(t, solver.t, side="right")
+        if k > j:
+            out[j:k] = solver.dense_output()(t[j:k]).T
+            if stop is not None:
+                hit = np.flatnonzero(stop(out[j:k]))
+                if len(hit) > 0:
+                    k = j + hit[0] + 1
+                    return out[k-1], h, k
+            j = k
+
+    return solver.y, h, j
+
+class ODEModel(Model):
+    """
+    Base class for compartmental models integrated as ODEs. Subclasses
+    give their couplings as a list of descriptions, in the notation of
+    cpyment's CModel, and rates from the `_couplings` method. These
+    are parsed once for each class, and the right hand side and its
+    Jacobian are computed by compiled code.
+    """
+    ## the scipy solver to use, an implicit one because testing and
+    ## tracing can make the system stiff
+    method = LSODA
+    ## and its tolerances, those of odeint, much tighter than scipy's
+    ## defaults so that the ways of running the model agree closely
+    rtol = 1.49012e-8
+    atol = 1.49012e-8
+
+    def _cmodel(self, N):
+        states = list(o["name"] for o in self.observables)
+        cm = CModel(states)
+        for descr, C in self._couplings(N):
+            cm.set_coupling_rate(descr, C)
+        return cm
+
+    def _index(self):
+        """
+        The coupling indexes for this class, as given by coupling_index.
+        """
+        cls = type(self)
+        if "_coupling_index" not in cls.__dict__:
+            states = list(o["name"] for o in self.observables)
+            cls._coupling_index = np.array([coupling_index(descr, states)
+                                            for descr, _ in self._couplings(1)],
+                                           dtype=np.int64)
+        return cls._coupling_index
+
+    def run(self, t0, tmax, tsteps, state, out=None):
+        """
+        Run the model from t0 to tmax in tsteps steps, given the
+        starting model state.
+        """
+        params = dict((k, getattr(self, k)) for k in self.parameters)
+        return self.run_schedule([(t0, tmax, tsteps, None)], [params], state, out)
+
+    def run_schedule(self, segments, parameters, state, out=None):
+        """
+        Run the model through all of the segments, with the given
+        parameters in force during each, giving the same result as
+        calling `run` for each in turn. The schedule is compiled into
+        coupling constants for each segment. The integration stops at
+        the segment boundaries, so as not to step over a change in the
+        rates, but carries on from one to the next with the step size
+        it had reached.
+        """
+        y, N = state
+        index = self._index()
+
+        rates = []
+        for p in parameters:
+            self.set_parameters(**p)
+            rates.append(np.array([C for _, C in self._couplings(N)], dtype=np.float64))
+
+        t = np.hstack([np.linspace(ts, te, tsteps) for ts, te, tsteps, _ in segments])
+        traj = np.empty((len(t), len(self.observables))) if out is None else out
+
+        h = None
+        lo = 0
+        for (ts, te, tsteps, _), C in zip(segments, rates):
+            hi = lo + tsteps
+            fun = lambda t, y, C=C: coupling_rhs(y, C, index)
+            jac = lambda t, y, C=C: coupling_jac(y, C, index)
+            y, h, _ = integrate_segment(self.method, fun, jac, ts, te, y,
+                                     t[lo:hi], traj[lo:hi], h,
+                                     rtol=self.rtol, atol=self.atol)
+            lo = hi
+
+        return (t, traj, (np.array(y), N))
+
+    def _rate_derivatives(self, N, wrt):
+        """
+        Derivatives of the coupling constants with respect to the
+        parameters named in wrt, one row for each, computed with a
+        complex step, which is exact for the arithmetic expressions
+        that give the rates.
+        """
+        h = 1e-20
+        dC = np.empty((len(wrt), len(self._index())))
+        for j, k in enumerate(wrt):
+            p = getattr(self, k)
+            setattr(self, k, p + 1j*h)
+            dC[j] = [np.imag(C)/h for _, C in self._couplings(N)]
+            setattr(self, k, p)
+        return dC
+
+    def run_sensitivity(self, segments, parameters, state, wrt, out=None, sens=None):
+        """
+        Run the model through the segments as `run_schedule` does, and
+        also compute the sensitivity of the trajectory to the parameters
+        named in wrt by integrating the forward sensitivity equations
+        alongside it. The sensitivity is to a change in a parameter in
+        all of the segments, whether or not an intervention sets it.
+        Returns `(t, traj, sens, state)` where sens has the shape
+        `(len(t), columns, len(wrt))`, and is written into the given
+        array if there is one.
+        """
+        y, N = state
+        index = self._index()
+        n = len(y)
+        P = len(wrt)
+
+        rates = []
+        for p in parameters:
+            self.set_parameters(**p)
+            rates.append((np.array([C for _, C in self._couplings(N)], dtype=np.float64),
+                          self._rate_derivatives(N, wrt)))
+
+        t = np.hstack([np.linspace(ts, te, tsteps) for ts, te, tsteps, _ in segments])
+        traj = np.empty((len(t), n)) if out is None else out
+        if sens is None:
+            sens = np.empty((len(t), n, P))
+
+        ## the initial conditions do not depend on the parameters
+        z = np.concatenate([y, np.zeros(n*P)])
+        h = None
+        lo = 0
+        for (ts, te, tsteps, _), (C, dC) in zip(segments, rates):
+            hi = lo + tsteps
+            fun = lambda t, z, C=C, dC=dC: coupling_sens_rhs(z, C, dC, index)
+            jac = lambda t, z, C=C, dC=dC: coupling_sens_jac(z, C, dC, index)
+            zt = np.empty((tsteps, n*(P + 1)))
+            z, h, _ = integrate_segment(self.method, fun, jac, ts, te, z, t[lo:hi], zt, h,
+                                     rtol=self.rtol, atol=self.atol)
+            traj[lo:hi] = zt[:, :n]
+            sens[lo:hi] = zt[:, n:].reshape(tsteps, P, n).transpose(0, 2, 1)
+            lo = hi
+
+        return (t, traj, sens, (np.array(z[:n]), N))
+
+    def run_batch(self, segments, parameters, seeds, N, out=None, **init):
+        """
+        Run the model through the segments, with the parameters in
+        force during each, for as many samples as there are seeds. The
+        model is deterministic so the seeds themselves are not used, but
+        parameters may be sequences with one value for each sample, for
+        a parameter sweep. All of the samples are integrated together as
+        one system, whose Jacobian is block diagonal, with LSODA.
+        """
+        M = len(seeds)
+        y0, N = self.initial_conditions(N, **init)
+        index = self._index()
+        n = len(y0)
+
+        rates = []
+        for p in parameters:
+            self.set_parameters(**p)
+            rates.append(np.array([np.broadcast_to(C, M) for _, C in self._couplings(N)],
+                                  dtype=np.float64).T.copy())
+
+        t, _, _ = segment_grid(segments)
+        if out is None:
+            out = np.empty((M, len(t), n))
+
+        y = np.tile(y0, M)
+        h = None
+        lo = 0
+        for (ts, te, tsteps, _), C in zip(segments, rates):
+            hi = lo + tsteps
+            fun = lambda t, y, C=C: coupling_rhs_batch(y, C, index)
+            jac = lambda t, y, C=C: coupling_jac_batch(y, C, index)
+            traj = np.empty((tsteps, M*n))
+            y, h, _ = integrate_segment(LSODA, fun, jac, ts, te, y, t[lo:hi], traj, h,
+                                     lband=n-1, uband=n-1, rtol=self.rtol, atol=self.atol)
+            out[:, lo:hi] = traj.reshape(tsteps, M, n).transpose(1, 0, 2)
+            lo = hi
+
+        return t, out
+
+class SEIRCTODEMem(ODEModel):
     name = "SEIR-CT ODE"
     observables = yaml.load(yaml_seirct_obs, yaml.FullLoader)
 
@@ -55,7 +434,7 @@ class SEIRCTODEMem(Model):
         return (y0, N)
 
 
-    def _cmodel(self, N):
+    def _couplings(self, N):
         beta  = self.beta
         c     = self.c
         chi   = self.chi
@@ -65,66 +444,49 @@ class SEIRCTODEMem(Model):
         theta = self.theta
         kappa = self.kappa
 
-        states = list(o["name"] for o in self.observables)
-        cm = CModel(states)
-
-        cm.set_coupling_rate('SU*IU:SU=>EU', beta*c/N)
-        cm.set_coupling_rate('SD:SD=>SU', kappa)
+        return [
+            ('SU*IU:SU=>EU', beta*c/N),
+            ('SD:SD=>SU', kappa),
 
-        cm.set_coupling_rate('EU:EU=>IU', alpha)
-        cm.set_coupling_rate('ED:ED=>ID', alpha)
+            ('EU:EU=>IU', alpha),
+            ('ED:ED=>ID', alpha),
 
-        cm.set_coupling_rate('IU:IU=>RU', gamma)
-        cm.set_coupling_rate('ID:ID=>RD', gamma)
+            ('IU:IU=>RU', gamma),
+            ('ID:ID=>RD', gamma),
 
-        cm.set_coupling_rate('RD:RD=>RU', kappa)
+            ('RD:RD=>RU', kappa),
 
-        cm.set_coupling_rate('EU:EU=>ED', eta*chi*theta)
-        cm.set_coupling_rate('IU:IU=>ID', theta*(1+eta*chi))
+            ('EU:EU=>ED', eta*chi*theta),
+            ('IU:IU=>ID', theta*(1+eta*chi)),
 
-        # Now the stuff that depends on memory
-        cm.set_coupling_rate('IU*SU:=>CIS', c*(1-beta)/N)
-        cm.set_coupling_rate('IU*CIS:CIS=>', c*beta/N)
-        cm.set_coupling_rate('CIS:CIS=>', gamma+theta*eta*chi)
-        # cm.set_coupling_rate('IU*CIS:CIS=>CIE', c*beta/N)
-        # Quadratic terms currently removed. It's a bit hard to justify them
-        # theoretically even though heuristically they make sense
-        # cm.set_coupling_rate('CIS*CIS:CIS=>', chi*(1-(1-eta)**2)*theta/N)
+            # Now the stuff that depends on memory
+            ('IU*SU:=>CIS', c*(1-beta)/N),
+            ('IU*CIS:CIS=>', c*beta/N),
+            ('CIS:CIS=>', gamma+theta*eta*chi),
+            # ('IU*CIS:CIS=>CIE', c*beta/N),
+            # Quadratic terms currently removed. It's a bit hard to justify them
+            # theoretically even though heuristically they make sense
+            # ('CIS*CIS:CIS=>', chi*(1-(1-eta)**2)*theta/N),
 
-        # cm.set_coupling_rate('IU*SU:=>CIE', c*beta/N)
-        # cm.set_coupling_rate('IU*EU:=>CIE', c/N)
-        # cm.set_coupling_rate('CIE:CIE=>CII', alpha)
-        # cm.set_coupling_rate('CIE:CIE=>', gamma+theta*eta*chi)
+            # ('IU*SU:=>CIE', c*beta/N),
+            # ('IU*EU:=>CIE', c/N),
+            # ('CIE:CIE=>CII', alpha),
+            # ('CIE:CIE=>', gamma+theta*eta*chi),
 
-        # cm.set_coupling_rate('IU*IU:=>CII', c/N)
-        # cm.set_coupling_rate('CII:CII=>CIR', gamma)
-        # cm.set_coupling_rate('CII:CII=>', gamma+theta*(1+eta*chi))
+            # ('IU*IU:=>CII', c/N),
+            # ('CII:CII=>CIR', gamma),
+            # ('CII:CII=>', gamma+theta*(1+eta*chi)),
 
-        cm.set_coupling_rate('IU*RU:=>CIR', c/N)
-        cm.set_coupling_rate('IU:=>CIR', gamma)
-        cm.set_coupling_rate('CIR:CIR=>', gamma+theta*eta*chi)
-        # cm.set_coupling_rate('CIR*CIR:CIR=>', chi*(1-(1-eta)**2)*theta/N)
-
-        cm.set_coupling_rate('CIS:SU=>SD', chi*eta*theta)
-        # cm.set_coupling_rate('CIS*CIS:SU=>SD', chi*(1-(1-eta)**2)*theta/N)
-        cm.set_coupling_rate('CIR:RU=>RD', chi*eta*theta)
-        # cm.set_coupling_rate('CIR*CIR:RU=>RD', chi*(1-(1-eta)**2)*theta/N)
-
-        return cm
-
-    def run(self, t0, tmax, tsteps, state):
-        """
-        Run the model from t0 to tmax in tsteps steps, given the
-        starting model state.
-        """
-        y0, N = state
-        cm = self._cmodel(N)
-        t = np.linspace(t0, tmax, tsteps)
-
-        traj = cm.integrate(t, y0)
-
-        return (t, traj["y"], (traj["y"][-1, :], N))
+            ('IU*RU:=>CIR', c/N),
+            ('IU:=>CIR', gamma),
+            ('CIR:CIR=>', gamma+theta*eta*chi),
+            # ('CIR*CIR:CIR=>', chi*(1-(1-eta)**2)*theta/N),
 
+            ('CIS:SU=>SD', chi*eta*theta),
+            # ('CIS*CIS:SU=>SD', chi*(1-(1-eta)**2)*theta/N),
+            ('CIR:RU=>RD', chi*eta*theta),
+            # ('CIR*CIR:RU=>RD', chi*(1-(1-eta)**2)*theta/N),
+        ]
 
 
 yaml_seir_obs = """
@@ -138,7 +500,7 @@ yaml_seir_obs = """
   descr: removed and unconfined
 """
 
-class SEIRODE(Model):
+class SEIRODE(ODEModel):
     name = "SEIR ODE"
     observables = yaml.load(yaml_seir_obs, yaml.FullLoader)
 
@@ -163,33 +525,17 @@ class SEIRODE(Model):
         return (y0, N)
 
 
-    def _cmodel(self, N):
+    def _couplings(self, N):
         beta  = self.beta
         c     = self.c
         alpha = self.alpha
         gamma = self.gamma
 
-        states = list(o["name"] for o in self.observables)
-        cm = CModel(states)
-
-        cm.set_coupling_rate('SU*IU:SU=>EU', beta*c/N)
-        cm.set_coupling_rate('EU:EU=>IU', alpha)
-        cm.set_coupling_rate('IU:IU=>RU', gamma)
-
-        return cm
-
-    def run(self, t0, tmax, tsteps, state):
-        """
-        Run the model from t0 to tmax in tsteps steps, given the
-        starting model state.
-        """
-        y0, N = state
-        cm = self._cmodel(N)
-        t = np.linspace(t0, tmax, tsteps)
-
-        traj = cm.integrate(t, y0)
-
-        return (t, traj["y"], (traj["y"][-1, :], N))
+        return [
+            ('SU*IU:SU=>EU', beta*c/N),
+            ('EU:EU=>IU', alpha),
+            ('IU:IU=>RU', gamma),
+        ]
 
 
     def fit_beta(self, N, init, data):
@@ -0,0 +1,112 @@
+__all__ = ['SEIRCTSDE']
+
+import numpy as np
+import yaml
+from numba import jit, prange
+from ptti.seirct_ode import SEIRCTODEMem
+from ptti.seirct_stochastic import SEIRCTStochastic
+
+@jit(nopython=True, cache=True)
+def cle_step(y, C, index, h):
+    """
+    One Euler-Maruyama step of length h of the chemical Langevin
+    equation of a compartmental model with the coupling constants C and
+    the coupling indexes given by coupling_index. Each coupling moves
+    its propensity a times h, plus a normal deviate with variance a h,
+    from one state to another. The propensities are those at the start
+    of the step, and the amounts moved are limited so that no state
+    goes negative. The state y is updated in place.
+    """
+    n = len(y)
+    a = np.empty(len(C))
+    for k in range(len(C)):
+        i1, i2 = index[k, 0], index[k, 1]
+        v = C[k]
+        if i1 < n:
+            v *= max(y[i1], 0.0)
+        if i2 < n:
+            v *= max(y[i2], 0.0)
+        a[k] = v
+
+    for k in range(len(C)):
+        if a[k] <= 0:
+            continue
+        i3, i4 = index[k, 2], index[k, 3]
+        d = a[k]*h + np.sqrt(a[k]*h)*np.random.standard_normal()
+        if i3 < n:
+            d = min(d, y[i3])
+        if i4 < n:
+            d = max(d, -y[i4])
+        if i3 < n:
+            y[i3] -= d
+        if i4 < n:
+            y[i4] += d
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def cle_batch(y0, seeds, tgrid, segstart, segtime, C, index, dt, out):
+    """
+    Integrate the chemical Langevin equation for many samples at once,
+    from the initial states y0, of shape (samples, states), with the
+    Euler-Maruyama method and time step dt, through the segments given
+    by segstart, the index in tgrid of the first output time of each
+    segment, and segtime, the start and end time of each. The coupling
+    constants in force during each segment are C[k, s] for sample k and
+    segment s. The states at the output times tgrid are written into out,
+    of shape (samples, len(tgrid), states).
+
+    Each sample uses its own random number stream, seeded from its seed,
+    and reseeded for every segment, so that it gives the same result
+    when integrated on its own, one segment at a time. Returns the
+    final states and the seeds to continue with.
+    """
+    M = y0.shape[0]
+    tsteps = len(tgrid)
+    nseg = len(segstart)
+    y = y0.copy()
+    nseeds = seeds.copy()
+
+    for k in prange(M):
+        for s in range(nseg):
+            np.random.seed(nseeds[k])
+            lo = segstart[s]
+            hi = segstart[s+1] if s + 1 < nseg else tsteps
+            t = segtime[s, 0]
+            for j in range(lo, hi + 1):
+                tend = tgrid[j] if j < hi else segtime[s, 1]
+                while t < tend:
+                    h = min(dt, tend - t)
+                    cle_step(y[k], C[k, s], index, h)
+                    t += h
+                if j < hi:
+                    out[k, j] = y[k]
+            nseeds[k] = np.random.randint(0, 2**31 - 1)
+
+    return y, nseeds
+
+
+yaml_sde_params = """
+dt:
+  descr:   Euler-Maruyama time step
+  default: 0.1
+"""
+
+class SEIRCTSDE(SEIRCTStochastic):
+    """
+    Stochastic version of SEIRCTODEMem as a chemical Langevin equation:
+    each coupling of the ODE model also adds noise with variance equal
+    to its rate. It is integrated with the Euler-Maruyama method, with
+    time step `dt`, so the cost does not depend on the size of the
+    population, and many samples are integrated together by
+    `runModelBatch`. It is a good approximation when the compartments
+    are large, but with only a few infectious individuals it much
+    underestimates the chance that the outbreak dies out, for which
+    SEIRCTHybrid or the agent-based models are better.
+    """
+    name = "SEIR-CT SDE"
+    parameters = dict(SEIRCTODEMem.parameters, **yaml.load(yaml_sde_params, yaml.FullLoader))
+
+    kernel = staticmethod(cle_batch)
+
+    def _extra(self):
+        return self.dt
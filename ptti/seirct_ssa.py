@@ -0,0 +1,141 @@
+__all__ = ['SEIRCTSSA']
+
+import numpy as np
+from numba import jit, prange
+from ptti.seirct_stochastic import SEIRCTStochastic
+
+def coupling_deps(index, n):
+    """
+    The dependency graph of the couplings with the given indexes, for
+    a model with n states: for each coupling, the couplings whose rates
+    change when it happens. It is returned in compressed form, as the
+    arrays (ptr, deps), with the dependents of coupling k given by
+    deps[ptr[k]:ptr[k+1]].
+    """
+    ptr, deps = [0], []
+    for k in range(len(index)):
+        changed = set(i for i in index[k, 2:] if i < n)
+        deps.extend(l for l in range(len(index)) if changed.intersection(index[l, :3]))
+        ptr.append(len(deps))
+    return np.array(ptr, dtype=np.int64), np.array(deps, dtype=np.int64)
+
+@jit(nopython=True, cache=True)
+def coupling_propensity(y, C, index, k):
+    """
+    The rate of coupling k, as for coupling_rhs, except that it is zero
+    when there is nobody in the state that it takes from.
+    """
+    n = len(y)
+    i1, i2, i3 = index[k, 0], index[k, 1], index[k, 2]
+    if i3 < n and y[i3] < 1:
+        return 0.0
+    v = C[k]
+    if i1 < n:
+        v *= y[i1]
+    if i2 < n:
+        v *= y[i2]
+    return v
+
+@jit(nopython=True, cache=True)
+def coupling_ssa(t, tgrid, tmax, y, C, index, deps, out):
+    """
+    Simulate a compartmental model with the coupling constants C and
+    the coupling indexes given by coupling_index exactly, with
+    Gillespie's direct method, from time t to tmax. Each time a
+    coupling happens, one individual is taken from one state and added
+    to another, and only the rates of the couplings that depend on
+    them, given by coupling_deps, are recomputed, so that the cost of
+    each event does not depend on the size of the population. The state
+    y, of whole numbers, is updated in place and its values at the times
+    in tgrid are written into out. Returns the time reached.
+    """
+    n = len(y)
+    ptr, dep = deps
+    a = np.empty(len(C))
+    for k in range(len(C)):
+        a[k] = coupling_propensity(y, C, index, k)
+
+    j = 0
+    while True:
+        total = np.sum(a)
+        tnext = t + np.random.exponential(1.0/total) if total > 0 else np.inf
+
+        # the state holds until the next event
+        while j < len(tgrid) and tgrid[j] < min(tnext, tmax):
+            out[j] = y
+            j += 1
+        if tnext > tmax:
+            break
+        t = tnext
+
+        # choose which coupling happens
+        r = np.random.random()*total
+        k = 0
+        while k < len(a) - 1 and r >= a[k]:
+            r -= a[k]
+            k += 1
+
+        i3, i4 = index[k, 2], index[k, 3]
+        if i3 < n:
+            y[i3] -= 1
+        if i4 < n:
+            y[i4] += 1
+        for d in range(ptr[k], ptr[k+1]):
+            a[dep[d]] = coupling_propensity(y, C, index, dep[d])
+
+    while j < len(tgrid):
+        out[j] = y
+        j += 1
+    return tmax
+
+@jit(nopython=True, parallel=True, cache=True)
+def ssa_batch(y0, seeds, tgrid, segstart, segtime, C, index, deps, out):
+    """
+    Simulate many samples at once with coupling_ssa, from the initial
+    states y0, of shape (samples, states), through the segments given
+    by segstart, the index in tgrid of the first output time of each
+    segment, and segtime, the start and end time of each. The coupling
+    constants in force during each segment are C[k, s] for sample k and
+    segment s. The states at the output times tgrid are written into out,
+    of shape (samples, len(tgrid), states).
+
+    Each sample uses its own random number stream, seeded from its seed,
+    and reseeded for every segment, so that it gives the same result
+    when simulated on its own, one segment at a time. Returns the
+    final states and the seeds to continue with.
+    """
+    M = y0.shape[0]
+    tsteps = len(tgrid)
+    nseg = len(segstart)
+    y = y0.copy()
+    nseeds = seeds.copy()
+
+    for k in prange(M):
+        for s in range(nseg):
+            np.random.seed(nseeds[k])
+            lo = segstart[s]
+            hi = segstart[s+1] if s + 1 < nseg else tsteps
+            coupling_ssa(segtime[s, 0], tgrid[lo:hi], segtime[s, 1], y[k],
+                         C[k, s], index, deps, out[k, lo:hi])
+            nseeds[k] = np.random.randint(0, 2**31 - 1)
+
+    return y, nseeds
+
+
+class SEIRCTSSA(SEIRCTStochastic):
+    """
+    Exact stochastic version of SEIRCTODEMem at the level of the
+    population. The couplings of the ODE model are taken as the rates
+    of events that move one individual, or contact, from one state to
+    another, and simulated with Gillespie's direct method. Unlike the
+    agent-based models, the cost of each event does not depend on the
+    size of the population, and many samples are simulated together by
+    `runModelBatch`.
+    """
+    name = "SEIR-CT SSA"
+
+    kernel = staticmethod(ssa_batch)
+    whole = True
+
+    def _extra(self):
+        return coupling_deps(self._index(), len(self.observables))
@@ -0,0 +1,97 @@
+__all__ = ['SEIRCTStochastic']
+
+import numpy as np
+from ptti.model import Unimplemented, segment_grid
+from ptti.seirct_ode import SEIRCTODEMem
+
+class SEIRCTStochastic(SEIRCTODEMem):
+    """
+    Base for stochastic versions of SEIRCTODEMem that simulate its
+    couplings with a numba `kernel` for many samples at once, called as
+
+        y, seeds = kernel(y0, seeds, t, segstart, segtime, C, index, extra, out)
+
+    from the initial states y0, of shape (samples, states), through the
+    segments given by `segment_grid`, with the coupling constants C[k, s]
+    of sample k in segment s. The argument extra is particular to the
+    kernel, and given by `_extra`. The states at the times t are written
+    into out, and the final states and the seeds to continue with are
+    returned. Each sample has its own random number stream, reseeded
+    for every segment, so that a batch gives the same as single runs.
+    """
+    ## the ODE ways of running do not apply
+    run_schedule = None
+    run_sensitivity = None
+
+    ## the kernel, and whether the state is of whole individuals
+    kernel = None
+    whole = False
+
+    def _extra(self):
+        raise Unimplemented("[{}] _extra".format(self.name))
+
+    def initial_conditions(self, N, **o):
+        """
+        Populate the initial conditions as for SEIRCTODEMem. The random
+        number stream is seeded from numpy's global generator, so it
+        follows the seed given to runModel.
+        """
+        y0, N = SEIRCTODEMem.initial_conditions(self, N, **o)
+        if self.whole:
+            y0 = np.round(y0)
+        return (y0, N, np.random.randint(0, 2**31 - 1))
+
+    def _rates(self, parameters, N, M):
+        """
+        The coupling constants for M samples in each segment, with
+        shape (M, len(parameters), couplings).
+        """
+        rates = []
+        for p in parameters:
+            self.set_parameters(**p)
+            rates.append(np.array([np.broadcast_to(C, M) for _, C in self._couplings(N)],
+                                  dtype=np.float64).T)
+        return np.ascontiguousarray(np.array(rates).transpose(1, 0, 2))
+
+    def run(self, t0, tmax, tsteps, state, out=None):
+        """
+        Run the model from t0 to tmax in tsteps steps, given the
+        starting model state.
+        """
+        y, N, seed = state
+        params = dict((k, getattr(self, k)) for k in self.parameters)
+
+        t, segstart, segtime = segment_grid([(t0, tmax, tsteps, None)])
+        traj = np.empty((1, tsteps, len(y)))
+        y, seeds = self.kernel(y.reshape(1, -1), np.array([seed], dtype=np.int64), t,
+                               segstart, segtime, self._rates([params], N, 1),
+                               self._index(), self._extra(), traj)
+        if out is not None:
+            out[:] = traj[0]
+        else:
+            out = traj[0]
+
+        return (t, out, (y[0], N, seeds[0]))
+
+    def run_batch(self, segments, parameters, seeds, N, out=None, **init):
+        """
+        Run one sample for each of seeds through the given segments,
+        with the given parameters in each, in parallel threads. Sample i
+        gets the same random number stream as `runModel` with seed
+        `seeds[i]` would give it, so the result is the same. Parameters
+        may be sequences with one value for each sample.
+        """
+        M = len(seeds)
+
+        ## seed each sample as initial_conditions would
+        rseeds = np.zeros(M, dtype=np.int64)
+        for i, seed in enumerate(seeds):
+            np.random.seed(seed)
+            y0, N, rseeds[i] = self.initial_conditions(N, **init)
+
+        t, segstart, segtime = segment_grid(segments)
+        if out is None:
+            out = np.empty((M, len(t), len(y0)))
+        self.kernel(np.tile(y0, (M, 1)), rseeds, t, segstart, segtime,
+                    self._rates(parameters, N, M), self._index(), self._extra(), out)
+        return t, out
@@ -5,7 +5,7 @@
 ###
 
 from ptti.config import config_load
-from ptti.model import runModel
+from ptti.model import runModel, runModelBatch
 from ptti.seirct_ode import SEIRCTODEMem
 from ptti.seirct_abm import SEIRCTABM
 
@@ -52,21 +52,24 @@ def figure_testing():
 
 def figure_c_testing():
     model = SEIRCTODEMem
-    with open("c-testing.tsv", "w") as fp:
-        for theta in np.linspace(0.0, 0.55, 25):
-            for c in np.linspace(0.0, 20.0, 25):
-                log.info("Figure: c testing -- theta = {}, c = {}".format(theta, c))
+    thetas = np.linspace(0.0, 0.55, 25)
+    cs = np.linspace(0.0, 20.0, 25)
+    theta, c = np.meshgrid(thetas, cs, indexing="ij")
+    log.info("Figure: c testing -- {} values of theta and c".format(theta.size))
 
-                cfg = basic_config()
-                cfg["meta"]["model"] = model
-                cfg["parameters"]["theta"] = theta
-                cfg["parameters"]["c"] = c
+    cfg = basic_config()
+    cfg["meta"]["model"] = model
+    cfg["parameters"]["theta"] = theta.ravel()
+    cfg["parameters"]["c"] = c.ravel()
 
-                t, traj = runModel(**cfg["meta"], **cfg)
+    t, trajs = runModelBatch(**cfg["meta"], **cfg)
 
-                R30 = traj[30, -1]
+    R30 = trajs[:, 30, -1].reshape(theta.shape)
 
-                line = "%e\t%e\t%e\n" % (theta, c, R30)
+    with open("c-testing.tsv", "w") as fp:
+        for i, th in enumerate(thetas):
+            for j, cc in enumerate(cs):
+                line = "%e\t%e\t%e\n" % (th, cc, R30[i, j])
                 fp.write(line)
             fp.write("\n")
 
@@ -100,22 +103,25 @@ def figure_tracing():
 
 def figure_testing_tracing():
     model = SEIRCTODEMem
-    with open("testing-tracing.tsv", "w") as fp:
-        for theta in np.linspace(0.0, 0.55, 25):
-            for eta in np.linspace(0.0, 1.0, 25):
-                log.info("Figure: testing tracing -- theta = {}, eta = {}".format(theta, eta))
+    thetas = np.linspace(0.0, 0.55, 25)
+    etas = np.linspace(0.0, 1.0, 25)
+    theta, eta = np.meshgrid(thetas, etas, indexing="ij")
+    log.info("Figure: testing tracing -- {} values of theta and eta".format(theta.size))
 
-                cfg = basic_config()
-                cfg["meta"]["model"] = model
-                cfg["parameters"]["theta"] = theta
-                cfg["parameters"]["eta"] = eta
-                cfg["parameters"]["chi"] = 0.5
+    cfg = basic_config()
+    cfg["meta"]["model"] = model
+    cfg["parameters"]["theta"] = theta.ravel()
+    cfg["parameters"]["eta"] = eta.ravel()
+    cfg["parameters"]["chi"] = 0.5
 
-                t, traj = runModel(**cfg["meta"], **cfg)
+    t, trajs = runModelBatch(**cfg["meta"], **cfg)
 
-                R30 = traj[30, -1]
+    R30 = trajs[:, 30, -1].reshape(theta.shape)
 
-                line = "%e\t%e\t%e\n" % (theta, eta, R30)
+    with open("testing-tracing.tsv", "w") as fp:
+        for i, th in enumerate(thetas):
+            for j, et in enumerate(etas):
+                line = "%e\t%e\t%e\n" % (th, et, R30[i, j])
                 fp.write(line)
             fp.write("\n")
 
@@ -61,13 +61,20 @@ setup(name='ptti',
       entry_points={
           'console_scripts': [
               'ptti = ptti.command:command',
-              'ptti-compare = ptti.command:compare'
+              'ptti-compare = ptti.command:compare',
+              'ptti-scenarios = ptti.command:scenarios'
           ],
           'models': [
               'SEIRODE      = ptti.seirct_ode:SEIRODE',
               'SEIRCTABM    = ptti.seirct_abm:SEIRCTABM',
+              'SEIRCTABMTau = ptti.seirct_abm:SEIRCTABMTau',
+              'SEIRCTABMNRM = ptti.seirct_nrm:SEIRCTABMNRM',
+              'SEIRCTNet    = ptti.seirct_net:SEIRCTNet',
               'SEIRCTODEMem = ptti.seirct_ode:SEIRCTODEMem',
               'SEIRCTKappa  = ptti.seirct_kappa:SEIRCTKappa',
+              'SEIRCTHybrid = ptti.seirct_hybrid:SEIRCTHybrid',
+              'SEIRCTSDE    = ptti.seirct_sde:SEIRCTSDE',
+              'SEIRCTSSA    = ptti.seirct_ssa:SEIRCTSSA',
           ]
       },
       package_data={
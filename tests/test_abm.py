@@ -0,0 +1,68 @@
+"""
+Tests of the agent-based models. The approximate and alternative
+simulations are checked against the exact SEIRCTABM: the population is
+conserved, and over a set of seeded samples the mean final number of
+removed agrees to within a few standard errors.
+"""
+import functools
+import numpy as np
+from ptti.model import runModel
+from ptti.seirct_abm import SEIRCTABM, SEIRCTABMTau
+from ptti.seirct_net import SEIRCTNet
+from ptti.seirct_nrm import SEIRCTABMNRM
+
+params = {"theta": 0.1, "eta": 0.5, "chi": 0.25}
+interventions = [{"time": 40, "parameters": {"c": 6}}]
+
+def samples(model, initial, n=40, **parameters):
+    return np.array([runModel(model, 0, 100, 100, dict(params, **parameters), initial,
+                              interventions, rseries=False, seed=s)[1]
+                     for s in range(n)])
+
+@functools.lru_cache(maxsize=None)
+def exact(N, IU):
+    return samples(SEIRCTABM, {"N": N, "IU": IU})
+
+def removed(model, trajs):
+    return trajs[:, -1, [model.colindex("RU"), model.colindex("RD")]].sum(axis=1)
+
+def assert_conserved(model, trajs, N):
+    assert np.all(trajs[:, :, list(model().pcols)].sum(axis=2) == N)
+
+def assert_agree(a, b, k=4):
+    se = np.sqrt(np.var(a)/len(a) + np.var(b)/len(b))
+    assert abs(np.mean(a) - np.mean(b)) < k*se
+
+def test_tau_leaping():
+    ## large enough that most of the simulation is in leaps
+    trajs = samples(SEIRCTABMTau, {"N": 20000, "IU": 200}, epsilon=0.03)
+    assert_conserved(SEIRCTABMTau, trajs, 20000)
+    assert_agree(removed(SEIRCTABMTau, trajs), removed(SEIRCTABM, exact(20000, 200)))
+
+def test_network_dense():
+    ## on a dense network everyone is nearly everyone's neighbour, as
+    ## in the well mixed model
+    trajs = samples(SEIRCTNet, {"N": 2000, "IU": 20, "k": 1999})
+    assert_conserved(SEIRCTNet, trajs, 2000)
+    assert_agree(removed(SEIRCTNet, trajs), removed(SEIRCTABM, exact(2000, 20)))
+
+def test_network_empty():
+    ## without edges nobody can be infected
+    trajs = samples(SEIRCTNet, {"N": 2000, "IU": 20, "k": 0}, n=5)
+    assert_conserved(SEIRCTNet, trajs, 2000)
+    assert np.all(removed(SEIRCTNet, trajs) == 20)
+
+def test_next_reaction():
+    ## with exponential durations it is the same model
+    trajs = samples(SEIRCTABMNRM, {"N": 2000, "IU": 20})
+    assert_conserved(SEIRCTABMNRM, trajs, 2000)
+    assert_agree(removed(SEIRCTABMNRM, trajs), removed(SEIRCTABM, exact(2000, 20)))
+
+def test_next_reaction_shape():
+    ## an intervention that only changes the shape of the durations
+    ## still changes the pending timers
+    a, b = (runModel(SEIRCTABMNRM, 0, 100, 100, params, {"N": 2000, "IU": 20},
+                     [{"time": 10, "parameters": {"gamma_k": k}}], rseries=False)[1]
+            for k in (1.0, 4.0))
+    assert np.all(a[:10] == b[:10])
+    assert np.any(a[10:] != b[10:])
@@ -0,0 +1,51 @@
+"""
+Tests of the on-disk cache of results.
+"""
+import numpy as np
+from ptti.cache import ResultCache
+from ptti.model import runModel
+from ptti.seirct_abm import SEIRCTABM
+
+params = {"theta": 0.1, "eta": 0.5, "chi": 0.25}
+initial = {"N": 1000, "IU": 10}
+
+def test_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    t, traj = cache.runModel(SEIRCTABM, 0, 100, 100, params, initial, seed=3)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    ## a new cache on the same directory finds it
+    cache = ResultCache(str(tmp_path))
+    ct, ctraj = cache.runModel(SEIRCTABM, 0, 100, 100, params, initial, seed=3)
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert np.array_equal(t, ct) and np.array_equal(traj, ctraj)
+
+    ## and it is what runModel gives
+    rt, rtraj = runModel(SEIRCTABM, 0, 100, 100, params, initial, seed=3)
+    assert np.array_equal(traj, rtraj)
+
+def test_key(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    key = cache.key(SEIRCTABM, 0, 100, 100, params, initial, seed=3)
+    ## the order of the configuration does not matter, the seed does
+    assert key == cache.key(SEIRCTABM, 0, 100, 100, dict(reversed(list(params.items()))),
+                            initial, seed=3)
+    assert key != cache.key(SEIRCTABM, 0, 100, 100, params, initial, seed=4)
+    ## and neither does anything that does not determine the result
+    assert key == cache.key(SEIRCTABM, 0, 100, 100, params, initial, seed=3, output="out")
+
+def test_evict(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    t, traj = np.arange(1000.0), np.random.RandomState(0).random_sample((1000, 10))
+    cache.put("a", t, traj)
+    size = cache.size
+
+    ## room for two results, so the least recently used goes
+    cache = ResultCache(str(tmp_path), maxsize=2*size + size//2)
+    cache.put("b", t, traj)
+    cache.get("a")
+    cache.put("c", t, traj)
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert cache.size <= cache.maxsize
@@ -0,0 +1,40 @@
+"""
+Tests of the hybrid agent-based and ODE model.
+"""
+import logging
+import numpy as np
+from ptti.model import runModel
+from ptti.seirct_abm import SEIRCTABM
+from ptti.seirct_hybrid import SEIRCTHybrid
+
+from test_abm import params, interventions, samples, exact, removed, assert_conserved, assert_agree
+
+def test_memory():
+    ## at the size of the UK only the infectious are individuals
+    state = SEIRCTHybrid().initial_conditions(N=67886011, IU=100)
+    a = state.abm
+    arrays = (a.agents, a.tpool, a.tpos) + a.pools + a.contacts
+    assert sum(x.nbytes for x in arrays) < 2**20
+    assert a.observe()[:8].sum() == 67886011
+
+def test_handover(caplog):
+    ## up to the ODE and back down to agents when a lockdown works
+    caplog.set_level(logging.INFO, logger="ptti.seirct_hybrid")
+    t, traj = runModel(SEIRCTHybrid, 0, 150, 150,
+                       dict(params, threshold=400, threshold_down=100),
+                       {"N": 20000, "IU": 100}, [{"time": 30, "parameters": {"c": 2}}],
+                       rseries=False, seed=1)
+    up, down = (r for r in caplog.records if r.name == "ptti.seirct_hybrid")
+    assert up.message.startswith("Switching to ODE")
+    assert down.message.startswith("Switching to agents")
+    assert np.allclose(traj[:, :8].sum(axis=1), 20000)
+
+    ## after going back to agents the counts are whole again
+    tdown = float(down.message.split()[-1])
+    assert np.all(traj[t > tdown, :8] == np.round(traj[t > tdown, :8]))
+
+def test_agents():
+    ## below the threshold it is the agent-based model
+    trajs = samples(SEIRCTHybrid, {"N": 2000, "IU": 20}, threshold=2001)
+    assert_conserved(SEIRCTHybrid, trajs, 2000)
+    assert_agree(removed(SEIRCTHybrid, trajs), removed(SEIRCTABM, exact(2000, 20)))
@@ -0,0 +1,55 @@
+"""
+Tests of the Kappa model, simulated in process by KappaSystem, and
+checked against KaSim where kappy is installed.
+"""
+import numpy as np
+import pytest
+from ptti.model import runModel, segments, schedule
+from ptti.seirct_kappa import SEIRCTKappa
+
+from test_abm import params, interventions, samples, removed, assert_conserved, assert_agree
+
+initial = {"N": 2000, "IU": 20}
+
+class KaSim(SEIRCTKappa):
+    ## the docstring is the header of the Kappa text
+    __doc__ = SEIRCTKappa.__doc__
+    kasim = True
+
+def test_native():
+    trajs = samples(SEIRCTKappa, initial, n=10)
+    assert_conserved(SEIRCTKappa, trajs, 2000)
+    assert np.all(trajs == np.round(trajs))
+
+def test_seed():
+    ## the same seed gives the same sample, and a different one does not
+    a, b, c = (runModel(SEIRCTKappa, 0, 100, 100, params, initial, interventions,
+                        rseries=False, seed=s)[1]
+               for s in (1, 1, 2))
+    assert np.all(a == b)
+    assert np.any(a != c)
+
+def test_schedule():
+    ## the whole schedule in one go is the same as a segment at a time
+    _, traj = runModel(SEIRCTKappa, 0, 100, 100, params, initial, interventions,
+                       rseries=False, seed=1)
+
+    np.random.seed(1)
+    m = SEIRCTKappa()
+    m.set_parameters(**params)
+    state = m.initial_conditions(**initial)
+    segs = segments(0, 100, 100, interventions)
+    rows = []
+    for (ts, te, tsteps, pi), p in zip(segs, schedule(m, segs)):
+        m.set_parameters(**p)
+        _, obs, state = m.run(ts, te, tsteps, state)
+        rows.append(obs)
+
+    assert np.all(traj == np.vstack(rows))
+
+def test_kasim():
+    pytest.importorskip("kappy")
+    ## KaSim is slow, so few samples
+    trajs = samples(KaSim, initial, n=10)
+    assert_conserved(KaSim, trajs, 2000)
+    assert_agree(removed(KaSim, trajs), removed(SEIRCTKappa, samples(SEIRCTKappa, initial)))
@@ -0,0 +1,30 @@
+"""
+Tests of the generic machinery for running models.
+"""
+import numpy as np
+from ptti.model import runModel, segments, schedule, advance
+from ptti.seirct_abm import SEIRCTABM
+from ptti.seirct_ode import SEIRODE
+
+class Scheduled(SEIRCTABM):
+    def run_schedule(self, segments, parameters, state, out=None):
+        raise AssertionError("simulated from an absorbing state")
+
+def test_absorbed_schedule():
+    ## a model that runs the whole schedule is not run once absorbed
+    m = Scheduled()
+    segs = segments(0, 10, 10, [{"time": 5, "parameters": {"c": 1}}])
+    params = schedule(m, segs)
+    last = np.zeros(9)
+    last[[m.colindex("SU"), m.colindex("RU")]] = (90, 10)
+    t, out = np.empty(10), np.empty((10, 9))
+    advance(m, segs, params, None, t, out, last)
+    assert np.all(out == last)
+
+def test_extinction():
+    t, traj = runModel(SEIRCTABM, 0, 100, 100, {"theta": 1.0}, {"N": 100, "IU": 1}, rseries=False)
+    assert SEIRCTABM().extinction(t, traj) is not None
+
+def test_extinction_without_columns():
+    t, traj = runModel(SEIRODE, 0, 100, 100, {}, {"N": 100, "IU": 1}, rseries=False)
+    assert SEIRODE().extinction(t, traj) is None
@@ -0,0 +1,39 @@
+"""
+Tests of the ODE models: the different ways of integrating them give
+the same results to within the tolerance of the solver.
+"""
+import numpy as np
+from ptti.model import runModel, runModelBatch, segments, schedule
+from ptti.seirct_ode import SEIRCTODEMem
+
+params = {"theta": 0.1, "eta": 0.5, "chi": 0.25}
+initial = {"N": 10000, "IU": 10}
+interventions = [{"time": 30, "parameters": {"c": 4}},
+                 {"time": 60, "parameters": {"theta": 0.3, "chi": 0.5}},
+                 {"time": 100, "parameters": {"c": 13}}]
+
+def test_schedule():
+    ## the whole schedule in one go is the same as a segment at a time
+    t, traj = runModel(SEIRCTODEMem, 0, 200, 200, params, initial, interventions, rseries=False)
+
+    m = SEIRCTODEMem()
+    m.set_parameters(**params)
+    state = m.initial_conditions(**initial)
+    segs = segments(0, 200, 200, interventions)
+    rows = []
+    for (ts, te, tsteps, pi), p in zip(segs, schedule(m, segs)):
+        m.set_parameters(**p)
+        _, obs, state = m.run(ts, te, tsteps, state)
+        rows.append(obs)
+
+    assert np.allclose(traj, np.vstack(rows), rtol=1e-6, atol=1e-6)
+
+def test_batch():
+    ## a sweep integrated as one system is the same as single runs
+    theta = np.array([0.0, 0.1, 0.3])
+    t, trajs = runModelBatch(SEIRCTODEMem, 0, 200, 200, dict(params, theta=theta), initial,
+                             interventions, rseries=False)
+    for k in range(len(theta)):
+        _, traj = runModel(SEIRCTODEMem, 0, 200, 200, dict(params, theta=theta[k]), initial,
+                           interventions, rseries=False)
+        assert np.allclose(trajs[k], traj, rtol=1e-6, atol=1e-6)
@@ -0,0 +1,30 @@
+"""
+Tests of running scenarios that share their beginning as a tree: each
+gives the same as running it on its own.
+"""
+import numpy as np
+from ptti.model import runModel, runScenarios
+from ptti.seirct_abm import SEIRCTABM
+from ptti.seirct_ode import SEIRCTODEMem
+
+def scenarios(model):
+    base = {"model": model, "t0": 0, "tmax": 150, "steps": 150, "seed": 2,
+            "parameters": {"theta": 0.1, "eta": 0.5, "chi": 0.25},
+            "initial": {"N": 5000, "IU": 20}}
+    lockdown = {"time": 30, "parameters": {"c": 4}}
+    return [dict(base, interventions=[lockdown, {"time": t, "parameters": {"c": 13}}])
+            for t in (60, 90, 120)] + [dict(base, interventions=[]), dict(base, seed=3)]
+
+def test_stochastic():
+    ## the state is copied where they part, so each branch continues
+    ## the same sample exactly
+    for sc, (t, traj) in zip(scenarios(SEIRCTABM), runScenarios(scenarios(SEIRCTABM))):
+        rt, rtraj = runModel(**sc)
+        assert np.array_equal(t, rt)
+        assert np.array_equal(traj, rtraj)
+
+def test_deterministic():
+    for sc, (t, traj) in zip(scenarios(SEIRCTODEMem), runScenarios(scenarios(SEIRCTODEMem))):
+        rt, rtraj = runModel(**sc)
+        assert np.array_equal(t, rt)
+        assert np.allclose(traj, rtraj, rtol=1e-6, atol=1e-6)
@@ -0,0 +1,57 @@
+"""
+Tests of the stochastic population models. In a large population their
+mean is close to the ODE, SEIRCTODEMem, and the samples run in a batch
+are the same as those run one at a time.
+"""
+import numpy as np
+import pytest
+from ptti.model import Unimplemented, runModel, runModelBatch
+from ptti.seirct_ode import SEIRCTODEMem
+from ptti.seirct_sde import SEIRCTSDE
+from ptti.seirct_ssa import SEIRCTSSA
+from ptti.seirct_stochastic import SEIRCTStochastic
+
+params = {"theta": 0.1, "eta": 0.5, "chi": 0.25}
+initial = {"N": 20000, "IU": 200}
+interventions = [{"time": 40, "parameters": {"c": 6}}]
+seeds = list(range(20))
+
+def batch(model):
+    return runModelBatch(model, 0, 100, 100, params, initial, interventions,
+                         rseries=False, seeds=seeds)[1]
+
+def removed(model, trajs):
+    return trajs[..., -1, [model.colindex("RU"), model.colindex("RD")]].sum(axis=-1)
+
+def test_sde():
+    trajs = batch(SEIRCTSDE)
+    assert np.allclose(trajs[:, :, :8].sum(axis=2), 20000)
+    assert np.all(trajs >= 0)
+
+    ## with hundreds infectious the noise is small
+    _, ode = runModel(SEIRCTODEMem, 0, 100, 100, params, initial, interventions, rseries=False)
+    assert np.isclose(np.mean(removed(SEIRCTSDE, trajs)), removed(SEIRCTODEMem, ode), rtol=0.05)
+
+    ## and a sample does not depend on what it was run with
+    for k in (0, 7):
+        _, traj = runModel(SEIRCTSDE, 0, 100, 100, params, initial, interventions,
+                           rseries=False, seed=seeds[k])
+        assert np.allclose(trajs[k], traj)
+
+def test_ssa():
+    trajs = batch(SEIRCTSSA)
+    assert np.all(trajs[:, :, :8].sum(axis=2) == 20000)
+    assert np.all(trajs == np.round(trajs))
+
+    _, ode = runModel(SEIRCTODEMem, 0, 100, 100, params, initial, interventions, rseries=False)
+    assert np.isclose(np.mean(removed(SEIRCTSSA, trajs)), removed(SEIRCTODEMem, ode), rtol=0.05)
+
+    for k in (0, 7):
+        _, traj = runModel(SEIRCTSSA, 0, 100, 100, params, initial, interventions,
+                           rseries=False, seed=seeds[k])
+        assert np.all(trajs[k] == traj)
+
+def test_unimplemented():
+    ## a subclass must say what its kernel needs
+    with pytest.raises(Unimplemented):
+        SEIRCTStochastic()._extra()